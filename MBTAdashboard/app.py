@@ -1,5 +1,5 @@
-import json
-from flask import Flask, request, render_template, jsonify
+import time
+from flask import Flask, request, render_template, jsonify, url_for, g
 
 import sys, os
 sys.path.append('./')  # allow access to MBTAriderSegmentation
@@ -8,8 +8,66 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # allow reading fil
 from MBTAriderSegmentation.config import *  # setting global file params
 
 import src.utils as utils
+from src.jobs import job_queue
+from src.warmup import AccessLog, Warmup
+import src.metrics as metrics
 
 app = Flask(__name__)
+access_log = AccessLog()
+warmup = Warmup(access_log)
+
+@app.before_request
+def start_warmup():
+    '''Start the warm-up with the first request when the app is served without running this module'''
+    warmup.start()
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@app.after_request
+def record_metrics(response):
+    '''Record the latency and size of the response by route, e.g. /jobs/<job_id> rather than every job'''
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if 'start' in g:
+        metrics.request_seconds.observe(route, time.perf_counter() - g.start)
+    if response.content_length is not None:
+        metrics.response_bytes.observe(route, response.content_length)
+    return response
+
+def _send_payload(payload, max_age=None, mimetype='application/json'):
+    '''Return an EncodedPayload in the smallest encoding the client accepts, 304 if the client has it already'''
+    encoding = payload.get_encoding(request.accept_encodings)
+    response = app.response_class(payload.encodings[encoding], mimetype=mimetype)
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(payload.get_etag(encoding))
+    if max_age is None:
+        response.cache_control.no_cache = True  # reuse only after checking the ETag
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+def _get_payload_response(view, start_month, duration, time_weight, algorithm):
+    '''Return the frontend data of a request, or queue its computation and return the job if it is not cached'''
+    req = {'view': view, 'start_month': start_month, 'duration': duration,
+           'time_weight': time_weight, 'algorithm': algorithm}
+    if utils.find_profile(**req) is None:
+        job = job_queue.submit(**req)
+        response = jsonify({'job': job, 'status_url': url_for('job_status', job_id=job['id'])})
+        if job['status'] == 'failed':
+            # until its retry is due (see JobQueue.submit()), 404 if the input data of the request is missing
+            return response, 404 if job['error_type'] == 'FileNotFoundError' else 500
+        return response, 202
+    # json unless the client prefers the binary format, e.g. the dashboard in a browser with typed arrays
+    mimetype = request.accept_mimetypes.best_match(['application/json', BINARY_PAYLOAD_MIMETYPE]) or 'application/json'
+    binary = mimetype == BINARY_PAYLOAD_MIMETYPE
+    response = _send_payload(utils.get_frontend_payload(binary=binary, **req), mimetype=mimetype)
+    response.vary.add('Accept')
+    access_log.record(req, binary=binary)
+    return response
 
 @app.route('/request_view', methods=['GET', 'POST'])
 @app.route('/dashboard', methods=['GET', 'POST'])
@@ -20,38 +78,64 @@ def index():
 @app.route('/initialize_data')
 def initialize_view():
     '''Initialize page with default values'''
-    backend_data = utils.get_backend_data()
-    frontend_data = utils.get_frontend_data(backend_data)
-    return jsonify(frontend_data)
+    return _get_payload_response(view='overview', start_month='1710', duration='1', time_weight='0', algorithm='lda')
 
 @app.route('/reload_data', methods=['GET', 'POST'])
 def reload_data():
     '''Update page with user selection'''
-    if request.method == 'POST':
-        req_view = request.args.get('view')
-        req_start_month = request.args.get('start_month')
-        req_duration = request.args.get('duration')
-        req_time_weight = request.args.get('time_weight')
-        req_algorithm = request.args.get('algorithm')
+    # GET lets the browser revalidate its copy with If-None-Match
+    req_view = request.args.get('view')
+    req_start_month = request.args.get('start_month')
+    req_duration = request.args.get('duration')
+    req_time_weight = request.args.get('time_weight')
+    req_algorithm = request.args.get('algorithm')
 
-        req_backend_data = utils.get_backend_data(view=req_view,
-                                                  start_month=req_start_month,
-                                                  duration=req_duration,
-                                                  time_weight=req_time_weight,
-                                                  algorithm=req_algorithm)
+    req_response = _get_payload_response(view=req_view,
+                                         start_month=req_start_month,
+                                         duration=req_duration,
+                                         time_weight=req_time_weight,
+                                         algorithm=req_algorithm)
+    return req_response
 
-        req_frontend_data = utils.get_frontend_data(req_backend_data)
-    return jsonify(req_frontend_data)
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    '''Return the progress of a background job computing an uncached request'''
+    job = job_queue.get_status(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job {}'.format(job_id)}), 404
+    return jsonify(job)
+
+@app.route('/ready')
+def ready():
+    '''Return the progress of the warm-up, 503 until the shared resources and most requested views are loaded'''
+    status = warmup.get_status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    '''Return the latency histograms and cache counters in the Prometheus text format'''
+    text = metrics.render([('dashboard_payload_cache', 'Frontend payload cache', utils.payload_cache.get_stats())])
+    return app.response_class(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats')
+def cache_stats():
+    '''Return the hit/miss counters of the frontend payload cache'''
+    return jsonify(utils.payload_cache.get_stats())
 
 
 @app.route('/load_MBTA_geoJSON')
 def load_MBTA_geoJSON():
     '''Return the geoJson data of MBTA lines'''
-    filename = DATA_PATH + INPUT_PATH + 'geojson/MBTA-lines.json'
-    if filename:
-        with open(filename, 'r') as f:
-            mbta_geojson = json.load(f)
-    return jsonify(mbta_geojson)
+    return _send_payload(utils.get_mbta_lines_payload(), max_age=STATIC_MAX_AGE)
+
+@app.route('/load_zipcode_geoJSON')
+def load_zipcode_geoJSON():
+    '''Return the geoJson polygons of the zipcodes in the dashboard data, versioned by the geometry_version of the data'''
+    _, payload = utils.get_zipcode_geometry_payload()
+    return _send_payload(payload, max_age=GEOMETRY_MAX_AGE)
 
 if __name__ == "__main__":
+    # warm up while the server starts, with debug=True only in the reloader child that serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warmup.start()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,63 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+
+import sys, os
+sys.path.append('././')  # allow access to MBTAriderSegmentation
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # allow reading files from within MBTAriderSegmentation
+
+from MBTAriderSegmentation.config import *  # setting global file params
+from MBTAriderSegmentation.benchmark import run_stage_group_process
+from src.utils import get_backend_data, get_frontend_data
+
+
+def run_frontend_stages(recorder, start_month, duration):
+    """
+    Function to time the frontend data of the synthetic profiles, the frontend stage group of PipelineBenchmark
+    """
+    for algorithm in ALGORITHMS:
+        with recorder.stage('frontend_json'):
+            backend_data = get_backend_data(view='hierarchical', start_month=start_month, duration=str(duration),
+                                            time_weight='0', algorithm=algorithm)
+            json.dumps(get_frontend_data(backend_data=backend_data))
+
+
+def benchmark_frontend_data(n_clusters_list=FRONTEND_BENCHMARK_CLUSTERS, view='hierarchical', start_month='1710',
+                            duration='1', time_weight='0', algorithm='kmeans', repeat=3):
+    """
+    DESCRIPTION:
+        Function to time the formatting and serialization of dashboard payloads as the number of
+        clusters grows. The cached profile of the request is tiled to the number of clusters, so
+        DATA_PATH must hold that profile.
+    INPUT:
+        n_clusters_list: A list of integers, number of clusters of the formatted profiles
+        view, start_month, duration, time_weight, algorithm: The cached profile, see get_backend_data()
+        repeat: An integer, number of runs per size, the fastest one is reported
+    RETURN:
+        records: A list of dictionaries with n_clusters, format_time, serialize_time (seconds)
+            and payload_mb for every size
+    """
+    backend_data = get_backend_data(view=view, start_month=start_month, duration=duration,
+                                    time_weight=time_weight, algorithm=algorithm)
+    records = []
+    for n_clusters in n_clusters_list:
+        n_tiles = -(-n_clusters // len(backend_data))
+        profile = pd.concat([backend_data] * n_tiles, ignore_index=True).iloc[:n_clusters]
+        profile['cluster'] = np.arange(n_clusters)
+        format_time, serialize_time = np.inf, np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            frontend_data = get_frontend_data(profile)
+            format_time = min(format_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            payload = json.dumps(frontend_data, sort_keys=True, separators=(',', ':'))
+            serialize_time = min(serialize_time, time.perf_counter() - start)
+        records.append({'n_clusters': n_clusters, 'format_time': format_time, 'serialize_time': serialize_time,
+                        'payload_mb': len(payload) / 1024 ** 2})
+    return records
+
+
+if __name__ == '__main__':
+    # entry point of the frontend stage group process started by PipelineBenchmark
+    run_stage_group_process({'frontend': run_frontend_stages})
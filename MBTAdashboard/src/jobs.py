@@ -0,0 +1,162 @@
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import sys, os
+sys.path.append('././')  # allow access to MBTAriderSegmentation
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # allow reading files from within MBTAriderSegmentation
+
+from MBTAriderSegmentation.config import *  # setting global file params
+from MBTAriderSegmentation.catalog import ARTIFACT_PARAMS, get_catalog
+
+# pipeline stages of a profile and the artifact each one writes, the overview profiles the riders of the
+# non-hierarchical labels (see ClusterProfiler) so its segmentation stage writes those
+JOB_STAGES = [('features', 'features'), ('segmentation', 'clusters'), ('profile', 'profiles')]
+
+#######################################################################
+# ######################## HELPER FUNCTIONS ##########################
+#######################################################################
+
+def _get_params(view, start_month, duration, time_weight, algorithm):
+    return {'view': view, 'month': start_month, 'duration': duration, 'w_time': time_weight, 'algorithm': algorithm}
+
+def _get_stage_params(kind, params):
+    stage_params = dict((param, params[param]) for param in ARTIFACT_PARAMS[kind])
+    if kind == 'clusters' and stage_params['view'] == 'overview':
+        stage_params['view'] = 'non-hierarchical'
+    return stage_params
+
+def compute_profile(view, start_month, duration, time_weight, algorithm):
+    """
+    DESCRIPTION:
+        Function to run the features, segmentation and profile stages of a request, each one
+        only if its output is not cached. Runs in a worker process of JobQueue.
+    INPUT:
+        view, start_month, duration, time_weight, algorithm: The request, see utils.get_backend_data()
+    RETURN:
+        filename: A string of the profile file name
+    """
+    from MBTAriderSegmentation.profile import ClusterProfiler
+
+    by_cluster = view != 'overview'
+    def extract_profile():
+        profiler = ClusterProfiler(hierarchical=view == 'hierarchical', w_time=time_weight,
+                                   start_month=start_month, duration=int(duration))
+        profiler.extract_profile(algorithm=algorithm, by_cluster=by_cluster)
+
+    # a request computed by another process (e.g. a driver) is waited for, not computed twice
+    return get_catalog().find_or_compute('profiles', extract_profile,
+                                         **_get_params(view, start_month, duration, time_weight, algorithm))
+
+
+#######################################################################
+# ############################ JOB QUEUE #############################
+#######################################################################
+
+class JobQueue:
+    """
+    DESCRIPTION:
+        Queue of uncached dashboard requests computed by a pool of worker processes. Requests of
+        the same profile share one job while it is queued or running, and for retry_after seconds
+        once it failed, so a profile that cannot be computed is not recomputed by every request.
+    """
+    def __init__(self, max_workers=JOB_WORKERS, history=JOB_HISTORY, retry_after=JOB_RETRY_AFTER):
+        self.max_workers = max_workers
+        self.history = history
+        self.retry_after = retry_after
+        self.jobs = {}  # job id: job
+        self.__active = {}  # profile key: id of its queued, running or recently failed job
+        self.__executor = None  # started with the first job
+        self.__lock = threading.Lock()  # flask may serve requests from several threads
+
+    def __get_executor(self):
+        if self.__executor is None:
+            # spawn, forking the threads of the web server is not safe
+            self.__executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+        return self.__executor
+
+    def __forget_finished(self):
+        """
+        Function to drop the oldest finished jobs beyond the history
+        """
+        finished = [job for job in self.jobs.values() if job['future'].done()]
+        for job in sorted(finished, key=lambda job: job['submitted'])[:max(len(finished) - self.history, 0)]:
+            del self.jobs[job['id']]
+
+    def submit(self, view='overview', start_month='1710', duration='1', time_weight='0', algorithm='lda'):
+        """
+        DESCRIPTION:
+            Function to queue the computation of a profile, joining the job of the same profile if
+            there is one (or returning it if it failed less than retry_after seconds ago)
+        INPUT:
+            view, start_month, duration, time_weight, algorithm: The request, see utils.get_backend_data()
+        RETURN:
+            status: A dictionary, see get_status()
+        """
+        params = _get_params(view, start_month, duration, time_weight, algorithm)
+        key = get_catalog().get_key('profiles', **params)
+        future = None
+        with self.__lock:
+            job_id = self.__active.get(key)
+            job = self.jobs.get(job_id)
+            if job is None or time.time() - job.get('finished', time.time()) >= self.retry_after:
+                self.__forget_finished()
+                job_id = uuid.uuid4().hex[:12]
+                future = self.__get_executor().submit(compute_profile, view, start_month, duration,
+                                                      time_weight, algorithm)
+                self.jobs[job_id] = {'id': job_id, 'key': key, 'params': params, 'future': future,
+                                     'submitted': time.time()}
+                self.__active[key] = job_id
+        if future is not None:
+            # outside the lock, the callback runs right away if the job is already done
+            future.add_done_callback(lambda _: self.__finish(job_id))
+        return self.get_status(job_id)
+
+    def __finish(self, job_id):
+        with self.__lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job['finished'] = time.time()
+                # a failed job stays active until its retry is due, see submit()
+                if self.__active.get(job['key']) == job_id and job['future'].exception() is None:
+                    del self.__active[job['key']]
+
+    def get_status(self, job_id):
+        """
+        DESCRIPTION:
+            Function to get the progress of a job, a stage is done once its output is cached
+        INPUT:
+            job_id: A string, required
+        RETURN:
+            status: A dictionary with id, key, status (queued, running, done or failed), stage
+                (the stage being computed), stages (name and done of every stage), error,
+                error_type (class name of the error) and elapsed (seconds), None if there is no such job
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        future = job['future']
+        error = None
+        if future.done():
+            error = future.exception()
+            status = 'failed' if error is not None else 'done'
+        else:
+            status = 'running' if future.running() else 'queued'
+
+        catalog = get_catalog()
+        stages = []
+        for name, kind in JOB_STAGES:
+            stage_params = _get_stage_params(kind, job['params'])
+            stages.append({'name': name, 'done': catalog.find(kind, **stage_params) is not None})
+        stage = None
+        if status in ['queued', 'running']:
+            stage = next((stage['name'] for stage in stages if not stage['done']), stages[-1]['name'])
+        return {'id': job['id'], 'key': job['key'], 'status': status, 'stage': stage, 'stages': stages,
+                'error': None if error is None else repr(error),
+                'error_type': None if error is None else type(error).__name__,
+                'elapsed': job.get('finished', time.time()) - job['submitted']}
+
+job_queue = JobQueue()
@@ -7,4 +7,14 @@ views = ['overview', 'hierarchical', 'non-hierarchical']
 duration = '1'
 time_weight = '0'
 
-utils.generate_json(views, start_months, algorithms, duration, time_weight)
+if __name__ == '__main__':  # the combinations are built in worker processes
+    # only the files whose profile changed since the last build are rebuilt
+    summary = utils.generate_json(views, start_months, algorithms, duration, time_weight,
+                                  max_workers=utils.STATIC_BUILD_WORKERS)
+
+    print("\n{:<60s} {:>8s} {:>8s}".format('file', 'status', 'time'))
+    for record in sorted(summary, key=lambda record: -record['time']):
+        print("{:<60s} {:>8s} {:7.2f}s".format(record['filename'], record['status'], record['time']))
+    counts = dict((status, sum(record['status'] == status for record in summary))
+                  for status in ['built', 'skipped', 'missing', 'failed'])
+    print("\n{built} built, {skipped} skipped, {missing} missing, {failed} failed".format(**counts))
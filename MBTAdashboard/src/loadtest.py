@@ -0,0 +1,415 @@
+from collections import Counter
+from datetime import datetime
+import json
+import platform
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import numpy as np
+
+import sys, os
+sys.path.append('././')  # allow access to MBTAriderSegmentation
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # allow reading files from within MBTAriderSegmentation
+
+from MBTAriderSegmentation.config import *  # setting global file params
+
+# root of the repository and the dashboard app, the local server runs from the repository root
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+APP_FILENAME = os.path.join(REPO_PATH, 'MBTAdashboard', 'app.py')
+
+# the dashboard requests payloads like a browser does (see load_payload() in main.js), or as json for other clients
+REQUEST_HEADERS = {'Accept-Encoding': 'gzip', 'Accept': BINARY_PAYLOAD_MIMETYPE + ', application/json;q=0.9'}
+JSON_REQUEST_HEADERS = {'Accept-Encoding': 'gzip', 'Accept': 'application/json'}
+
+#######################################################################
+# ######################## HELPER FUNCTIONS ##########################
+#######################################################################
+
+def _get_rss(pid=None):
+    """
+    Function to get the current RSS of a process in MB, only supported on Linux, None elsewhere
+    """
+    try:
+        with open('/proc/{}/status'.format(pid or 'self'), 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+def _get_revision():
+    """
+    Function to get the git revision of the repository, suffixed with -dirty if it has local changes
+    """
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_PATH,
+                                          stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + '-dirty' if changes else revision
+
+def _get_candidates(views, months, algorithms):
+    """
+    Function to get every distinct request of the views, months and algorithms
+    """
+    candidates = []
+    for view in views:
+        for month in months:
+            # the overview does not depend on the algorithm
+            for algorithm in (algorithms[:1] if view == 'overview' else algorithms):
+                candidates.append({'view': view, 'start_month': month, 'duration': '1', 'time_weight': '0',
+                                   'algorithm': algorithm})
+    return candidates
+
+def get_request_mix(n_requests, views=PROFILE_VIEWS, months=LOADTEST_MONTHS, algorithms=ALGORITHMS,
+                    skew=LOADTEST_SKEW, seed=RANDOM_STATE):
+    """
+    DESCRIPTION:
+        Function to draw a mix of /reload_data requests. Every view, month and algorithm is a
+        distinct request, their popularity follows a Zipf-like distribution in a random order,
+        so a few views are requested most of the time like on the deployed dashboard.
+    INPUT:
+        n_requests: An integer, number of requests, required
+        views, months, algorithms: Lists of the requested values
+        skew: A float, Zipf skew of the popularity, 0 for uniform
+        seed: An integer, random seed
+    RETURN:
+        requests: A list of dictionaries of view, start_month, duration, time_weight and algorithm
+    """
+    candidates = _get_candidates(views, months, algorithms)
+    rng = np.random.RandomState(seed)
+    proba = 1. / np.arange(1, len(candidates) + 1) ** skew
+    proba = rng.permutation(proba / proba.sum())
+    return [candidates[i] for i in rng.choice(len(candidates), size=n_requests, p=proba)]
+
+
+#######################################################################
+# ########################### CLIENTS #################################
+#######################################################################
+
+class _AppClient:
+    """
+    Client sending requests to the dashboard app in this process with the flask test client,
+    DATA_PATH must be the data root of the load test
+    """
+    def __init__(self, headers=REQUEST_HEADERS):
+        from app import app  # MBTAdashboard/app.py, imported when the load test runs
+        self.app = app
+        self.headers = headers
+        self.pid = None  # this process
+        self.__local = threading.local()  # one test client per thread
+
+    def get(self, path):
+        client = getattr(self.__local, 'client', None)
+        if client is None:
+            client = self.__local.client = self.app.test_client()
+        response = client.get(path, headers=self.headers)
+        return response.status_code, response.get_data()
+
+
+class _HTTPClient:
+    """
+    Client sending requests to a dashboard server, started in a child process unless url is given
+    """
+    def __init__(self, data_path, url=None, port=LOADTEST_PORT, headers=REQUEST_HEADERS, timeout=60):
+        self.headers = headers
+        self.server = None
+        self.pid = None
+        if url is None:
+            url = 'http://127.0.0.1:{}'.format(port)
+            env = dict(os.environ, MBTA_DATA_PATH=data_path, FLASK_APP=APP_FILENAME)
+            env.pop('FLASK_DEBUG', None)  # no reloader, so RSS is measured in the process serving requests
+            self.server = subprocess.Popen([sys.executable, '-m', 'flask', 'run', '--port', str(port)], env=env,
+                                           cwd=REPO_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.pid = self.server.pid
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, path):
+        request = urllib.request.Request(self.url + path, headers=self.headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def close(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+            self.server = None
+
+
+#######################################################################
+# ########################## LOAD TEST ################################
+#######################################################################
+
+class LoadTest:
+    """
+    DESCRIPTION:
+        Load test of /reload_data at increasing numbers of concurrent clients. The requested views
+        are synthetic profiles written into data_path (see SyntheticDataGenerator.generate_profile()),
+        requested in a skewed mix (see get_request_mix()) by the flask test client in this process
+        or by HTTP clients of a local server, in the binary format of the dashboard in a browser
+        unless binary is False. With warm, every view is requested once before the first level,
+        so levels measure served payloads rather than building them.
+
+        Each concurrency level is a closed loop: every client sends its next request once the
+        previous one is answered. Results are a list of records (one per level) with throughput,
+        latency percentiles, RSS growth of the serving process and payload cache hit rate, saved
+        as json together with the revision and machine they were measured with.
+    """
+    def __init__(self, data_path=DATA_PATH, mode='in-process', url=None, port=LOADTEST_PORT,
+                 concurrency=LOADTEST_CONCURRENCY, n_requests=LOADTEST_REQUESTS, months=LOADTEST_MONTHS,
+                 views=PROFILE_VIEWS, algorithms=ALGORITHMS, n_clusters=LOADTEST_CLUSTERS, skew=LOADTEST_SKEW,
+                 binary=True, warm=True, seed=RANDOM_STATE):
+        if mode not in ['in-process', 'server']:
+            raise ValueError('mode must be in-process or server, not {}'.format(mode))
+        self.data_path = os.path.join(data_path, '')
+        if mode == 'in-process' and os.path.abspath(self.data_path) != os.path.abspath(DATA_PATH):
+            raise ValueError('the app in this process reads {}, set MBTA_DATA_PATH to {} to load test it in-process'
+                             .format(DATA_PATH, self.data_path))
+        self.mode = mode
+        self.url = url
+        self.port = port
+        self.concurrency = concurrency
+        self.n_requests = n_requests
+        self.months = months
+        self.views = views
+        self.algorithms = algorithms
+        self.n_clusters = n_clusters
+        self.skew = skew
+        self.binary = binary
+        self.warm = warm
+        self.seed = seed
+        self.results = []
+
+    def prepare(self):
+        """
+        DESCRIPTION:
+            Function to write the lookups and the synthetic profiles of every requested view, profiles
+            written by a previous run are reused
+        INPUT:
+            None
+        RETURN:
+            n_profiles: An integer, number of profiles written
+        """
+        from MBTAriderSegmentation.catalog import get_catalog
+        from MBTAriderSegmentation.synthetic import SyntheticDataGenerator
+
+        if self.url is not None:
+            return 0  # the server reads its own data root
+        generator = SyntheticDataGenerator(output_path=self.data_path, seed=self.seed)
+        if not os.path.exists(self.data_path + INPUT_PATH + 'stops/stops_withzip.csv'):
+            generator.generate_lookups()
+        catalog = get_catalog(self.data_path)
+        n_profiles = 0
+        for req in _get_candidates(self.views, self.months, self.algorithms):
+            if catalog.find('profiles', view=req['view'], month=req['start_month'], duration=req['duration'],
+                            w_time=req['time_weight'], algorithm=req['algorithm']) is None:
+                generator.generate_profile(req['view'], req['start_month'], algorithm=req['algorithm'],
+                                           n_clusters=self.n_clusters)
+                n_profiles += 1
+        return n_profiles
+
+    def __wait_ready(self, client, timeout=120):
+        """
+        Function to wait until the server answers and its warm-up is done, see /ready
+        """
+        start = time.time()
+        while time.time() - start < timeout:
+            try:
+                status, _ = client.get('/ready')
+                if status == 200:
+                    return
+            except (OSError, urllib.error.URLError):
+                pass  # the server is still starting
+            server = getattr(client, 'server', None)
+            if server is not None and server.poll() is not None:
+                raise RuntimeError('the dashboard server exited with code {}'.format(server.returncode))
+            time.sleep(0.2)
+        raise RuntimeError('the dashboard was not ready after {} seconds'.format(timeout))
+
+    def __get_cache_stats(self, client):
+        status, body = client.get('/cache_stats')
+        return json.loads(body.decode()) if status == 200 else {}
+
+    def __run_level(self, client, concurrency, requests):
+        """
+        Function to send requests from concurrency clients in a closed loop and summarize the latencies
+        """
+        latencies = np.zeros(len(requests))
+        statuses = Counter()
+        n_bytes = [0]
+        errors = []
+        next_request = iter(range(len(requests)))
+        lock = threading.Lock()
+
+        def send():
+            while True:
+                with lock:
+                    i = next(next_request, None)
+                if i is None:
+                    return
+                path = '/reload_data?' + urllib.parse.urlencode(requests[i])
+                start = time.perf_counter()
+                try:
+                    status, body = client.get(path)
+                except Exception as e:  # e.g. a timeout or a refused connection of an overloaded server
+                    status, body = 'error', b''
+                    with lock:
+                        errors.append(repr(e))
+                latencies[i] = time.perf_counter() - start
+                with lock:
+                    statuses[str(status)] += 1
+                    n_bytes[0] += len(body)
+
+        stats = self.__get_cache_stats(client)
+        rss_start = _get_rss(client.pid)
+        start = time.perf_counter()
+        threads = [threading.Thread(target=send) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.perf_counter() - start
+        rss_end = _get_rss(client.pid)
+        end_stats = self.__get_cache_stats(client)
+
+        hits = end_stats.get('hits', 0) - stats.get('hits', 0)
+        misses = end_stats.get('misses', 0) - stats.get('misses', 0)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {'concurrency': concurrency, 'requests': len(requests), 'wall_time': wall_time,
+                'throughput': len(requests) / wall_time, 'p50': p50, 'p95': p95, 'p99': p99,
+                'mean': latencies.mean(), 'max': latencies.max(), 'statuses': dict(statuses),
+                'errors': len(requests) - statuses.get('200', 0), 'error_samples': errors[:5],
+                'mb_per_request': n_bytes[0] / len(requests) / 1024 ** 2,
+                'rss_start_mb': rss_start, 'rss_end_mb': rss_end,
+                'rss_growth_mb': None if rss_start is None or rss_end is None else rss_end - rss_start,
+                'cache_hit_rate': hits / (hits + misses) if hits + misses else None}
+
+    def run(self):
+        """
+        DESCRIPTION:
+            Function to prepare the synthetic profiles, start the dashboard and run every concurrency level
+        INPUT:
+            None
+        RETURN:
+            results: A list of dictionaries, one per concurrency level, with concurrency, requests,
+                wall_time, throughput (requests per second), p50, p95, p99, mean and max latency
+                (seconds), statuses (count per status code), errors (responses other than 200),
+                mb_per_request, rss_start_mb, rss_end_mb, rss_growth_mb and cache_hit_rate
+        """
+        print("writing synthetic profiles into {}...".format(self.data_path))
+        self.prepare()
+        headers = REQUEST_HEADERS if self.binary else JSON_REQUEST_HEADERS
+        client = _AppClient(headers) if self.mode == 'in-process' else _HTTPClient(self.data_path, url=self.url,
+                                                                                   port=self.port, headers=headers)
+        self.results = []
+        try:
+            self.__wait_ready(client)
+            if self.warm:
+                # every view requested once, so the first level does not pay for building the payloads
+                for req in _get_candidates(self.views, self.months, self.algorithms):
+                    client.get('/reload_data?' + urllib.parse.urlencode(req))
+            for level, concurrency in enumerate(self.concurrency):
+                requests = get_request_mix(self.n_requests, views=self.views, months=self.months,
+                                           algorithms=self.algorithms, skew=self.skew, seed=self.seed + level)
+                record = self.__run_level(client, concurrency, requests)
+                self.results.append(record)
+                print("[{:3d} clients] {:8.1f} req/s  p50 {:7.1f}ms  p95 {:7.1f}ms  p99 {:7.1f}ms  errors {}".format(
+                    concurrency, record['throughput'], record['p50'] * 1000, record['p95'] * 1000,
+                    record['p99'] * 1000, record['errors']))
+        finally:
+            if self.mode == 'server':
+                client.close()
+        return self.results
+
+    def save(self, filename):
+        """
+        DESCRIPTION:
+            Function to save results as json, together with the revision, parameters and machine they were measured with
+        INPUT:
+            filename: A string of json filename, required
+        RETURN:
+            None
+        """
+        output = {
+            'created': datetime.now().isoformat(),
+            'revision': _get_revision(),
+            'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                        'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+            'params': {'mode': self.mode, 'url': self.url, 'concurrency': self.concurrency,
+                       'n_requests': self.n_requests, 'months': self.months, 'views': self.views,
+                       'algorithms': self.algorithms, 'n_clusters': self.n_clusters, 'skew': self.skew,
+                       'binary': self.binary, 'warm': self.warm, 'seed': self.seed},
+            'results': self.results
+        }
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    def get_saturation(self, fraction=0.9):
+        """
+        Function to get the concurrency at which throughput saturates, see get_saturation()
+        """
+        return get_saturation(self.results, fraction=fraction)
+
+
+def get_saturation(results, fraction=0.9):
+    """
+    DESCRIPTION:
+        Function to get the lowest concurrency reaching a fraction of the highest throughput,
+        more concurrent clients mostly wait longer beyond it
+    INPUT:
+        results: A list of result records, see LoadTest.run(), required
+        fraction: A float, fraction of the highest throughput
+    RETURN:
+        concurrency: An integer, None if there are no results
+    """
+    if not results:
+        return None
+    max_throughput = max(record['throughput'] for record in results)
+    return min(record['concurrency'] for record in results if record['throughput'] >= fraction * max_throughput)
+
+def load_results(filename):
+    """
+    Function to load results saved by LoadTest.save()
+    """
+    with open(filename, 'r') as f:
+        return json.load(f)['results']
+
+def compare_to_baseline(results, baseline, threshold=LOADTEST_THRESHOLD):
+    """
+    DESCRIPTION:
+        Function to compare results against baseline results of the same concurrency levels
+    INPUT:
+        results: A list of result records, see LoadTest.run(), required
+        baseline: A list of baseline result records, e.g. load_results(baseline_filename), required
+        threshold: A float, relative throughput drop or p95 latency increase that counts as a regression
+    RETURN:
+        regressions: A list of dictionaries with concurrency, metric, baseline, current and change
+            (relative change vs baseline) of every regression, empty if there is none
+    """
+    baseline_by_concurrency = dict((record['concurrency'], record) for record in baseline)
+    regressions = []
+    for record in results:
+        base = baseline_by_concurrency.get(record['concurrency'])
+        if base is None:
+            continue
+        for metric, sign in [('throughput', -1), ('p95', 1)]:
+            if base[metric] <= 0:
+                continue
+            change = record[metric] / base[metric] - 1
+            if sign * change > threshold:
+                regressions.append({'concurrency': record['concurrency'], 'metric': metric,
+                                    'baseline': base[metric], 'current': record[metric], 'change': change})
+    return regressions
@@ -0,0 +1,109 @@
+from bisect import bisect_left
+from functools import wraps
+import threading
+import time
+
+import sys, os
+sys.path.append('././')  # allow access to MBTAriderSegmentation
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # allow reading files from within MBTAriderSegmentation
+
+from MBTAriderSegmentation.config import *  # setting global file params
+
+
+class Histogram:
+    """
+    DESCRIPTION:
+        Histogram of observations per label value, rendered in the Prometheus text format.
+        Observing is a bisect and a few additions under a lock, cheap enough for every request.
+    """
+    def __init__(self, name, description, label, buckets):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = list(buckets)
+        self.series = {}  # label value: [counts per bucket (+Inf last), sum]
+        self.__lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        i = bisect_left(self.buckets, value)
+        with self.__lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        """
+        Function to get the lines of the histogram in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self.__lock:
+            series = sorted((label_value, list(counts), total) for label_value, (counts, total) in self.series.items())
+        for label_value, counts, total in series:
+            label = '{}="{}"'.format(self.label, label_value)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, label, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label, cumulative))
+        return lines
+
+
+# latency of the dashboard routes, of the stages of building a payload and size of the responses
+request_seconds = Histogram('dashboard_request_seconds', 'Latency of dashboard requests by route',
+                            'route', METRICS_LATENCY_BUCKETS)
+stage_seconds = Histogram('dashboard_stage_seconds', 'Latency of the stages of building a dashboard payload',
+                          'stage', METRICS_LATENCY_BUCKETS)
+response_bytes = Histogram('dashboard_response_bytes', 'Size of dashboard responses by route',
+                           'route', METRICS_SIZE_BUCKETS)
+
+def timed(stage):
+    """
+    DESCRIPTION:
+        Decorator to record the latency of a function in stage_seconds
+    INPUT:
+        stage: A string, the stage label, required
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stage_seconds.observe(stage, time.perf_counter() - start)
+        return wrapped
+    return decorator
+
+def render_counters(prefix, description, counters):
+    """
+    Function to get the lines of counters (e.g. cache hits) in the Prometheus text format
+    """
+    lines = []
+    for name, value in counters.items():
+        metric = prefix + '_' + name
+        metric_type = 'counter' if name in ['hits', 'misses', 'evictions'] else 'gauge'
+        if metric_type == 'counter':
+            metric += '_total'
+        lines += ['# HELP {} {} {}'.format(metric, description, name),
+                  '# TYPE {} {}'.format(metric, metric_type),
+                  '{} {}'.format(metric, value)]
+    return lines
+
+def render(counters=()):
+    """
+    DESCRIPTION:
+        Function to get all metrics in the Prometheus text format
+    INPUT:
+        counters: A list of (prefix, description, dictionary of values) rendered with render_counters()
+    RETURN:
+        text: A string
+    """
+    lines = []
+    for histogram in [request_seconds, stage_seconds, response_bytes]:
+        lines += histogram.render()
+    for prefix, description, values in counters:
+        lines += render_counters(prefix, description, values)
+    return '\n'.join(lines) + '\n'
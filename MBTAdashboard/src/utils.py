@@ -1,42 +1,75 @@
-from copy import deepcopy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import gzip
+import hashlib
 import json
+import struct
+import threading
+import time
 import numpy as np
 import pandas as pd
-from datetime import datetime
 
 import sys, os
 sys.path.append('././')  # allow access to MBTAriderSegmentation
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # allow reading files from within MBTAriderSegmentation
 
 from MBTAriderSegmentation.config import *  # setting global file params
-from MBTAriderSegmentation.features import FeatureExtractor
-from MBTAriderSegmentation.segmentation import Segmentation
-from MBTAriderSegmentation.profile import ClusterProfiler
+from MBTAriderSegmentation.catalog import get_catalog, get_fingerprint, atomic_write
+from src.metrics import timed
 
 #######################################################################
 # ######################## HELPER FUNCTIONS ##########################
 #######################################################################
 
-def _get_profile_path(start_month, duration):
-    start = datetime.strptime(start_month, "%y%m").strftime("%Y-%b")
-    if int(duration) > 1:
-        end = datetime.strptime(str(int(start_month) + duration - 1), "%y%m").strftime("%Y-%b")
-        profile_path = DATA_PATH + PROFILE_PATH + start + '_to_' + end + '/'
-
-    else:
-        profile_path = DATA_PATH + PROFILE_PATH + start + '/'
-    return profile_path
-
 def _get_day_hr_array():
     """
     Function to generate day and hour arrays
     """
-    day_id = np.array([x for x in range(1, 8)])
-    day = [np.asscalar(x) for x in np.repeat(day_id, [24], axis=0)]
+    day = np.repeat(np.arange(1, 8), 24).tolist()
     hour = [x for x in range(1, 25)] * 7
     return day, hour
 
 
+# frontend labels of the groups, the other groups keep their column names
+GROUP_LABELS = {
+    'race': {'asn': 'Asian', 'blk': 'Black', 'hisp': 'Hispanic', 'othr': 'Other', 'wht': 'White'},
+    'agesex': {'f_br0': 'Female Age 0-9', 'f_br1': 'Female Age 10-19', 'f_br2': 'Female Age 20-29',
+               'f_br3': 'Female Age 30-39', 'f_br4': 'Female Age 40-49', 'f_br5': 'Female Age 50-59',
+               'f_br6': 'Female Age 60-69', 'f_br7': 'Female Age 70+', 'm_br0': 'Male Age 0-9',
+               'm_br1': 'Male Age 10-19', 'm_br2': 'Male Age 20-29', 'm_br3': 'Male Age 30-39',
+               'm_br4': 'Male Age 40-49', 'm_br5': 'Male Age 50-59', 'm_br6': 'Male Age 60-69',
+               'm_br7': 'Male Age 70+'},
+    'clust_info': {'id': 'ID', 'avg_num_trips': 'Average # of Trips', 'demo_fam': 'Number of Families',
+                   'demo_hh': 'Number of Households', 'demo_house_unit': 'Number of House Units',
+                   'demo_med_income': 'Median House Income', 'demo_pop': 'Population',
+                   'demo_pop_16': 'Population over 16 (Labor Force)', 'demo_pop_25': 'Population over 25',
+                   'size': 'Size'},
+    'edu': {'bd': '4: Bachelor', 'gd': '5: Graduate', 'hs': '2: High School',
+            'sc': '3: Some College', 'nd': '1: No Degree'},
+    'emp': {'employed': 'Employed', 'unemployed': 'Unemployed'},
+    'hstat': {'fam': 'Family Households', 'mcf': 'Married Couple Families',
+              'mcf_nchild': 'Married Coule Families - No Children',
+              'mcf_ychild': 'Married Coule Families - With Children', 'nf': 'Not Family Households',
+              'nf_alone': 'Not Family Living Alone',
+              'nf_with_ui': 'Not Family Living with Unreleated Individuals',
+              'spf': 'Single Parent Family Households',
+              'spf_nchild': 'Single Parent Families - No Children',
+              'spf_ychild': 'Single Parent Families - With Children'},
+    'hu': {'occ_hh': 'Occupied Households', 'unocc': 'Unoccupied Households'},
+    'income': {'br0': '1: <$25K', 'br1': '2: $25K-$50K', 'br2': '3: $50K-$75K',
+               'br3': '4: $75K-$100K', 'br4': '5: $100K-$150K', 'br5': '6: $150K-$200K',
+               'br6': '7: $200K+'},
+    'pov': {'fam_in_pov': 'Families in Poverty', 'fam_not_in_pov': 'Families Not in Poverty'}}
+
+def _rename_group_labels(grp_name, grps):
+    """
+    Function to rename group labels so it is easier to plot in frontend
+    """
+    if grp_name not in GROUP_LABELS:
+        return grps
+    return [GROUP_LABELS[grp_name][grp] for grp in grps]
+
+
 def _get_col_group_info(prefix, exceptions, df):
     """
     Function to get the column names, column indices and group values
@@ -51,11 +84,13 @@ def _get_col_group_info(prefix, exceptions, df):
         for exception in exceptions:
             col_names = [col for col in col_names if exception not in col]
     # get column indices of the finalized col names in the df
-    col_index_list = [list(df.columns.values).index(col) for col in col_names]
+    col_index = dict((col, i) for i, col in enumerate(df.columns))
+    col_index_list = [col_index[col] for col in col_names]
     # group values are col_names minus the prefix
     col_group_values = [col.split('_', 1)[1] for col in col_names]
     return col_names, col_index_list, col_group_values
 
+@timed('_get_vis_params')
 def _get_vis_params(backend_data):
     """
     Function to configure the parameters needed for visualization based on cols of backend_data
@@ -68,10 +103,6 @@ def _get_vis_params(backend_data):
     hr_cols, hr_cols_idx, _ = _get_col_group_info('hr_', None, backend_data)
 
     # params for geographical patterns
-    filename = DATA_PATH + INPUT_PATH + 'geojson/ma_massachusetts_zip_codes_geo.min.json'
-    if filename:
-        with open(filename, 'r') as f:
-            ma_zipcode_geojson = json.load(f)
     zip_cols, zip_cols_idx, zipcodes = _get_col_group_info('zipcode_', None, backend_data)
 
     # params for purchasing patterns
@@ -102,7 +133,6 @@ def _get_vis_params(backend_data):
         # geographical pattern params
         'zipcodes': zipcodes,
         'zip_cols_idx': zip_cols_idx,
-        'ma_zipcode_geojson': ma_zipcode_geojson,
 
         # purchasing pattern params
         'usertype_cols_idx': user_cols_idx,
@@ -139,52 +169,36 @@ def _get_vis_params(backend_data):
         'hstat_grps': hstat_grps,
 
     }
+    # rename the group labels once, before formatting the clusters
+    for name in GROUP_LABELS:
+        vis_params[name + '_grps'] = _rename_group_labels(name, vis_params[name + '_grps'])
     return vis_params
 
 
-def _format_time_patterns(day, hour, hr_cols_idx, data_matrix):
+@timed('_format_time_patterns')
+def _format_time_patterns(hr_cols_idx, data_matrix):
     """
-    Function to format temporal patterns into frontend format
+    Function to format temporal patterns into frontend format, one list of values per cluster
+    aligned to the day and hour index of the payload
     """
-    temporal_patterns = []
-    for cluster in data_matrix:
-        pattern_i = {'day': day, 'hour': hour, 'value': [np.asscalar(x) for x in cluster[hr_cols_idx]]}
-        pattern_i = [dict(zip(pattern_i, col)) for col in zip(*pattern_i.values())]
-        temporal_patterns.append(pattern_i)
-    return temporal_patterns
+    return np.round(data_matrix[:, hr_cols_idx].astype(float), PAYLOAD_DECIMALS).tolist()
 
-def _format_geo_patterns(zipcodes, zip_cols_idx, ma_zipcode_geojson, data_matrix):
+@timed('_format_geo_patterns')
+def _format_geo_patterns(zip_cols_idx, data_matrix):
     """
-    Functino to format geographical patterns into frontend format
+    Function to format geographical patterns into frontend format, one list of values per cluster
+    aligned to the zipcode index of the payload. The zipcode polygons are served once by
+    get_zipcode_geometry_payload()
     """
-    # filter the MA geojson to only consider zipcodes in the riders_df for processing efficiency
-    zoi_geojson = [d for d in ma_zipcode_geojson['features'] if d['properties']['ZCTA5CE10'] in zipcodes]
-    geographical_patterns = []
-    for cluster in data_matrix:
-        pattern_i = deepcopy(zoi_geojson)  # make a zoi_geojson for each cluster
-        # loop through each zipcode geojson and push the value for that zipcode in
-        for zipcode_geo in pattern_i:
-            # the current zipcode in the loop
-            zipcode_i = zipcode_geo['properties']['ZCTA5CE10']
-            # the value count fot the current zipcode in cluster
-            value = np.asscalar(cluster[zip_cols_idx][zipcodes.index(zipcode_i)])
-            # push value into zipcode geojson
-            zipcode_geo['properties']['value'] = value
-        geographical_patterns.append(pattern_i)
-    return geographical_patterns
+    return np.round(data_matrix[:, zip_cols_idx].astype(float), PAYLOAD_DECIMALS).tolist()
 
 def _format_one_group_pattern(grps, cols_idx, data_matrix):
     """
     Function to format one group pattern (e.g. race or usertype) into frontend format
     """
-    group_pattern = []
-    for cluster in data_matrix:
-        pattern_i = {}
-        for grp, idx in zip(grps, cols_idx):
-            pattern_i[grp] = np.asscalar(cluster[idx])
-        group_pattern.append(pattern_i)
-    return group_pattern
+    return [dict(zip(grps, values)) for values in data_matrix[:, cols_idx].tolist()]
 
+@timed('_format_group_patterns')
 def _format_group_patterns(grp_names, vis_params, data_matrix):
     """
     Function to format multiple group patterns
@@ -207,69 +221,255 @@ def _format_group_patterns(grp_names, vis_params, data_matrix):
                                                          vis_params[cols_idx], data_matrix)
     return group_patterns
 
-def _rename_group_labels(frontend_data):
+#######################################################################
+# ######################### PAYLOAD CACHE ############################
+#######################################################################
+
+def _get_brotli():
     """
-    Function to rename group labels so it is easier to plot in frontend
+    Function to get the brotli module, None if it is not installed (payloads are then only gzipped)
+    """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+@timed('serialize')
+def serialize(data):
+    """
+    Function to serialize frontend data as compact json bytes
     """
-    renamed = deepcopy(frontend_data)
-    group_rename_dict = {
-        'race': {'asn': 'Asian', 'blk': 'Black', 'hisp': 'Hispanic', 'othr': 'Other', 'wht': 'White'},
-        'agesex': {'f_br0': 'Female Age 0-9', 'f_br1': 'Female Age 10-19', 'f_br2': 'Female Age 20-29',
-                   'f_br3': 'Female Age 30-39', 'f_br4': 'Female Age 40-49', 'f_br5': 'Female Age 50-59',
-                   'f_br6': 'Female Age 60-69', 'f_br7': 'Female Age 70+', 'm_br0': 'Male Age 0-9',
-                   'm_br1': 'Male Age 10-19', 'm_br2': 'Male Age 20-29', 'm_br3': 'Male Age 30-39',
-                   'm_br4': 'Male Age 40-49', 'm_br5': 'Male Age 50-59', 'm_br6': 'Male Age 60-69',
-                   'm_br7': 'Male Age 70+'},
-        'clust_info': {'id': 'ID', 'avg_num_trips': 'Average # of Trips', 'demo_fam': 'Number of Families',
-                       'demo_hh': 'Number of Households', 'demo_house_unit': 'Number of House Units',
-                       'demo_med_income': 'Median House Income', 'demo_pop': 'Population',
-                       'demo_pop_16': 'Population over 16 (Labor Force)', 'demo_pop_25': 'Population over 25',
-                       'size': 'Size'},
-        'edu': {'bd': '4: Bachelor', 'gd': '5: Graduate', 'hs': '2: High School',
-                'sc': '3: Some College', 'nd': '1: No Degree'},
-        'emp': {'employed': 'Employed', 'unemployed': 'Unemployed'},
-        'hstat': {'fam': 'Family Households', 'mcf': 'Married Couple Families',
-                  'mcf_nchild': 'Married Coule Families - No Children',
-                  'mcf_ychild': 'Married Coule Families - With Children', 'nf': 'Not Family Households',
-                  'nf_alone': 'Not Family Living Alone',
-                  'nf_with_ui': 'Not Family Living with Unreleated Individuals',
-                  'spf': 'Single Parent Family Households',
-                  'spf_nchild': 'Single Parent Families - No Children',
-                  'spf_ychild': 'Single Parent Families - With Children'},
-        'hu': {'occ_hh': 'Occupied Households', 'unocc': 'Unoccupied Households'},
-        'income': {'br0': '1: <$25K', 'br1': '2: $25K-$50K', 'br2': '3: $50K-$75K',
-                   'br3': '4: $75K-$100K', 'br4': '5: $100K-$150K', 'br5': '6: $150K-$200K',
-                   'br6': '7: $200K+'},
-        'pov': {'fam_in_pov': 'Families in Poverty', 'fam_not_in_pov': 'Families Not in Poverty'}}
-    for cluster, info in frontend_data.items():
-        for item, groups in info.items():
-            if item not in ['viz', 'usertype', 'tariff', 'servicebrand', 'temporal_patterns', 'geographical_patterns', 'report']:
-                renamed[cluster][item] = dict((group_rename_dict[item][key], value) for (key, value) in groups.items())
-    return renamed
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+
+# cluster patterns sent as little-endian float32 blocks by serialize_binary(), one row per cluster
+BINARY_BLOCKS = ['temporal_patterns', 'geographical_patterns']
+
+@timed('serialize_binary')
+def serialize_binary(data):
+    """
+    DESCRIPTION:
+        Function to serialize frontend data for clients accepting BINARY_PAYLOAD_MIMETYPE, so browsers
+        do not parse the numbers of the temporal and geographical patterns as text
+    INPUT:
+        data: A dictionary generated by get_frontend_data(), required
+    RETURN:
+        payload: Bytes of a little-endian uint32 header length, the json header padded to 4 bytes and
+            the float32 block of every BINARY_BLOCKS. The header is the frontend data without the
+            blocks plus cluster_ids (the row order of the blocks) and blocks ({name: {'offset': bytes
+            after the header, 'shape': [clusters, values per cluster]}})
+    """
+    cluster_ids = list(data['clusters'])
+    header = dict(data, cluster_ids=cluster_ids, blocks={}, clusters={})
+    for cluster_id, cluster in data['clusters'].items():
+        header['clusters'][cluster_id] = dict((name, value) for name, value in cluster.items()
+                                              if name not in BINARY_BLOCKS)
+    blocks = []
+    offset = 0
+    for name in BINARY_BLOCKS:
+        n_values = len(data['clusters'][cluster_ids[0]][name]) if cluster_ids else 0
+        block = np.array([data['clusters'][cluster_id][name] for cluster_id in cluster_ids],
+                         dtype='<f4').reshape(len(cluster_ids), n_values)
+        header['blocks'][name] = {'offset': offset, 'shape': list(block.shape)}
+        blocks.append(block.tobytes())
+        offset += block.nbytes
+    header = serialize(header)
+    header += b' ' * (-(4 + len(header)) % 4)  # float32 blocks start at a multiple of 4 bytes
+    return struct.pack('<I', len(header)) + header + b''.join(blocks)
+
+class EncodedPayload:
+    """
+    DESCRIPTION:
+        Serialized payload (json or binary) with its precompressed encodings and a strong ETag of its content,
+        compressed once when it is cached rather than on every response
+    """
+    @timed('compress')
+    def __init__(self, payload):
+        self.etag = hashlib.sha1(payload).hexdigest()[:20]
+        self.encodings = {'identity': payload, 'gzip': gzip.compress(payload)}
+        brotli = _get_brotli()
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(payload)
+        self.nbytes = sum(len(encoded) for encoded in self.encodings.values())
+
+    def get_encoding(self, accept_encodings):
+        """
+        Function to get the smallest encoding accepted by the client, e.g. br, gzip or identity
+        """
+        for encoding in ['br', 'gzip']:
+            if encoding in self.encodings and encoding in accept_encodings:
+                return encoding
+        return 'identity'
+
+    def get_etag(self, encoding):
+        """
+        Function to get the ETag of an encoding, each encoding is a different representation
+        """
+        return self.etag if encoding == 'identity' else self.etag + '-' + encoding
+
+    def write(self, filename):
+        """
+        Function to write the payload and its compressed encodings next to it, e.g. x.json and x.json.gz
+        """
+        extensions = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+        for encoding, encoded in self.encodings.items():
+            with atomic_write(filename + extensions[encoding]) as temp_filename:
+                with open(temp_filename, 'wb') as fp:
+                    fp.write(encoded)
+
+
+class PayloadCache:
+    """
+    DESCRIPTION:
+        Least recently used cache of encoded payloads (see EncodedPayload), bounded by the number of
+        entries and their total size. Each entry keeps the fingerprints of the files it was computed from
+        and is dropped when one of them changes.
+    """
+    def __init__(self, max_entries=PAYLOAD_CACHE_SIZE, max_bytes=PAYLOAD_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (fingerprints, payload)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()  # flask may serve requests from several threads
+
+    def __pop(self, key):
+        _, payload = self.entries.pop(key)
+        self.nbytes -= payload.nbytes
+
+    def get(self, key, fingerprints, count=True):
+        """
+        Function to get a cached payload, None if it is not cached or its files changed. With count=False
+        the hit/miss counters are left unchanged, e.g. for the warm-up that is not serving a client.
+        """
+        with self.__lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == fingerprints:
+                self.entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self.__pop(key)
+            if count:
+                self.misses += 1
+            return None
+
+    def put(self, key, fingerprints, payload):
+        """
+        Function to cache a payload, evicting the least recently used ones beyond the bounds
+        """
+        if payload.nbytes > self.max_bytes:
+            return
+        with self.__lock:
+            if key in self.entries:
+                self.__pop(key)
+            self.entries[key] = (fingerprints, payload)
+            self.nbytes += payload.nbytes
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self.__pop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get_stats(self):
+        """
+        Function to get the counters of the cache
+        """
+        with self.__lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / requests if requests else 0.0,
+                    'entries': len(self.entries), 'bytes': self.nbytes,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
+payload_cache = PayloadCache()
 
 
 #######################################################################
 # ######################## BACKEND FUNCTIONS ##########################
 #######################################################################
 
+def _get_zipcode_geojson_filename():
+    return DATA_PATH + INPUT_PATH + 'geojson/ma_massachusetts_zip_codes_geo.min.json'
+
+def _get_stops_filename():
+    return DATA_PATH + INPUT_PATH + 'stops/stops_withzip.csv'
+
+def _get_geometry_version():
+    """
+    Function to get the version of the zipcode geometry, changes with the files it is computed from
+    """
+    return '-'.join(str(get_fingerprint(filename))
+                    for filename in [_get_zipcode_geojson_filename(), _get_stops_filename()])
+
+def get_zipcode_geometry_payload(preload=False):
+    """
+    DESCRIPTION:
+        Function to get the serialized polygons of the zipcodes served by MBTA stops, the only
+        zipcodes that can appear in a profile. It does not depend on the request, so browsers
+        can keep it for as long as its version is unchanged.
+    INPUT:
+        preload: A boolean, True to load it into payload_cache without counting a hit or miss
+    RETURN:
+        version: A string, changes with the geojson and stops files
+        payload: An EncodedPayload of a geojson FeatureCollection with the ZCTA5CE10 property only
+    """
+    version = _get_geometry_version()
+    payload = payload_cache.get('geometry/zipcodes', version, count=not preload)
+    if payload is None:
+        stop_zipcodes = set(pd.read_csv(_get_stops_filename(), usecols=['zipcode'], dtype={'zipcode': str})['zipcode'])
+        with open(_get_zipcode_geojson_filename(), 'r') as f:
+            ma_zipcode_geojson = json.load(f)
+        features = [{'type': 'Feature', 'geometry': d['geometry'],
+                     'properties': {'ZCTA5CE10': d['properties']['ZCTA5CE10']}}
+                    for d in ma_zipcode_geojson['features'] if d['properties']['ZCTA5CE10'] in stop_zipcodes]
+        payload = EncodedPayload(json.dumps({'type': 'FeatureCollection', 'features': features},
+                                            separators=(',', ':')).encode())
+        payload_cache.put('geometry/zipcodes', version, payload)
+    return version, payload
+
+def get_mbta_lines_payload(preload=False):
+    """
+    Function to get the geojson of the MBTA lines as an EncodedPayload, read again only when the file changes
+    (preload=True leaves the hit/miss counters of payload_cache unchanged)
+    """
+    filename = DATA_PATH + INPUT_PATH + 'geojson/MBTA-lines.json'
+    fingerprint = get_fingerprint(filename)
+    payload = payload_cache.get('geometry/mbta_lines', fingerprint, count=not preload)
+    if payload is None:
+        with open(filename, 'rb') as f:
+            payload = EncodedPayload(f.read())
+        payload_cache.put('geometry/mbta_lines', fingerprint, payload)
+    return payload
+
+def find_profile(view, start_month, duration, time_weight, algorithm):
+    """
+    Function to look up the cached profile of a request
+    """
+    if view not in ['overview', 'hierarchical', 'non-hierarchical']:
+        print('File Not Found: {} view'.format(view))
+        raise FileNotFoundError
+    return get_catalog().find('profiles', view=view, month=start_month, duration=duration,
+                              w_time=time_weight, algorithm=algorithm)
+
+@timed('get_backend_data')
 def get_backend_data(view='overview', start_month='1710', duration='1',
                      time_weight='0', algorithm='lda'):
     """
     """
-    # parse request to generate profile filename
-    profile_path = _get_profile_path(start_month=start_month, duration=duration)
-    if view == 'overview':
-        profile_filename = profile_path + view + '_' + PROFILE_FILE_PREFIX + start_month + '_' + duration + '.csv'
-    elif view in ['hierarchical', 'non-hierarchical']:
-        profile_filename = profile_path + view + '_' + PROFILE_FILE_PREFIX + start_month + '_' + duration + '_' + time_weight + '_' + algorithm + '.csv'
-    else:
-        print('File Not Found: {}'.format(profile_filename))
-        raise FileNotFoundError
-    try:
-        backend_data = pd.read_csv(profile_filename, index_col=0)
-    except FileNotFoundError:
-        print("Recluster....")
-        backend_data = None
+    # look up the cached profile of the request
+    profile_filename = find_profile(view, start_month, duration, time_weight, algorithm)
+    if profile_filename is None:
+        # computed in the background by jobs.job_queue, see /reload_data
+        raise FileNotFoundError('{} {} {} {} {} profile is not cached'.format(view, start_month, duration,
+                                                                             time_weight, algorithm))
+    backend_data = pd.read_csv(profile_filename, index_col=0)
 
     # collapse some groups for better visualization e.g. usertype should only have adult, student, senior/TAP and others
     usertype_cols = [col for col in backend_data.columns if "usertype_" in col]
@@ -295,18 +495,30 @@ def get_backend_data(view='overview', start_month='1710', duration='1',
 
     return backend_data
 
+@timed('get_frontend_data')
 def get_frontend_data(backend_data):
     """
+    DESCRIPTION:
+        Function to format backend data for the dashboard. Temporal and geographical patterns are
+        lists of values aligned to the shared day/hour and zipcode indices of the payload, the
+        zipcode polygons are served separately, see get_zipcode_geometry_payload()
+    INPUT:
+        backend_data: A data frame generated by get_backend_data() function
+    RETURN:
+        frontend_data: A dictionary in the form of
+            {'version': PAYLOAD_VERSION, 'geometry_version': version of the zipcode polygons,
+             'days': [day of each temporal value], 'hours': [hour of each temporal value],
+             'zipcodes': [zipcode of each geographical value],
+             'clusters': {'cluster_id': {'temporal_patterns': [values], 'geographical_patterns': [values],
+                                         'report': text, 'race': {...}, ...}}}
     """
     vis_params = _get_vis_params(backend_data=backend_data)
     # data_matrix = backend_data.values
     data_matrix = backend_data.drop(['report', 'rider_type'], axis=1).values
     # format temporal patterns
-    time_data = _format_time_patterns(vis_params['day'], vis_params['hour'],
-                                      vis_params['hr_cols_idx'], data_matrix)
+    time_data = _format_time_patterns(vis_params['hr_cols_idx'], data_matrix)
     # format geographical patterns
-    geo_data = _format_geo_patterns(vis_params['zipcodes'], vis_params['zip_cols_idx'],
-                                    vis_params['ma_zipcode_geojson'], data_matrix)
+    geo_data = _format_geo_patterns(vis_params['zip_cols_idx'], data_matrix)
 
     # format all other patterns including ticket purchasing patterns, cluster information
     # and demographics distributions
@@ -315,22 +527,54 @@ def get_frontend_data(backend_data):
                  # demographics groups
                  'race', 'agesex', 'income', 'edu', 'pov', 'emp', 'hu', 'hstat']
     other_data = _format_group_patterns(grp_names, vis_params, data_matrix)
-    other_data = [dict(zip(other_data, col)) for col in zip(*other_data.values())]
-
-    # gather all formatted data and store in a dictionary
-    frontend_data = {}
-    # append other_data first
-    for cluster_id, cluster_data in zip(backend_data['cluster'], other_data):  # each item in other_data is a cluster
-        frontend_data[str(cluster_id)] = cluster_data
-    # append temporal and geo data
-    for i, (cluster_id, cluster_data) in enumerate(frontend_data.items()):
-        cluster_data['report'] = backend_data.loc[i, 'report']
-        cluster_data['temporal_patterns'] = time_data[int(i)]
-        cluster_data['geographical_patterns'] = geo_data[int(i)]
-
-    frontend_data = _rename_group_labels(frontend_data)
+    reports = backend_data['report'].tolist()
+
+    # gather all formatted data of each cluster and store in a dictionary
+    clusters = {}
+    for i, cluster_id in enumerate(backend_data['cluster'].tolist()):
+        cluster_data = dict((name, patterns[i]) for name, patterns in other_data.items())
+        cluster_data['report'] = reports[i]
+        cluster_data['temporal_patterns'] = time_data[i]
+        cluster_data['geographical_patterns'] = geo_data[i]
+        clusters[str(cluster_id)] = cluster_data
+
+    frontend_data = {'version': PAYLOAD_VERSION,
+                     'geometry_version': _get_geometry_version(),
+                     'days': vis_params['day'],
+                     'hours': vis_params['hour'],
+                     'zipcodes': vis_params['zipcodes'],
+                     'clusters': clusters}
     return frontend_data
 
+def get_frontend_payload(view='overview', start_month='1710', duration='1',
+                         time_weight='0', algorithm='lda', binary=False, preload=False):
+    """
+    DESCRIPTION:
+        Function to get the serialized frontend data of a request, served from payload_cache
+        while the profile and the zipcode geojson it was computed from are unchanged
+    INPUT:
+        view, start_month, duration, time_weight, algorithm: The request, see get_backend_data()
+        binary: A boolean, True for the format of serialize_binary(), False for json
+        preload: A boolean, True to load it into payload_cache without counting a hit or miss
+    RETURN:
+        payload: An EncodedPayload of the frontend data
+    """
+    profile_filename = find_profile(view, start_month, duration, time_weight, algorithm)
+    # the catalog key ignores the weight and algorithm of the overview
+    key = get_catalog().get_key('profiles', view=view, month=start_month, duration=duration,
+                                w_time=time_weight, algorithm=algorithm)
+    if binary:
+        key += '/binary'
+    fingerprints = (get_fingerprint(profile_filename) if profile_filename else None, _get_geometry_version())
+    payload = payload_cache.get(key, fingerprints, count=not preload)
+    if payload is None:
+        backend_data = get_backend_data(view=view, start_month=start_month, duration=duration,
+                                        time_weight=time_weight, algorithm=algorithm)
+        frontend_data = get_frontend_data(backend_data)
+        payload = EncodedPayload(serialize_binary(frontend_data) if binary else serialize(frontend_data))
+        payload_cache.put(key, fingerprints, payload)
+    return payload
+
 
 def generate_filename(view, start_month, algorithm, duration, time_weight):
     filename = ''
@@ -343,22 +587,98 @@ def generate_filename(view, start_month, algorithm, duration, time_weight):
     else:
         raise ValueError('invalid filename')
 
-def generate_json(views, start_months, algorithms, duration, time_weight):
+def _get_file_hash(filename):
+    """
+    Function to get the hash of the content of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def _build_static_payload(view, start_month, algorithm, duration, time_weight, filename):
+    """
+    Function to write the frontend data of one request for the static dashboard, runs in a worker process
+    """
+    start = time.perf_counter()
+    backend_data = get_backend_data(view=view, start_month=start_month, duration=duration,
+                                    time_weight=time_weight, algorithm=algorithm)
+    payload = EncodedPayload(serialize(get_frontend_data(backend_data=backend_data)))
+    payload.write(filename)
+    return {'time': time.perf_counter() - start, 'bytes': len(payload.encodings['identity'])}
+
+def generate_json(views, start_months, algorithms, duration, time_weight, output_path='',
+                  max_workers=STATIC_BUILD_WORKERS):
+    """
+    DESCRIPTION:
+        Function to write the frontend data of every combination of the arguments for the static
+        version of the dashboard. Combinations run in a process pool, and a file is only rebuilt
+        when the hash of its source profile differs from the one in the manifest of the previous build.
+    INPUT:
+        views, start_months, algorithms: Lists of the requests to build, the overview ignores algorithms
+        duration, time_weight: Strings, shared by all requests
+        output_path: A string, directory of the json files and of the build manifest
+        max_workers: An integer, number of worker processes
+    RETURN:
+        summary: A list of dictionaries with filename, status (built, skipped, missing or failed)
+            and time (seconds) of every file
+    """
+    manifest_filename = output_path + STATIC_BUILD_MANIFEST
+    manifest = {}
+    if os.path.isfile(manifest_filename):
+        with open(manifest_filename, 'r') as f:
+            manifest = json.load(f)
+    summary = []
+
+    # the zipcode polygons are shared by all views
+    start = time.perf_counter()
+    geometry_version, geometry = get_zipcode_geometry_payload()
+    filename = output_path + 'zipcode_geometry.json'
+    source = {'geometry_version': geometry_version}
+    if manifest.get(os.path.basename(filename)) != source or not os.path.isfile(filename):
+        geometry.write(filename)
+        manifest[os.path.basename(filename)] = source
+        summary.append({'filename': filename, 'status': 'built', 'time': time.perf_counter() - start})
+    else:
+        summary.append({'filename': filename, 'status': 'skipped', 'time': 0.0})
+
+    # the source of each file (keyed by its name in output_path): the hash of its profile and the format of the payload
+    tasks = {}
     for view in views:
-        if view == 'overview':
-            for start_month in start_months:
-                filename = generate_filename(view=view, start_month=start_month, algorithm=None, duration=duration, time_weight=time_weight)
-                print("filename: ", filename)
-                backend_data = get_backend_data(view=view, start_month=start_month, duration=duration, time_weight=time_weight, algorithm=None)
-                frontend_data = get_frontend_data(backend_data=backend_data)
-                with open(filename, 'w') as fp:
-                    json.dump(frontend_data, fp)
-        else:
-            for start_month in start_months:
-                for algorithm in algorithms:
-                    filename = generate_filename(view=view, start_month=start_month, algorithm=algorithm, duration=duration, time_weight=time_weight)
-                    print("filename: ", filename)
-                    backend_data = get_backend_data(view=view, start_month=start_month, duration=duration, time_weight=time_weight, algorithm=algorithm)
-                    frontend_data = get_frontend_data(backend_data=backend_data)
-                    with open(filename, 'w') as fp:
-                        json.dump(frontend_data, fp)
+        for start_month in start_months:
+            for algorithm in ([None] if view == 'overview' else algorithms):
+                filename = output_path + generate_filename(view=view, start_month=start_month, algorithm=algorithm,
+                                                           duration=duration, time_weight=time_weight)
+                profile_filename = find_profile(view, start_month, duration, time_weight, algorithm)
+                if profile_filename is None:
+                    summary.append({'filename': filename, 'status': 'missing', 'time': 0.0})
+                    continue
+                source = {'profile': _get_file_hash(profile_filename), 'payload_version': PAYLOAD_VERSION,
+                          'geometry_version': geometry_version}
+                if manifest.get(os.path.basename(filename)) == source and os.path.isfile(filename):
+                    summary.append({'filename': filename, 'status': 'skipped', 'time': 0.0})
+                    continue
+                tasks[filename] = ((view, start_month, algorithm, duration, time_weight, filename), source)
+
+    if tasks:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+            futures = dict((executor.submit(_build_static_payload, *args), filename)
+                           for filename, (args, _) in tasks.items())
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print("failed to build {}: {!r}".format(filename, e))
+                    summary.append({'filename': filename, 'status': 'failed', 'time': 0.0})
+                    manifest.pop(os.path.basename(filename), None)
+                    continue
+                print("built {} in {:.2f}s".format(filename, result['time']))
+                summary.append({'filename': filename, 'status': 'built', 'time': result['time']})
+                manifest[os.path.basename(filename)] = tasks[filename][1]
+
+    with atomic_write(manifest_filename) as temp_filename:
+        with open(temp_filename, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return summary
@@ -0,0 +1,175 @@
+from collections import Counter, deque
+import json
+import atexit
+import threading
+import time
+
+import sys, os
+sys.path.append('././')  # allow access to MBTAriderSegmentation
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # allow reading files from within MBTAriderSegmentation
+
+from MBTAriderSegmentation.config import *  # setting global file params
+from MBTAriderSegmentation.catalog import atomic_write
+
+import src.utils as utils
+
+# request parameters recorded in the access log, in the order of utils.get_frontend_payload()
+REQUEST_PARAMS = ['view', 'start_month', 'duration', 'time_weight', 'algorithm']
+
+# format of the payloads recorded after the request parameters, see utils.get_frontend_payload(binary=...)
+PAYLOAD_FORMATS = ['json', 'binary']
+
+# the view the dashboard opens with, see /initialize_data
+DEFAULT_REQUEST = {'view': 'overview', 'start_month': '1710', 'duration': '1', 'time_weight': '0', 'algorithm': 'lda'}
+
+
+class AccessLog:
+    """
+    DESCRIPTION:
+        Log of the dashboard requests served from cached profiles, read at start up to preload the
+        most requested payloads. The latest max_lines requests are kept in memory and written to
+        the file, one json line per request, at most every flush_interval seconds, so the file
+        never grows beyond max_lines and requests do not wait for it.
+    """
+    def __init__(self, filename=None, max_lines=WARMUP_LOG_LINES, flush_interval=WARMUP_LOG_FLUSH_INTERVAL):
+        self.filename = filename or DATA_PATH + ACCESS_LOG_FILE
+        self.max_lines = max_lines
+        self.flush_interval = flush_interval
+        self.__lines = None  # latest requests, read from the file on first use
+        self.__pending = 0  # requests recorded since the last flush
+        self.__flushed = time.time()
+        self.__lock = threading.Lock()  # flask may serve requests from several threads
+        self.__flush_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def __get_lines(self):
+        if self.__lines is None:
+            self.__lines = deque(maxlen=self.max_lines)
+            if os.path.isfile(self.filename):
+                with open(self.filename, 'r') as f:
+                    lines = deque(f, maxlen=self.max_lines)
+                for line in lines:
+                    try:
+                        values = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash of an older version of the log
+                    # lines logged before the format was recorded were served as json
+                    payload_format = values[len(REQUEST_PARAMS):] or ['json']
+                    self.__lines.append(json.dumps(values[:len(REQUEST_PARAMS)] + payload_format))
+        return self.__lines
+
+    def record(self, req, binary=False):
+        """
+        Function to add a request and the format it was served in to the log, written to the file once
+        flush_interval has passed
+        """
+        line = json.dumps([req[name] for name in REQUEST_PARAMS] + [PAYLOAD_FORMATS[binary]])
+        with self.__lock:
+            self.__get_lines().append(line)
+            self.__pending += 1
+            due = time.time() - self.__flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Function to rewrite the file with the latest max_lines requests, does nothing if none was recorded
+        """
+        with self.__flush_lock:
+            with self.__lock:
+                if not self.__pending:
+                    return
+                lines = list(self.__get_lines())
+                self.__pending = 0
+                self.__flushed = time.time()
+            # replaced in one step, a crash never leaves the file cut short
+            with atomic_write(self.filename) as temp_filename:
+                with open(temp_filename, 'w') as f:
+                    f.writelines(line + '\n' for line in lines)
+
+    def get_most_requested(self, n):
+        """
+        DESCRIPTION:
+            Function to get the most requested requests among the last max_lines of the log, a request
+            served in both formats counts as two
+        INPUT:
+            n: An integer, number of requests, required
+        RETURN:
+            requests: A list of at most n dictionaries of REQUEST_PARAMS and binary, most requested first
+        """
+        with self.__lock:
+            counts = Counter(self.__get_lines())
+        requests = []
+        for line, _ in counts.most_common(n):
+            values = json.loads(line)
+            req = dict(zip(REQUEST_PARAMS, values))
+            req['binary'] = values[len(REQUEST_PARAMS)] == 'binary'
+            requests.append(req)
+        return requests
+
+
+class Warmup:
+    """
+    DESCRIPTION:
+        Background preloading of the resources shared by all requests (zipcode geometry, MBTA
+        lines) and of the most requested payloads into utils.payload_cache. Requests are served
+        while it runs, a payload that is not preloaded yet is computed by the request as usual.
+    """
+    def __init__(self, access_log, n_payloads=WARMUP_PAYLOADS):
+        self.access_log = access_log
+        self.n_payloads = n_payloads
+        self.status = 'pending'  # pending, running, ready
+        self.steps = []  # name, time and error of every step done
+        self.started = None
+        self.finished = None
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        Function to start the warm-up in a daemon thread, does nothing if it is already started
+        """
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__thread = threading.Thread(target=self.run, name='dashboard-warmup', daemon=True)
+            self.status = 'running'
+            self.started = time.time()
+            self.__thread.start()
+
+    def __run_step(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        error = None
+        try:
+            func(*args, **kwargs)
+        except Exception as e:  # e.g. an uncached profile, the server still starts
+            error = repr(e)
+        self.steps.append({'name': name, 'time': time.perf_counter() - start, 'error': error})
+
+    def run(self):
+        """
+        Function to preload the shared resources, the default view in both formats and the most requested payloads
+        """
+        # preloads are not requests, they leave the hit rate of payload_cache to the clients
+        self.__run_step('zipcode_geometry', utils.get_zipcode_geometry_payload, preload=True)
+        self.__run_step('mbta_lines', utils.get_mbta_lines_payload, preload=True)
+
+        preloaded = set()
+        # the dashboard in a browser asks for the binary format, other clients for json
+        default_requests = [dict(DEFAULT_REQUEST, binary=binary) for binary in [True, False]]
+        for req in default_requests + self.access_log.get_most_requested(self.n_payloads):
+            key = tuple(req[name] for name in REQUEST_PARAMS) + (PAYLOAD_FORMATS[req['binary']],)
+            if key not in preloaded:
+                preloaded.add(key)
+                # an uncached profile fails its step, it is computed by a job when it is requested
+                self.__run_step('payload ' + '/'.join(str(value) for value in key),
+                                utils.get_frontend_payload, preload=True, **req)
+        self.finished = time.time()
+        self.status = 'ready'
+
+    def get_status(self):
+        """
+        Function to get the progress of the warm-up
+        """
+        return {'status': self.status, 'ready': self.status == 'ready', 'steps': list(self.steps),
+                'elapsed': None if self.started is None else (self.finished or time.time()) - self.started}
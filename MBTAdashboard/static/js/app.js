@@ -22,20 +22,27 @@ function update_url() {
 
 // Run pyscript
 function run_pyscript(input) {
-    $.ajax({
-        type: "POST",
-        url: update_url(),
-        data: {
-            param: input
-        }, //use this to store what changed
-        success: call_back
+    // GET is cacheable, the server answers 304 when the view did not change
+    var url = update_url() + "&param=" + encodeURIComponent(input); //use this to store what changed
+    load_payload(url, function(error, response) {
+        if (error) { console.log(error); return; }
+        call_back(response);
     });
 }
 
 function call_back(response) {
     // window.location.href = "/request_view";
-    clusters = Object.keys(response).map(function(key) {
-        return response[key];
+    if (response.job) {
+        // the requested view is not cached yet, request it again once its job is done
+        wait_for_job(response, function() {
+            run_pyscript("view request");
+        });
+        return;
+    }
+    show_job_status(null);
+    if (response.version !== PAYLOAD_VERSION) { console.log("unexpected payload version " + response.version); };
+    clusters = Object.keys(response.clusters).map(function(key) {
+        return response.clusters[key];
     });
     console.log("this is call back");
     // get different types of patterns
@@ -45,6 +52,9 @@ function call_back(response) {
     geographical_data = clusters.map(function(d) {
         return d.geographical_patterns;
     });
+    temporal_index = {day: response.days, hour: response.hours};
+    zipcodes = response.zipcodes;
+    geometry_version = response.geometry_version;
     usertype_data = clusters.map(function(d) {
         return d.usertype;
     });
@@ -96,11 +106,11 @@ function call_back(response) {
     temporal_data.map(function(d, i) {
         timePatternVisTitleList.push("Cluster " + i);
     })
-    timePatternVis = new TemporalPatternChart("temporal-chart", temporal_data, timePatternVisTitleList, temporal_data.length, colors)
+    timePatternVis = new TemporalPatternChart("temporal-chart", temporal_data, timePatternVisTitleList, temporal_data.length, colors, temporal_index)
 
     // update geographical pattern chart
     geoPatternVis.bostonMap.remove();
-    geoPatternVis = new BostonMap("geographical-chart", geographical_data, 0, colors, USER_CONTROLS.VIEW_BY_CLUSTER);
+    geoPatternVis = new BostonMap("geographical-chart", geographical_data, 0, colors, USER_CONTROLS.VIEW_BY_CLUSTER, zipcodes, geometry_version);
 
     // update purchase pattern
     $('#purchase-chart').empty();
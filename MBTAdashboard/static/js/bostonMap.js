@@ -1,24 +1,28 @@
 /*
  *  StationMap - Object constructor function
  *  @param _parentElement   	-- HTML element in which to draw the visualization
- *  @param _data            	-- Array with all stations of the bike-sharing network
+ *  @param _data            	-- Array of zipcode values per cluster
  *  @param _clusterSelection  -- Cluster number to visualize
+ *  @param _zipcodes          -- Zipcode of each value
+ *  @param _geometryVersion   -- Version of the zipcode polygons the values refer to
  */
 
-BostonMap = function(_parentElement, _data, _clusterSelection, _colors, _view=false) {
+BostonMap = function(_parentElement, _data, _clusterSelection, _colors, _view=false, _zipcodes, _geometryVersion) {
 
 	this.parentElement = _parentElement;
 	this.data = _data;
 	this.clusterSelection = _clusterSelection;
 	this.colors = _colors;
 	this.view = _view; // false = overview; true = by_cluster
+	this.zipcodes = _zipcodes;
+	this.geometryVersion = _geometryVersion;
 
 	this.valueMax = d3.max(_data.map(function(d){
-			return d3.max(d, function (e) { return e.properties.value; });
+			return d3.max(d);
 	}));
 
 	this.valueMin = d3.min(_data.map(function(d){
-			return d3.min(d, function (e) { return e.properties.value; });
+			return d3.min(d);
 	}));
 
 	this.buckets = _colors.length;;
@@ -28,6 +32,20 @@ BostonMap = function(_parentElement, _data, _clusterSelection, _colors, _view=fa
 }
 
 
+/*
+ *  Zipcode polygons shared by all maps, requested once per geometry version
+ */
+
+BostonMap.geometry = {};
+
+BostonMap.loadGeometry = function(version) {
+	if (!(version in BostonMap.geometry)) {
+		BostonMap.geometry[version] = $.getJSON("/load_zipcode_geoJSON?v=" + version);
+	}
+	return BostonMap.geometry[version];
+}
+
+
 /*
  *  Initialize station map
  */
@@ -62,17 +80,26 @@ BostonMap.prototype.initVis = function() {
 		// Add cluster zipcode pattern layer group
 		vis.zipCodeLayerGroup = L.layerGroup().addTo(vis.bostonMap);
 
-		vis.wrangleData();
-
-		// Listen to view change events
-		// If view is overall, append one radio button with value = Overall
-		if (vis.view) { // if view by_cluster
-			$('#geo-data-selection div input').click(function(){
-				vis.clusterSelection = d3.select(this).property("value");
-				vis.zipCodeLayerGroup.clearLayers(); // clear previous layers to redraw
-				vis.wrangleData();
-			})
-		}
+		BostonMap.loadGeometry(vis.geometryVersion).done(function(geoJSONdata) {
+			// keep the polygons of the zipcodes in the data, looked up by the index of their value
+			vis.zipcodeIndex = {};
+			vis.zipcodes.forEach(function(d, i) { vis.zipcodeIndex[d] = i; });
+			vis.zipcodeFeatures = geoJSONdata.features.filter(function(d) {
+				return d.properties.ZCTA5CE10 in vis.zipcodeIndex;
+			});
+
+			vis.wrangleData();
+
+			// Listen to view change events
+			// If view is overall, append one radio button with value = Overall
+			if (vis.view) { // if view by_cluster
+				$('#geo-data-selection div input').click(function(){
+					vis.clusterSelection = d3.select(this).property("value");
+					vis.zipCodeLayerGroup.clearLayers(); // clear previous layers to redraw
+					vis.wrangleData();
+				})
+			}
+		});
 }
 
 
@@ -96,7 +123,7 @@ BostonMap.prototype.wrangleData = function() {
 BostonMap.prototype.updateVis = function() {
 	var vis = this;
 
-	L.geoJson(vis.displayData, {style: styleZipCode}).addTo(vis.zipCodeLayerGroup);
+	L.geoJson(vis.zipcodeFeatures, {style: styleZipCode}).addTo(vis.zipCodeLayerGroup);
 
 	function getColor(d) {
 		return 	d < vis.valueScale[0] ? vis.colors[0] :
@@ -117,7 +144,7 @@ BostonMap.prototype.updateVis = function() {
       opacity: 0.8,
 			color: "white",
 			dashArray: '3',
-			fillColor: getColor(feature.properties.value),
+			fillColor: getColor(vis.displayData[vis.zipcodeIndex[feature.properties.ZCTA5CE10]]),
 			fillOpacity: 0.6
 		};
 	}
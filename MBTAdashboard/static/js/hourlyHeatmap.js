@@ -1,13 +1,13 @@
 /*
  *  Heatmap - Object constructor function
  *  @param _parentElement   -- HTML element in which to draw the visualization
- *  @param _data            -- array of data
+ *  @param _data            -- array of hourly values
  *  @param _colors          -- array of colors
  *  @param _maxSaturation   -- maximum color saturation on the color scale
- *  @param _showLegend      -- whether to show legend (boolean)
+ *  @param _index           -- day and hour of each value, {day: [...], hour: [...]}
  */
 
-HourlyHeatmap = function(_parentElement, _data, _titleText, _colors, _maxSaturation){
+HourlyHeatmap = function(_parentElement, _data, _titleText, _colors, _maxSaturation, _index){
     this.$graphicContainer = $("#" + _parentElement);
     this.parentElement = _parentElement;
     this.data = _data;
@@ -18,6 +18,7 @@ HourlyHeatmap = function(_parentElement, _data, _titleText, _colors, _maxSaturat
     this.colors = _colors;
     this.buckets = _colors.length;
     this.maxSaturation = _maxSaturation;
+    this.index = _index;
     this.duration = 1000;
 
     this.initVis();
@@ -90,6 +91,10 @@ HourlyHeatmap.prototype.initVis = function() {
  */
 HourlyHeatmap.prototype.wrangleData = function() {
     var vis = this;
+    // pair each value with its day and hour, data is an array or a Float32Array (binary payload)
+    vis.displayData = Array.prototype.map.call(vis.data, function(value, i) {
+        return {day: vis.index.day[i], hour: vis.index.hour[i], value: value};
+    });
     // Update the visualization
     vis.updateVis();
 }
@@ -104,7 +109,7 @@ HourlyHeatmap.prototype.updateVis = function() {
     vis.colorScale.domain(d3.range(0, vis.maxSaturation, vis.maxSaturation/vis.buckets));
 
     vis.cards = vis.svg.selectAll(".hour")
-		.data(vis.data, function(d) {return d.day+':'+d.hour;});
+		.data(vis.displayData, function(d) {return d.day+':'+d.hour;});
 
 	vis.cards.append("title");
 
@@ -3,8 +3,12 @@ var colors = ["#ffffd9","#edf8b1","#c7e9b4","#7fcdbb","#41b6c4","#1d91c0","#225e
 var colors2 = ["#edf8b1","#c7e9b4","#7fcdbb","#41b6c4","#1d91c0","#225ea8","#081d58"]; 
 var colors3 = ["#7fcdbb","#225ea8"]; // alternatively colorbrewer.YlGnBu[9]
 var colors4 = ["#7fcdbb"]
+var PAYLOAD_VERSION = 2; // format of /initialize_data and /reload_data, see get_frontend_data() in utils.py
 var temporal_data;
+var temporal_index; // day and hour of each temporal value
 var geographical_data;
+var zipcodes; // zipcode of each geographical value
+var geometry_version;
 var clusters;
 
 // make chart names global
@@ -15,21 +19,142 @@ var geoPatternVis = null;
 var pathPrefix = "http://0.0.0.0:5000"
 if (window.location.href === (pathPrefix + "/")||window.location.href === (pathPrefix + "/dashboard" )) {
     queue()
-        .defer(d3.json, "/initialize_data")
+        .defer(load_payload, "/initialize_data")
         .await(createVis);
 }
 
+// Binary payload: float32 temporal and geographical patterns, see serialize_binary() in utils.py
+var BINARY_PAYLOAD_TYPE = "application/vnd.mbta.payload";
+var USE_BINARY_PAYLOAD = typeof TextDecoder !== "undefined" && typeof Float32Array !== "undefined";
+var LITTLE_ENDIAN = new Uint8Array(new Uint16Array([1]).buffer)[0] === 1;
+
+// Decode a binary payload into the json format, patterns are Float32Arrays instead of arrays
+function decode_binary_payload(buffer) {
+    var headerLength = new DataView(buffer).getUint32(0, true);
+    var data = JSON.parse(new TextDecoder("utf-8").decode(new Uint8Array(buffer, 4, headerLength)));
+    var start = 4 + headerLength;
+    Object.keys(data.blocks).forEach(function(name) {
+        var block = data.blocks[name];
+        var n = block.shape[0] * block.shape[1];
+        var values;
+        if (LITTLE_ENDIAN) {
+            values = new Float32Array(buffer, start + block.offset, n);
+        } else {
+            var view = new DataView(buffer, start + block.offset, 4 * n);
+            values = new Float32Array(n);
+            for (var i = 0; i < n; i++) { values[i] = view.getFloat32(4 * i, true); }
+        }
+        // one row per cluster, in the order of cluster_ids
+        data.cluster_ids.forEach(function(id, i) {
+            data.clusters[id][name] = values.subarray(i * block.shape[1], (i + 1) * block.shape[1]);
+        });
+    });
+    delete data.blocks;
+    delete data.cluster_ids;
+    return data;
+}
+
+// Return the json body of an error response answering a failed job, see _get_payload_response() in app.py,
+// null for other errors
+function get_failed_job_response(error) {
+    var xhr = error && error.target;
+    if (!xhr || (xhr.getResponseHeader("Content-Type") || "").indexOf("application/json") !== 0) { return null; }
+    try {
+        var data = JSON.parse(xhr.responseType === "arraybuffer"
+            ? new TextDecoder("utf-8").decode(new Uint8Array(xhr.response)) : xhr.responseText);
+        return data.job ? data : null;
+    } catch (e) {
+        return null;
+    }
+}
+
+// Load a payload of /initialize_data or /reload_data and call done(error, data) with the data in the json format,
+// or with the job of an uncached or failed request. The binary format is requested when the browser can decode
+// it, the server answers json otherwise
+function load_payload(url, done) {
+    if (!USE_BINARY_PAYLOAD) {
+        d3.json(url, function(error, data) {
+            var failed = get_failed_job_response(error);
+            if (failed) { done(null, failed); } else { done(error, data); }
+        });
+        return;
+    }
+    d3.request(url)
+        .header("Accept", BINARY_PAYLOAD_TYPE + ", application/json;q=0.9")
+        .responseType("arraybuffer")
+        .get(function(error, xhr) {
+            if (error) {
+                var failed = get_failed_job_response(error);
+                if (failed) { done(null, failed); } else { done(error); }
+                return;
+            }
+            var data;
+            try {
+                var type = xhr.getResponseHeader("Content-Type") || "";
+                data = type.indexOf(BINARY_PAYLOAD_TYPE) === 0 ? decode_binary_payload(xhr.response)
+                    : JSON.parse(new TextDecoder("utf-8").decode(new Uint8Array(xhr.response)));
+            } catch (e) {
+                done(e);
+                return;
+            }
+            done(null, data);
+        });
+}
+
+// Show the progress (or failure) of the job computing an uncached view, hide it with null
+function show_job_status(message, failed) {
+    $("#job-status").text(message || "")
+        .toggleClass("alert-info", !failed)
+        .toggleClass("alert-danger", !!failed)
+        .toggle(!!message);
+}
+
+// Poll the background job computing an uncached request, then call done
+var JOB_POLL_INTERVAL = 2000;
+function wait_for_job(response, done) {
+    var job = response.job;
+    if (job.status === "failed") {
+        // the server returns the failed job until its retry is due, requesting the view again later recomputes it
+        console.log("job " + job.id + " failed: " + job.error);
+        show_job_status("Could not compute this view: " + job.error + ". Please try again later.", true);
+        return;
+    }
+    console.log("computing " + job.key + ", stage: " + job.stage);
+    show_job_status("Computing this view (" + job.stage + " stage)...", false);
+    setTimeout(function() {
+        $.getJSON(response.status_url, function(job) {
+            if (job.status === "done") { done(); }
+            else { wait_for_job({job: job, status_url: response.status_url}, done); }
+        }).fail(function(xhr, text_status, error) {
+            console.log("could not get the status of job " + job.id + ": " + (error || text_status));
+            show_job_status("Lost track of the computation of this view. Please request it again.", true);
+        });
+    }, JOB_POLL_INTERVAL);
+}
+
 function createVis(error, jsonData) {
     if (error) { console.log(error); };
+    if (!error && jsonData.job) {
+        // the default view is not cached yet, load it once its job is done
+        wait_for_job(jsonData, function() {
+            queue().defer(load_payload, "/initialize_data").await(createVis);
+        });
+        return;
+    };
     if (!error) {
+        show_job_status(null);
         console.log("this is from initial view");
+        if (jsonData.version !== PAYLOAD_VERSION) { console.log("unexpected payload version " + jsonData.version); };
         // get the clusters into an array
-        clusters = Object.keys(jsonData).map(function(key) {return jsonData[key];});
+        clusters = Object.keys(jsonData.clusters).map(function(key) {return jsonData.clusters[key];});
         console.log("data:")
         console.log(clusters);
         // get different types of patterns
         temporal_data = clusters.map(function(d){return d.temporal_patterns;});
         geographical_data = clusters.map(function(d){return d.geographical_patterns;});
+        temporal_index = {day: jsonData.days, hour: jsonData.hours};
+        zipcodes = jsonData.zipcodes;
+        geometry_version = jsonData.geometry_version;
         usertype_data = clusters.map(function(d){return d.usertype;});
         tariff_data = clusters.map(function(d){return d.tariff;});
         servicebrand_data = clusters.map(function(d){return d.servicebrand;});
@@ -50,9 +175,9 @@ function createVis(error, jsonData) {
         clusterpcaVis = new ClusterPCAVis("pca-chart", viz_data, colors3);
         clusterstatVis = new ClusterSimpleStatVis("simple-stat-chart", "simple-stat-data-selection", clust_info_data, colors4);
         clusterReport = new ClusterReport("description-chart", "description-data-selection", report_data);
-        timePatternVis = new TemporalPatternChart("temporal-chart", temporal_data, ["Overview"], temporal_data.length, colors)
+        timePatternVis = new TemporalPatternChart("temporal-chart", temporal_data, ["Overview"], temporal_data.length, colors, temporal_index)
         timeLegend = new TemporalLegend("temporal-legend", temporal_data, colors);
-        geoPatternVis = new BostonMap("geographical-chart", geographical_data, 0, colors);
+        geoPatternVis = new BostonMap("geographical-chart", geographical_data, 0, colors, false, zipcodes, geometry_version);
         purchaseVis = new GroupDistributionChart("purchase-chart", "purchase_chart-selector", "purchase_view-selector",
                             [usertype_data, tariff_data, servicebrand_data], ["User Type", "Tariff Type", "Servicebrand"], 3, 0, colors2);
         basicDemographicsVis = new GroupDistributionChart("basic_demographics-chart", "basic_demographics_chart-selector",
@@ -1,7 +1,7 @@
 /*
  *  TemporalLegend - Object constructor function
  *  @param _parentElement   -- HTML element in which to draw the visualization
- *  @param _data            -- array of data
+ *  @param _data            -- array of hourly values per graph
  *  @param _colors          -- array of colors
  */
 
@@ -15,9 +15,7 @@ TemporalLegend = function(_parentElement, _data, _colors) {
     this.colors = _colors;
     this.buckets = _colors.length;
     this.maxSaturation = d3.max(this.data.map(function(d) {
-        return d3.max(d, function(e) {
-            return e.value;
-        });
+        return d3.max(d);
     }));
     this.duration = 1000;
 
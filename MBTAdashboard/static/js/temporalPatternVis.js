@@ -1,13 +1,13 @@
 /*
  *  TemporalPatternChart - Object constructor function
  *  @param _parentElement   -- HTML element in which to draw the visualization
- *  @param _data            -- array of data
+ *  @param _data            -- array of hourly values per graph
  *  @param _colors          -- array of colors
  *  @param _nGraph          -- number of graphs to compare
- *  @param _showLegend          -- whether to show legend
+ *  @param _index           -- day and hour of each value, {day: [...], hour: [...]}
  */
 
-TemporalPatternChart = function(_parentElement, _data, _titleList, _nGraph, _colors) {
+TemporalPatternChart = function(_parentElement, _data, _titleList, _nGraph, _colors, _index) {
     this.nGraph = _nGraph;
     this.titleList = _titleList;
     this.nGraphPerSlide = 6;
@@ -16,11 +16,10 @@ TemporalPatternChart = function(_parentElement, _data, _titleList, _nGraph, _col
     this.parentElement = _parentElement;
     this.data = _data;
     this.colors = _colors;
+    this.index = _index;
     this.duration = 1000;
     this.maxSaturation = d3.max(this.data.map(function(d) {
-        return d3.max(d, function(e) {
-            return e.value;
-        });
+        return d3.max(d);
     }));
     this.initVis();
 }
@@ -122,7 +121,7 @@ TemporalPatternChart.prototype.drawHeatmaps = function() {
     if (vis.nCarouselSlide === 0) {
         for (i = 0; i < vis.nGraphPerSlide; i++) {
             if (numDrawnGraph < vis.nGraph) {
-                var heatmapVis = new HourlyHeatmap("heatmap" + i + "_carousel" + 0, vis.data[numDrawnGraph], vis.titleList[numDrawnGraph], vis.colors, vis.maxSaturation);
+                var heatmapVis = new HourlyHeatmap("heatmap" + i + "_carousel" + 0, vis.data[numDrawnGraph], vis.titleList[numDrawnGraph], vis.colors, vis.maxSaturation, vis.index);
                 numDrawnGraph += 1;
             }
         }
@@ -130,7 +129,7 @@ TemporalPatternChart.prototype.drawHeatmaps = function() {
         for (j = 0; j < vis.nCarouselSlide; j++) {
             for (i = 0; i < vis.nGraphPerSlide; i++) {
                 if (numDrawnGraph < vis.nGraph) {
-                    var heatmapVis = new HourlyHeatmap("heatmap" + i + "_carousel" + j, vis.data[numDrawnGraph], vis.titleList[numDrawnGraph], vis.colors, vis.maxSaturation);
+                    var heatmapVis = new HourlyHeatmap("heatmap" + i + "_carousel" + j, vis.data[numDrawnGraph], vis.titleList[numDrawnGraph], vis.colors, vis.maxSaturation, vis.index);
                     numDrawnGraph += 1;
                 }
             }
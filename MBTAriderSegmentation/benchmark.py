@@ -0,0 +1,479 @@
+import numpy as np
+import os, sys
+import json
+import time
+import resource
+import platform
+import subprocess
+import argparse
+import tempfile
+from datetime import datetime
+
+from MBTAriderSegmentation.config import *
+
+# stage groups run in their own process, in this order, each one reads the cached outputs of the previous ones
+STAGE_GROUPS = ['features', 'segmentation', 'profile', 'frontend']
+
+# stages recorded by each stage group
+STAGES = {
+    'features': ['load', 'temporal_extraction', 'geographical_extraction', 'purchase_extraction',
+                 'labeling', 'features_total'],
+    'segmentation': ['standardize_normalize', 'kmeans_sweep', 'lda_sweep', 'segmentation_total'],
+    'profile': ['census', 'profile_summary', 'demographics', 'report', 'profile_total'],
+    'frontend': ['frontend_json']
+}
+
+# root of the repository, stage group processes run from here so both packages are importable
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# command of the stage group processes, the dashboard times its own stages so this package does not import it
+STAGE_GROUP_COMMANDS = {'frontend': [os.path.join(REPO_PATH, 'MBTAdashboard', 'src', 'benchmark.py')]}
+DEFAULT_STAGE_GROUP_COMMAND = ['-m', 'MBTAriderSegmentation.benchmark']
+
+
+###############################################
+# Stage measurement (runs in the stage group process)
+###############################################
+def _reset_peak_rss():
+    """
+    Function to reset the peak RSS of the current process, only supported on Linux.
+    Returns False if the peak cannot be reset, peak RSS is then the process peak so far.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def _get_peak_rss():
+    """
+    Function to get the peak RSS of the current process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024. / 1024.
+    return peak / 1024.
+
+def _get_cpu_time():
+    """
+    Function to get user + system CPU time of the current process and its terminated children
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class StageRecorder:
+    """
+    Class to record wall time, CPU time and peak RSS of pipeline stages.
+    A stage that runs several times (e.g. one KMeans sweep per configuration) is accumulated:
+    times are summed and peak RSS is the max over the calls.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.peak_rss_reset = True
+        self.open_stages = []
+
+    def stage(self, name):
+        return _StageContext(self, name)
+
+    def wrap(self, name, func):
+        """
+        DESCRIPTION:
+            Function to wrap a pipeline function so that each of its calls is recorded as a stage
+        INPUT:
+            name: A string of stage name, or a function of the call arguments returning the stage name, required
+            func: The function to wrap, required
+        RETURN:
+            wrapped: The wrapped function
+        """
+        def wrapped(*args, **kwargs):
+            stage_name = name(*args, **kwargs) if callable(name) else name
+            with self.stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def add(self, name, wall_time, cpu_time, peak_rss_mb):
+        if name not in self.stages:
+            self.stages[name] = {'wall_time': 0., 'cpu_time': 0., 'peak_rss_mb': 0., 'calls': 0}
+        record = self.stages[name]
+        record['wall_time'] += wall_time
+        record['cpu_time'] += cpu_time
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss_mb)
+        record['calls'] += 1
+
+
+class _StageContext:
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.inner_peak_rss = 0.
+
+    def __enter__(self):
+        self.recorder.peak_rss_reset &= _reset_peak_rss()
+        self.recorder.open_stages.append(self)
+        self.wall_t0 = time.perf_counter()
+        self.cpu_t0 = _get_cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall_time = time.perf_counter() - self.wall_t0
+        cpu_time = _get_cpu_time() - self.cpu_t0
+        peak_rss = max(_get_peak_rss(), self.inner_peak_rss)
+        self.recorder.open_stages.pop()
+        # nested stages reset the peak, pass their peak on to the enclosing stage
+        if self.recorder.open_stages:
+            outer = self.recorder.open_stages[-1]
+            outer.inner_peak_rss = max(outer.inner_peak_rss, peak_rss)
+        self.recorder.add(self.name, wall_time, cpu_time, peak_rss)
+        return False
+
+
+###############################################
+# Stage groups (run in the stage group process, with MBTA_DATA_PATH set to the synthetic data root)
+###############################################
+def _run_features(recorder, start_month, duration):
+    from MBTAriderSegmentation.features import FeatureExtractor
+
+    with recorder.stage('features_total'):
+        with recorder.stage('load'):
+            extractor = FeatureExtractor(start_month=start_month, duration=duration)
+        extractor._extract_temporal_patterns = recorder.wrap('temporal_extraction', extractor._extract_temporal_patterns)
+        extractor._extract_geographical_patterns = recorder.wrap('geographical_extraction',
+                                                                 extractor._extract_geographical_patterns)
+        extractor._extract_ticket_purchasing_patterns = recorder.wrap('purchase_extraction',
+                                                                      extractor._extract_ticket_purchasing_patterns)
+        extractor._label_riders = recorder.wrap('labeling', extractor._label_riders)
+        extractor.extract_features()
+
+def _run_segmentation(recorder, start_month, duration):
+    import MBTAriderSegmentation.segmentation as segmentation
+
+    # final segmentation of each configuration is recorded as a sweep of its algorithm,
+    # configurations run one at a time so that sweeps run in this process
+    segmentation._final_rider_segmentation = recorder.wrap(lambda *args, **kwargs: args[4] + '_sweep',
+                                                           segmentation._final_rider_segmentation)
+    with recorder.stage('segmentation_total'):
+        with recorder.stage('standardize_normalize'):
+            seg = segmentation.Segmentation(start_month=start_month, duration=duration)
+        seg.get_rider_segmentation_sweep(hierarchical_list=[True, False], w_time_list=[None],
+                                         algorithms=ALGORITHMS, n_jobs=1)
+
+def _run_profile(recorder, start_month, duration):
+    import MBTAriderSegmentation.profile as profile
+
+    profile.ReportGenerator.generate_report = recorder.wrap('report', profile.ReportGenerator.generate_report)
+    with recorder.stage('profile_total'):
+        # census is loaded once per process and shared by the profilers
+        with recorder.stage('census'):
+            profile.CensusFormatter(DATA_PATH + INPUT_PATH + 'census/MA_census.xlsx').get_census_in_counts()
+        profiler = profile.ClusterProfiler(hierarchical=True, start_month=start_month, duration=duration)
+        profiler._aggregate_features = recorder.wrap('profile_summary', profiler._aggregate_features)
+        profiler._aggregate_features_chunked = recorder.wrap('profile_summary', profiler._aggregate_features_chunked)
+        profiler._summarize_feature_sums = recorder.wrap('profile_summary', profiler._summarize_feature_sums)
+        profiler._summarize_demographics = recorder.wrap('demographics', profiler._summarize_demographics)
+        profiler.extract_profiles(algorithms=ALGORITHMS, views=PROFILE_VIEWS)
+
+# stage groups of the pipeline, the frontend stages are run by MBTAdashboard/src/benchmark.py
+STAGE_GROUP_FUNCTIONS = {
+    'features': _run_features,
+    'segmentation': _run_segmentation,
+    'profile': _run_profile
+}
+
+def run_stage_group(group, start_month, duration, stage_group_functions=STAGE_GROUP_FUNCTIONS):
+    """
+    DESCRIPTION:
+        Function to run one stage group in the current process and record its stages.
+        DATA_PATH must already point to the benchmark data root (set MBTA_DATA_PATH before importing).
+    INPUT:
+        group: A string of stage group, one of stage_group_functions, required
+        start_month: A string of start month in yymm format, required
+        duration: An integer of number of months, required
+        stage_group_functions: A dictionary of the function of each stage group, taking a StageRecorder,
+            start_month and duration
+    RETURN:
+        result: A dictionary with the stage records and whether peak RSS was measured per stage
+    """
+    recorder = StageRecorder()
+    stage_group_functions[group](recorder, start_month, duration)
+    return {'stages': recorder.stages, 'peak_rss_reset': recorder.peak_rss_reset}
+
+def run_stage_group_process(stage_group_functions=STAGE_GROUP_FUNCTIONS):
+    """
+    Function to run the stage group given on the command line and write its result, the entry point of the
+    stage group processes started by PipelineBenchmark
+    """
+    parser = argparse.ArgumentParser(description='Run one benchmark stage group')
+    parser.add_argument('group', choices=list(stage_group_functions))
+    parser.add_argument('--start_month', default='1710')
+    parser.add_argument('--duration', type=int, default=1)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    result = run_stage_group(args.group, args.start_month, args.duration, stage_group_functions)
+    with open(args.output, 'w') as f:
+        json.dump(result, f)
+
+
+###############################################
+# Benchmark suite (runs in the driver process)
+###############################################
+class PipelineBenchmark:
+    """
+    Class to benchmark the pipeline end to end at several synthetic data scales.
+    For each scale a synthetic data root is generated (and reused in later runs), and each stage group
+    runs in a fresh process with MBTA_DATA_PATH pointing to that root, so peak RSS of one stage group
+    is not inflated by the previous ones.
+
+    Results are a list of records (one per scale and stage) with wall time, CPU time and peak RSS,
+    saved as json together with the machine and parameters they were measured with.
+    """
+    def __init__(self, output_path, scales=BENCHMARK_SCALES, trips_per_rider=BENCHMARK_TRIPS_PER_RIDER,
+                 start_month='1710', duration=1, stage_groups=STAGE_GROUPS, seed=RANDOM_STATE):
+        self.output_path = os.path.join(output_path, '')
+        self.scales = scales
+        self.trips_per_rider = trips_per_rider
+        self.start_month = start_month
+        self.duration = duration
+        self.stage_groups = stage_groups
+        self.seed = seed
+        self.results = []
+
+    def __get_data_path(self, n_riders):
+        return self.output_path + 'data_' + str(n_riders) + '_' + str(self.trips_per_rider) + '/'
+
+    def __generate_data(self, n_riders):
+        from MBTAriderSegmentation.synthetic import SyntheticDataGenerator
+
+        data_path = self.__get_data_path(n_riders)
+        months = [str(int(self.start_month) + dt) for dt in range(self.duration)]
+        generator = SyntheticDataGenerator(output_path=data_path, n_riders=n_riders,
+                                           trips_per_rider=self.trips_per_rider, seed=self.seed)
+        generator.generate_lookups()
+        n_transactions = 0
+        for month in months:
+            filename = data_path + INPUT_PATH + 'afc_odx/afc_odx_' + month + '.csv'
+            if os.path.exists(filename):  # data of this scale was generated in a previous run
+                with open(filename, 'r') as f:
+                    n_transactions += sum(1 for _ in f) - 1
+            else:
+                n_transactions += generator.generate_month(month)
+        return data_path, n_transactions
+
+    def __clear_cache(self, data_path):
+        # remove cached outputs of the stage groups that run, so that they recompute instead of reading them
+        paths = []
+        if 'features' in self.stage_groups:
+            paths.append(FEATURE_PATH)
+        if 'segmentation' in self.stage_groups:
+            paths += [CLUSTER_PATH + 'hierarchical/results/', CLUSTER_PATH + 'non_hierarchical/results/']
+        for path in paths:
+            for filename in os.listdir(data_path + path):
+                os.remove(data_path + path + filename)
+
+    def __run_stage_group(self, group, data_path):
+        env = dict(os.environ, MBTA_DATA_PATH=data_path)
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_filename = f.name
+        try:
+            command = STAGE_GROUP_COMMANDS.get(group, DEFAULT_STAGE_GROUP_COMMAND)
+            subprocess.check_call([sys.executable] + command + [group, '--start_month', self.start_month,
+                                                                '--duration', str(self.duration),
+                                                                '--output', result_filename], env=env, cwd=REPO_PATH)
+            with open(result_filename, 'r') as f:
+                return json.load(f)
+        finally:
+            os.remove(result_filename)
+
+    def run(self):
+        """
+        DESCRIPTION:
+            Function to run every stage group at every scale
+        INPUT:
+            None
+        RETURN:
+            results: A list of dictionaries, one per scale and stage, with n_riders, n_transactions,
+                group, stage, wall_time, cpu_time, peak_rss_mb, calls and peak_rss_reset
+        """
+        self.results = []
+        for n_riders in self.scales:
+            print("generating synthetic data with {} riders...".format(n_riders))
+            data_path, n_transactions = self.__generate_data(n_riders)
+            self.__clear_cache(data_path)
+            for group in self.stage_groups:
+                print("[{} riders] running {} stages...".format(n_riders, group))
+                result = self.__run_stage_group(group, data_path)
+                for stage in STAGES[group]:
+                    if stage not in result['stages']:
+                        continue
+                    record = {'n_riders': n_riders, 'n_transactions': n_transactions,
+                              'group': group, 'stage': stage, 'peak_rss_reset': result['peak_rss_reset']}
+                    record.update(result['stages'][stage])
+                    self.results.append(record)
+                    print("[{} riders] {:<24s} wall {:9.2f}s  cpu {:9.2f}s  peak rss {:9.1f}MB".format(
+                        n_riders, stage, record['wall_time'], record['cpu_time'], record['peak_rss_mb']))
+        return self.results
+
+    def save(self, filename):
+        """
+        DESCRIPTION:
+            Function to save results as json, together with the parameters and machine they were measured with
+        INPUT:
+            filename: A string of json filename, required
+        RETURN:
+            None
+        """
+        output = {
+            'created': datetime.now().isoformat(),
+            'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                        'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+            'params': {'scales': self.scales, 'trips_per_rider': self.trips_per_rider,
+                       'start_month': self.start_month, 'duration': self.duration, 'seed': self.seed},
+            'results': self.results
+        }
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    def get_scaling_curves(self, metric='wall_time'):
+        """
+        DESCRIPTION:
+            Function to get, for each stage, the metric at every scale and the fitted scaling exponent
+            (slope of log(metric) vs log(n_transactions), 1 means linear scaling)
+        INPUT:
+            metric: A string, one of wall_time, cpu_time, peak_rss_mb
+        RETURN:
+            curves: A dictionary keyed by stage with 'n_transactions', metric values and 'exponent'
+        """
+        return get_scaling_curves(self.results, metric=metric)
+
+
+def get_scaling_curves(results, metric='wall_time'):
+    """
+    DESCRIPTION:
+        Function to get, for each stage in results, the metric at every scale and the fitted scaling exponent
+    INPUT:
+        results: A list of result records, see PipelineBenchmark.run(), required
+        metric: A string, one of wall_time, cpu_time, peak_rss_mb
+    RETURN:
+        curves: A dictionary keyed by stage with 'n_transactions', metric values and 'exponent'
+            (None if there are less than 2 scales)
+    """
+    curves = {}
+    for record in results:
+        curve = curves.setdefault(record['stage'], {'n_transactions': [], metric: []})
+        curve['n_transactions'].append(record['n_transactions'])
+        curve[metric].append(record[metric])
+    for stage, curve in curves.items():
+        x = np.log(np.array(curve['n_transactions'], dtype=float))
+        y = np.log(np.maximum(np.array(curve[metric], dtype=float), 1e-6))
+        if len(np.unique(x)) > 1:
+            curve['exponent'] = float(np.polyfit(x, y, 1)[0])
+        else:
+            curve['exponent'] = None
+    return curves
+
+def load_results(filename):
+    """
+    Function to load results saved by PipelineBenchmark.save()
+    """
+    with open(filename, 'r') as f:
+        return json.load(f)['results']
+
+def compare_to_baseline(results, baseline, threshold=BENCHMARK_THRESHOLD, min_time=BENCHMARK_MIN_TIME,
+                        metrics=['wall_time', 'peak_rss_mb']):
+    """
+    DESCRIPTION:
+        Function to compare results against baseline results of the same stages and scales
+    INPUT:
+        results: A list of result records, see PipelineBenchmark.run(), required
+        baseline: A list of baseline result records, e.g. load_results(baseline_filename), required
+        threshold: A float, relative increase over baseline that counts as a regression
+        min_time: A float, stages whose baseline time is below min_time seconds are not compared
+        metrics: A list of metrics to compare
+    RETURN:
+        regressions: A list of dictionaries with n_riders, stage, metric, baseline, current and change
+            (relative change vs baseline) of every regression, empty if there is none
+    """
+    baseline_by_key = dict(((record['n_riders'], record['stage']), record) for record in baseline)
+    regressions = []
+    for record in results:
+        key = (record['n_riders'], record['stage'])
+        if key not in baseline_by_key:
+            continue
+        base = baseline_by_key[key]
+        if base['wall_time'] < min_time:
+            continue
+        for metric in metrics:
+            if base[metric] <= 0:
+                continue
+            change = record[metric] / base[metric] - 1
+            if change > threshold:
+                regressions.append({'n_riders': record['n_riders'], 'stage': record['stage'], 'metric': metric,
+                                    'baseline': base[metric], 'current': record[metric], 'change': change})
+    return regressions
+
+
+###############################################
+# Import time budget
+###############################################
+# run in a fresh interpreter, prints the import time and the top level packages loaded by the import
+_IMPORT_TIMER = """
+import sys, time, json
+start = time.perf_counter()
+__import__(sys.argv[1])
+import_time = time.perf_counter() - start
+print(json.dumps({'import_time': import_time, 'packages': sorted(set(name.split('.')[0] for name in sys.modules))}))
+"""
+
+def measure_import_time(module, repeat=3):
+    """
+    DESCRIPTION:
+        Function to measure the import time of a module, each import runs in a fresh interpreter
+        so that nothing is already loaded
+    INPUT:
+        module: A string, dotted module name importable from the repository root, required
+        repeat: An integer, number of imports, the fastest one is reported
+    RETURN:
+        import_time: A float, import time in seconds
+        deferred: A list of DEFERRED_IMPORTS loaded by the import
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO_PATH] + [p for p in [env.get('PYTHONPATH')] if p])
+    import_time = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_TIMER, module], cwd=REPO_PATH, env=env)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        if import_time is None or result['import_time'] < import_time:
+            import_time = result['import_time']
+    deferred = [package for package in DEFERRED_IMPORTS if package in result['packages']]
+    return import_time, deferred
+
+def check_import_budget(modules=IMPORT_BUDGET_MODULES, budget=IMPORT_TIME_BUDGET, repeat=3):
+    """
+    DESCRIPTION:
+        Function to check that each module imports within the time budget without loading
+        any of the heavy dependencies in DEFERRED_IMPORTS
+    INPUT:
+        modules: A list of dotted module names
+        budget: A float, maximum import time in seconds
+        repeat: An integer, number of imports per module, the fastest one is compared to the budget
+    RETURN:
+        records: A list of dictionaries with module, import_time, deferred (heavy dependencies loaded)
+            and passed for every module
+    """
+    records = []
+    for module in modules:
+        import_time, deferred = measure_import_time(module, repeat=repeat)
+        records.append({'module': module, 'import_time': import_time, 'deferred': deferred,
+                        'passed': import_time <= budget and not deferred})
+    return records
+
+
+if __name__ == '__main__':
+    # entry point of the stage group processes started by PipelineBenchmark
+    run_stage_group_process()
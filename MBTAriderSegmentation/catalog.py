@@ -0,0 +1,544 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from MBTAriderSegmentation.config import *
+
+# parameters that identify an artifact of each kind, in key order
+ARTIFACT_PARAMS = {
+    'features': ['month', 'duration'],
+    'clusters': ['view', 'month', 'duration', 'w_time'],
+    'profiles': ['view', 'month', 'duration', 'w_time', 'algorithm'],
+    'viz': ['view', 'month', 'duration', 'w_time', 'algorithm', 'cluster']
+}
+
+# format of the manifest, 2 since fingerprints hash the file content rather than its path and modification time
+MANIFEST_VERSION = 2
+
+# file name patterns of each kind, used once to adopt artifacts that were cached before the manifest existed
+_VIEW_PATTERN = '(?P<view>overview|hierarchical|non-hierarchical)'
+_FILENAME_PATTERNS = {
+    'features': re.compile('^' + re.escape(FEATURE_FILE_PREFIX) + r'(?P<month>\d{4})_(?P<duration>\d+)\.csv$'),
+    'clusters': re.compile('^' + re.escape(CLUSTER_FILE_PREFIX) +
+                           r'(?P<month>\d{4})_(?P<duration>\d+)_(?P<w_time>[^_]+)\.npz$'),
+    'profiles': re.compile('^' + _VIEW_PATTERN + '_' + re.escape(PROFILE_FILE_PREFIX) +
+                           r'(?P<month>\d{4})_(?P<duration>\d+)(_(?P<w_time>[^_]+)_(?P<algorithm>[^_]+))?\.csv$'),
+    'viz': re.compile('^GEO-chart_' + _VIEW_PATTERN +
+                      r'_(?P<month>\d{4})_(?P<duration>\d+)_(?P<w_time>[^_]+)_(?P<algorithm>[^_]+)_cluster(?P<cluster>.+)\.html$')
+}
+
+def get_period_path(start_month, duration):
+    """
+    Function to get the subdirectory of profiles and visualizations of a period, e.g. 2017-Oct/ or 2017-Oct_to_2017-Dec/
+    """
+    start = datetime.strptime(start_month, "%y%m").strftime("%Y-%b")
+    if int(duration) > 1:
+        end = datetime.strptime(str(int(start_month) + int(duration) - 1), "%y%m").strftime("%Y-%b")
+        return start + '_to_' + end + '/'
+    return start + '/'
+
+# fingerprints of the files seen by this process, by path, size and modification time
+_fingerprints = {}
+
+def get_fingerprint(filename, sample_bytes=FINGERPRINT_SAMPLE_BYTES):
+    """
+    DESCRIPTION:
+        Function to get a hash of the size and content of a file, None if it does not exist. Files larger
+        than three samples are hashed at their start, middle and end only. The hash does not depend on
+        where the file is or when it was modified, so a copied or moved data root keeps its fingerprints,
+        and it is computed again only when the size or modification time of the file changes.
+    INPUT:
+        filename: A string, required
+        sample_bytes: An integer, bytes of each sample
+    RETURN:
+        fingerprint: A string of 16 hex digits, None if the file does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, sample_bytes)
+    fingerprint = _fingerprints.get(key)
+    if fingerprint is None:
+        digest = hashlib.sha1(str(stat.st_size).encode())
+        try:
+            with open(filename, 'rb') as f:
+                if stat.st_size <= 3 * sample_bytes:
+                    digest.update(f.read())
+                else:
+                    for offset in [0, (stat.st_size - sample_bytes) // 2, stat.st_size - sample_bytes]:
+                        f.seek(offset)
+                        digest.update(f.read(sample_bytes))
+        except (IOError, OSError):
+            return None
+        fingerprint = _fingerprints[key] = digest.hexdigest()[:16]
+    return fingerprint
+
+@contextmanager
+def atomic_write(filename):
+    """
+    DESCRIPTION:
+        Context manager to write a file through a temporary file in the same directory, renamed to
+        filename when the block completes, so that a partially written file is never visible.
+        The temporary file keeps the extension of filename and is removed if the block raises.
+    INPUT:
+        filename: A string of the file to write, required
+    RETURN:
+        temp_filename: A string of the file to write to inside the block
+    """
+    dirname, basename = os.path.split(filename)
+    stem, ext = os.path.splitext(basename)
+    temp_filename = os.path.join(dirname, '.{}.{}-{}.tmp{}'.format(stem, os.getpid(), threading.get_ident(), ext))
+    try:
+        yield temp_filename
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+@contextmanager
+def file_lock(filename, timeout=LOCK_TIMEOUT):
+    """
+    DESCRIPTION:
+        Context manager to hold an exclusive lock on a lock file, shared between processes and threads.
+        The lock is released when the block exits or the process dies.
+    INPUT:
+        filename: A string of the lock file, created if needed, required
+        timeout: A float, seconds to wait for the lock, None to wait until it is released
+    RETURN:
+        None
+    """
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    f = open(filename, 'a')
+    try:
+        if timeout is None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() > deadline:
+                        raise TimeoutError('Timed out after {}s waiting for {}'.format(timeout, filename))
+                    time.sleep(LOCK_POLL_INTERVAL)
+        yield
+    finally:
+        f.close()
+
+
+class ArtifactCatalog:
+    """
+    Class to keep a manifest of the cached features, cluster labels, profiles and visualizations
+    under a data root. Each artifact is indexed by its kind and parameters and records its path,
+    size, creation time and the fingerprints of the files it was computed from, so lookups do not
+    scan directories and artifacts whose inputs changed can be found and removed.
+
+    The manifest (CATALOG_FILE in the data root) is built from the cached files the first time it is
+    needed, artifacts are registered by the stage that writes them, and a requested artifact that exists
+    on disk without being registered is adopted on lookup.
+
+    find_or_compute() computes a missing artifact once: the first requester computes it while holding
+    the artifact's lock (in LOCK_PATH), concurrent requesters in any process wait for the lock and reuse
+    the result. Updates of the manifest are serialized by a lock as well.
+    """
+    def __init__(self, data_path=DATA_PATH):
+        self.data_path = data_path
+        self.manifest_filename = data_path + CATALOG_FILE
+        self.artifacts = {}
+        self.manifest_mtime = None
+        if os.path.isfile(self.manifest_filename):
+            self.__load()
+        else:
+            self.rebuild()
+
+    def __lock_manifest(self):
+        return file_lock(self.data_path + LOCK_PATH + 'catalog.lock', timeout=None)
+
+    def lock(self, kind, timeout=LOCK_TIMEOUT, **params):
+        """
+        Function to get the lock of an artifact (see file_lock()), held while the artifact is computed
+        """
+        return file_lock(self.data_path + LOCK_PATH + self.get_key(kind, **params).replace('/', '_') + '.lock',
+                         timeout=timeout)
+
+    ###############################################
+    # Naming
+    ###############################################
+    def __get_params(self, kind, params):
+        """
+        Function to format the parameters of an artifact, e.g. w_time=None and w_time='0' are the same artifact
+        """
+        if kind not in ARTIFACT_PARAMS:
+            raise ValueError('kind must be one of {}'.format(list(ARTIFACT_PARAMS)))
+        unknown = set(params) - set(ARTIFACT_PARAMS[kind])
+        if unknown:
+            raise ValueError('Unknown {} parameters {}'.format(kind, sorted(unknown)))
+        formatted = {}
+        for name in ARTIFACT_PARAMS[kind]:
+            value = params.get(name)
+            if name == 'view' and value is not None and value not in PROFILE_VIEWS:
+                raise ValueError('view must be one of {}'.format(PROFILE_VIEWS))
+            if name in ['w_time', 'algorithm'] and params.get('view') == 'overview':
+                value = None  # the overview does not depend on the clustering
+            elif name == 'w_time':
+                value = str(value) if value and value != 'na' else '0'
+            elif name == 'duration':
+                value = str(int(value))
+            elif value is None:
+                raise ValueError('Missing {} parameter {}'.format(kind, name))
+            else:
+                value = str(value)
+            formatted[name] = value
+        return formatted
+
+    def get_key(self, kind, **params):
+        """
+        Function to get the manifest key of an artifact, e.g. profiles/hierarchical/1710/1/0/kmeans
+        """
+        params = self.__get_params(kind, params)
+        return '/'.join([kind] + [params[name] for name in ARTIFACT_PARAMS[kind] if params[name] is not None])
+
+    def __get_relative_filename(self, kind, params):
+        month, duration = params['month'], params['duration']
+        if kind == 'features':
+            return FEATURE_PATH + FEATURE_FILE_PREFIX + month + '_' + duration + '.csv'
+        if kind == 'clusters':
+            subdir = 'hierarchical/' if params['view'] == 'hierarchical' else 'non_hierarchical/'
+            return (CLUSTER_PATH + subdir + 'results/' + CLUSTER_FILE_PREFIX +
+                    month + '_' + duration + '_' + params['w_time'] + '.npz')
+        if kind == 'profiles':
+            filename = params['view'] + '_' + PROFILE_FILE_PREFIX + month + '_' + duration
+            if params['view'] != 'overview':
+                filename += '_' + params['w_time'] + '_' + params['algorithm']
+            return PROFILE_PATH + get_period_path(month, duration) + filename + '.csv'
+        # viz, the overview has no weight or algorithm
+        w_time = params['w_time'] or 'na'
+        algorithm = params['algorithm'] or 'na'
+        filename = ('GEO-chart_' + params['view'] + '_' + month + '_' + duration + '_' + w_time + '_' +
+                    algorithm + '_cluster' + params['cluster'] + '.html')
+        return VIZ_PATH + get_period_path(month, duration) + filename
+
+    def __get_sidecars(self, kind, relative_filename):
+        """
+        Function to get the files derived from an artifact, removed together with it
+        """
+        stem = os.path.splitext(relative_filename)[0]
+        if kind == 'features':
+            return [stem + '.pkl']  # binary copy, see load_rider_features()
+        if kind == 'clusters':
+            return [stem.replace('/results/', '/scores/') + '.json']
+        return []
+
+    def __get_inputs(self, kind, params):
+        """
+        Function to get the files an artifact is computed from, relative to the data root
+        """
+        month, duration = params['month'], params['duration']
+        if kind == 'features':
+            inputs = [INPUT_PATH + 'afc_odx/afc_odx_' + str(int(month) + dt) + '.csv' for dt in range(int(duration))]
+            return inputs + [INPUT_PATH + 'fareprod/fareprod_ttj.csv', INPUT_PATH + 'stops/stops_withzip.csv']
+        features = self.__get_relative_filename('features', {'month': month, 'duration': duration})
+        if kind == 'clusters':
+            return [features]
+        if kind == 'profiles':
+            inputs = [features, INPUT_PATH + 'census/MA_census.xlsx']
+            if params['view'] != 'overview':
+                clusters_params = dict((name, params[name]) for name in ARTIFACT_PARAMS['clusters'])
+                inputs.append(self.__get_relative_filename('clusters', clusters_params))
+            return inputs
+        profiles_params = dict((name, params[name]) for name in ARTIFACT_PARAMS['profiles'])
+        return [self.__get_relative_filename('profiles', profiles_params)]
+
+    def get_filename(self, kind, **params):
+        """
+        DESCRIPTION:
+            Function to get the file an artifact is (or will be) saved to, its directory is created if needed
+        INPUT:
+            kind: A string, one of ARTIFACT_PARAMS, required
+            params: The parameters of the artifact, see ARTIFACT_PARAMS
+        RETURN:
+            filename: A string of the absolute file name
+        """
+        filename = self.data_path + self.__get_relative_filename(kind, self.__get_params(kind, params))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        return filename
+
+    def get_sidecar_filenames(self, kind, **params):
+        """
+        Function to get the files derived from an artifact (e.g. cluster scores), their directories are created if needed
+        """
+        relative_filename = self.__get_relative_filename(kind, self.__get_params(kind, params))
+        filenames = [self.data_path + sidecar for sidecar in self.__get_sidecars(kind, relative_filename)]
+        for filename in filenames:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+        return filenames
+
+    ###############################################
+    # Manifest
+    ###############################################
+    def __load(self):
+        with open(self.manifest_filename, 'r') as f:
+            manifest = json.load(f)
+        self.artifacts = manifest['artifacts']
+        self.manifest_mtime = os.stat(self.manifest_filename).st_mtime_ns
+        if manifest.get('version', 1) < MANIFEST_VERSION:
+            self.__upgrade()
+
+    def __upgrade(self):
+        """
+        Function to record the fingerprints of a manifest written by an older version again, its entries
+        are kept rather than compared with fingerprints computed differently. Written with the next update.
+        """
+        for entry in self.artifacts.values():
+            entry['fingerprint'] = get_fingerprint(self.data_path + entry['path'])
+            entry['inputs'] = dict((input_filename, get_fingerprint(self.data_path + input_filename))
+                                   for input_filename in entry['inputs'])
+
+    def __reload_if_changed(self):
+        """
+        Function to pick up artifacts registered by other processes since the manifest was read
+        """
+        try:
+            mtime = os.stat(self.manifest_filename).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self.manifest_mtime:
+            self.__load()
+
+    def __save(self):
+        # readers never see a partial manifest, writers hold the manifest lock
+        with atomic_write(self.manifest_filename) as temp_filename:
+            with open(temp_filename, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'artifacts': self.artifacts}, f, indent=1, sort_keys=True)
+        self.manifest_mtime = os.stat(self.manifest_filename).st_mtime_ns
+
+    def __update(self, key, entry):
+        """
+        Function to add (or with entry None, drop) a manifest entry on top of the latest manifest
+        """
+        with self.__lock_manifest():
+            self.__reload_if_changed()
+            if entry is not None:
+                self.artifacts[key] = entry
+            else:
+                self.artifacts.pop(key, None)
+            self.__save()
+
+    def __get_entry(self, kind, params, relative_filename):
+        filename = self.data_path + relative_filename
+        return {
+            'kind': kind,
+            'params': params,
+            'path': relative_filename,
+            'sidecars': self.__get_sidecars(kind, relative_filename),
+            'size': os.path.getsize(filename),
+            'created': os.path.getmtime(filename),
+            'fingerprint': get_fingerprint(filename),
+            'inputs': dict((input_filename, get_fingerprint(self.data_path + input_filename))
+                           for input_filename in self.__get_inputs(kind, params))
+        }
+
+    def register(self, kind, **params):
+        """
+        DESCRIPTION:
+            Function to add or update an artifact after it was written to get_filename(kind, **params)
+        INPUT:
+            kind: A string, one of ARTIFACT_PARAMS, required
+            params: The parameters of the artifact, see ARTIFACT_PARAMS
+        RETURN:
+            entry: A dictionary of the artifact's kind, params, path, sidecars, size, created, fingerprint and inputs
+        """
+        params = self.__get_params(kind, params)
+        entry = self.__get_entry(kind, params, self.__get_relative_filename(kind, params))
+        self.__update(self.get_key(kind, **params), entry)
+        return entry
+
+    def rebuild(self):
+        """
+        Function to rebuild the manifest from the cached files under the data root. Artifacts already in the
+        manifest keep the fingerprints of the inputs they were computed from, so stale ones are still found.
+        """
+        with self.__lock_manifest():
+            self.__rebuild()
+
+    def __rebuild(self):
+        self.__reload_if_changed()
+        previous = self.artifacts
+        self.artifacts = {}
+        for kind, subdir in [('features', FEATURE_PATH), ('clusters', CLUSTER_PATH),
+                             ('profiles', PROFILE_PATH), ('viz', VIZ_PATH)]:
+            for dirpath, _, filenames in os.walk(self.data_path + subdir):
+                for filename in filenames:
+                    match = _FILENAME_PATTERNS[kind].match(filename)
+                    if match is None:
+                        continue
+                    params = dict((name, value) for name, value in match.groupdict().items() if value is not None)
+                    if kind == 'clusters':
+                        params['view'] = 'non-hierarchical' if 'non_hierarchical' in dirpath else 'hierarchical'
+                    params = self.__get_params(kind, params)
+                    relative_filename = self.__get_relative_filename(kind, params)
+                    # skip files that are not where the pipeline would write them
+                    if os.path.abspath(self.data_path + relative_filename) != os.path.abspath(os.path.join(dirpath, filename)):
+                        continue
+                    key = self.get_key(kind, **params)
+                    entry = self.__get_entry(kind, params, relative_filename)
+                    # the current fingerprints of the inputs only describe artifacts written since they were recorded
+                    if key in previous and previous[key]['fingerprint'] == entry['fingerprint']:
+                        entry['inputs'] = previous[key]['inputs']
+                    self.artifacts[key] = entry
+        if not os.path.isdir(self.data_path):
+            os.makedirs(self.data_path)
+        self.__save()
+
+    ###############################################
+    # Lookup
+    ###############################################
+    def find(self, kind, **params):
+        """
+        DESCRIPTION:
+            Function to look up a cached artifact
+        INPUT:
+            kind: A string, one of ARTIFACT_PARAMS, required
+            params: The parameters of the artifact, see ARTIFACT_PARAMS
+        RETURN:
+            filename: A string of the absolute file name, None if the artifact is not cached
+        """
+        key = self.get_key(kind, **params)
+        entry = self.artifacts.get(key)
+        if entry is None:
+            self.__reload_if_changed()
+            entry = self.artifacts.get(key)
+        if entry is not None and os.path.isfile(self.data_path + entry['path']):
+            return self.data_path + entry['path']
+
+        # not registered (or removed from disk), adopt the file if it was written without registering it
+        filename = self.data_path + self.__get_relative_filename(kind, self.__get_params(kind, params))
+        if os.path.isfile(filename):
+            self.register(kind, **params)
+            return filename
+        if entry is not None:
+            self.__update(key, None)
+        return None
+
+    def find_or_compute(self, kind, compute, timeout=LOCK_TIMEOUT, **params):
+        """
+        DESCRIPTION:
+            Function to look up a cached artifact, computing it if it is not cached. Only one requester
+            computes a missing artifact, the others wait for it and reuse the result.
+        INPUT:
+            kind: A string, one of ARTIFACT_PARAMS, required
+            compute: A function without arguments that writes and registers the artifact, required
+            timeout: A float, seconds to wait for another requester computing the artifact, None to wait until done
+            params: The parameters of the artifact, see ARTIFACT_PARAMS
+        RETURN:
+            filename: A string of the absolute file name
+        """
+        filename = self.find(kind, **params)
+        if filename is not None:
+            return filename
+        with self.lock(kind, timeout=timeout, **params):
+            # another requester may have computed it while this one waited for the lock
+            filename = self.find(kind, **params)
+            if filename is None:
+                compute()
+                filename = self.find(kind, **params)
+        if filename is None:
+            raise FileNotFoundError('{} was not written by {}'.format(self.get_key(kind, **params), compute))
+        return filename
+
+    def list_artifacts(self, kind=None, **params):
+        """
+        DESCRIPTION:
+            Function to list the registered artifacts, optionally of one kind and with the given parameter values
+        INPUT:
+            kind: A string, one of ARTIFACT_PARAMS, None for all kinds
+            params: Parameter values to filter on, e.g. month='1710'
+        RETURN:
+            entries: A list of artifact dictionaries (see register()) sorted by key
+        """
+        self.__reload_if_changed()
+        entries = []
+        for key in sorted(self.artifacts):
+            entry = self.artifacts[key]
+            if kind is not None and entry['kind'] != kind:
+                continue
+            if any(entry['params'].get(name) != str(value) for name, value in params.items()):
+                continue
+            entries.append(entry)
+        return entries
+
+    def is_stale(self, entry):
+        """
+        Function to check if any of the files an artifact was computed from changed or was removed since
+        """
+        return any(get_fingerprint(self.data_path + input_filename) != fingerprint
+                   for input_filename, fingerprint in entry['inputs'].items())
+
+    def collect_garbage(self, dry_run=False):
+        """
+        DESCRIPTION:
+            Function to remove stale artifacts (see is_stale()) with their sidecar files and drop them from the manifest.
+            Artifacts computed from a removed artifact are removed in the same call, artifacts that are no longer
+            on disk are dropped from the manifest and artifacts that were rewritten without registering are updated.
+        INPUT:
+            dry_run: A boolean, only list what would be removed
+        RETURN:
+            removed: A list of keys of the removed artifacts
+        """
+        with self.__lock_manifest():
+            return self.__collect_garbage(dry_run)
+
+    def __collect_garbage(self, dry_run):
+        self.__reload_if_changed()
+        removed = []
+        removed_paths = set()
+        changed = False
+        # features before clusters before profiles before viz, so dependents of removed artifacts are caught
+        for kind in ARTIFACT_PARAMS:
+            for key, entry in sorted(self.artifacts.items()):
+                if entry['kind'] != kind:
+                    continue
+                filename = self.data_path + entry['path']
+                if not os.path.isfile(filename):
+                    removed_paths.add(entry['path'])
+                    if not dry_run:
+                        del self.artifacts[key]
+                        changed = True
+                elif self.is_stale(entry) or removed_paths.intersection(entry['inputs']):
+                    removed.append(key)
+                    removed_paths.add(entry['path'])
+                    if not dry_run:
+                        for sidecar in [entry['path']] + entry['sidecars']:
+                            if os.path.isfile(self.data_path + sidecar):
+                                os.remove(self.data_path + sidecar)
+                        del self.artifacts[key]
+                        changed = True
+                elif get_fingerprint(filename) != entry['fingerprint'] and not dry_run:
+                    self.artifacts[key] = self.__get_entry(kind, entry['params'], entry['path'])
+                    changed = True
+        if changed:
+            self.__save()
+        return removed
+
+
+# one catalog per data root and process
+_catalogs = {}
+
+def get_catalog(data_path=DATA_PATH):
+    """
+    Function to get the artifact catalog of a data root, loaded once per process
+    """
+    if data_path not in _catalogs:
+        _catalogs[data_path] = ArtifactCatalog(data_path)
+    return _catalogs[data_path]
@@ -2,13 +2,16 @@ import os, sys
 import warnings
 warnings.filterwarnings('ignore')
 
-DATA_PATH = os.path.dirname(os.path.abspath(__file__)) + '/data/'
+# set MBTA_DATA_PATH to run the pipeline on another data root (e.g. synthetic data)
+DATA_PATH = os.path.join(os.environ.get('MBTA_DATA_PATH', os.path.dirname(os.path.abspath(__file__)) + '/data/'), '')
 INPUT_PATH = 'input/'  # this is for afc_odx, stops, fareprod, census, geojson
 FEATURE_PATH = 'cached_features/'  # output of FeatureExtractor
 CLUSTER_PATH = 'cached_clusters/'  # output of Segmentation
 PROFILE_PATH = 'cached_profiles/'  # output of ClusterProfiler
 VIZ_PATH = 'cached_viz/'
 REPORT_PATH = 'report_models/'
+CATALOG_FILE = 'catalog.json'  # manifest of cached artifacts, see catalog.py
+LOCK_PATH = 'locks/'  # lock files of artifacts being computed, see catalog.py
 
 FEATURE_FILE_PREFIX = 'rider_features_'
 CLUSTER_FILE_PREFIX = 'rider_clusters_'
@@ -19,6 +22,56 @@ ALGORITHMS = ['kmeans', 'lda']
 RANDOM_STATE = 12345
 MAX_ITER = 200
 TOL = 1e-3
+CHUNK_SIZE = 100000  # number of rider rows per chunk when streaming features
+
+# global params for profile.py
+PROFILE_VIEWS = ['hierarchical', 'non-hierarchical', 'overview']
+
+# global params for catalog.py
+LOCK_TIMEOUT = None  # seconds to wait for another process computing the same artifact, None to wait until it is done
+LOCK_POLL_INTERVAL = 0.5  # seconds between attempts to take a lock when LOCK_TIMEOUT is set
+FINGERPRINT_SAMPLE_BYTES = 1024 ** 2  # bytes hashed at the start, middle and end of a file to fingerprint its content
+
+# global params for benchmark.py
+BENCHMARK_SCALES = [1000, 10000, 100000]  # number of synthetic riders per benchmark scale
+BENCHMARK_TRIPS_PER_RIDER = 20
+BENCHMARK_THRESHOLD = 0.2  # relative slowdown vs baseline reported as a regression
+BENCHMARK_MIN_TIME = 0.5  # seconds, stages faster than this in the baseline are not compared
+IMPORT_BUDGET_MODULES = ['MBTAdashboard.app', 'MBTAdashboard.src.utils',
+                         'MBTAriderSegmentation.profile', 'MBTAriderSegmentation.visualization']
+IMPORT_TIME_BUDGET = 0.75  # seconds, import time of each module above in a fresh interpreter
+DEFERRED_IMPORTS = ['sklearn', 'keras', 'tensorflow', 'h5py', 'matplotlib', 'seaborn', 'folium', 'branca',
+                    'IPython']  # heavy dependencies that importing the modules above must not load
+
+# global params for MBTAdashboard
+PAYLOAD_CACHE_SIZE = 32  # number of serialized frontend payloads kept in memory
+PAYLOAD_CACHE_MAX_BYTES = 256 * 1024 ** 2  # total size of the cached payloads
+PAYLOAD_VERSION = 2  # format of the frontend payload, see get_frontend_data()
+PAYLOAD_DECIMALS = 4  # decimals kept of the temporal and geographical values in the payload
+BINARY_PAYLOAD_MIMETYPE = 'application/vnd.mbta.payload'  # /reload_data with float32 patterns, see serialize_binary()
+GEOMETRY_MAX_AGE = 30 * 24 * 3600  # seconds browsers may reuse the zipcode geometry of a given version
+STATIC_MAX_AGE = 24 * 3600  # seconds browsers may reuse the MBTA lines before checking their ETag
+STATIC_BUILD_WORKERS = 4  # processes building the json files of the static dashboard, see generate_json()
+STATIC_BUILD_MANIFEST = 'build_manifest.json'  # source hashes of the json files of the last static build
+ACCESS_LOG_FILE = 'dashboard_access.log'  # requests served by the dashboard, under DATA_PATH
+WARMUP_PAYLOADS = 5  # most requested payloads in the access log preloaded at start up
+WARMUP_LOG_LINES = 10000  # latest requests of the access log counted to find the most requested ones
+WARMUP_LOG_FLUSH_INTERVAL = 60  # seconds between writes of the access log, which keeps its latest lines only
+METRICS_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # seconds
+METRICS_SIZE_BUCKETS = [1e3, 1e4, 1e5, 1e6, 1e7]  # bytes
+JOB_WORKERS = 1  # processes computing the profiles of uncached dashboard requests
+JOB_HISTORY = 100  # finished jobs kept for /jobs/<id>
+JOB_RETRY_AFTER = 60  # seconds requests of a failed profile get its failed job before it is computed again
+FRONTEND_BENCHMARK_CLUSTERS = [10, 100, 1000]  # clusters of the profiles formatted by src/benchmark.py
+
+# global params for loadtest.py
+LOADTEST_CONCURRENCY = [1, 2, 4, 8, 16, 32]  # concurrent clients of each load level
+LOADTEST_REQUESTS = 400  # /reload_data requests per load level
+LOADTEST_MONTHS = ['1709', '1710', '1711']  # months of the synthetic profiles requested
+LOADTEST_CLUSTERS = 100  # clusters of each synthetic profile (the overview has 1)
+LOADTEST_SKEW = 1.0  # Zipf skew of the popularity of the requested views
+LOADTEST_THRESHOLD = 0.2  # relative throughput drop or p95 latency increase vs baseline reported as a regression
+LOADTEST_PORT = 5050  # port of the local server started by the load test
 
 # global params for visualization.py
 COLORMAP = 'Paired'  # colormap
@@ -3,6 +3,7 @@ import pandas as pd
 import os, sys
 
 from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.catalog import get_catalog, atomic_write
 
 class DataLoader:
     """
@@ -49,7 +50,7 @@ class DataLoader:
                                      file_key + '.csv', sep=',', usecols=self.afc_odx_fields, dtype={'origin': str, 'card': str}, parse_dates=parse_dates)
                 self.df = self.df.append(new_df)
             except FileNotFoundError:
-                raise ValueError('File not found, check parameter values')
+                raise FileNotFoundError('File not found, check parameter values')
 
         # filter out transactions with no origin data
         self.df = self.df[-self.df['origin'].isnull()]
@@ -261,6 +262,27 @@ class FeatureExtractor:
         self.purchasing_patterns = self._extract_ticket_purchasing_patterns()
         sys.stdout.flush()
 
+        print('Labeling riders...', end='\r')
+        self.df_rider_features = self._label_riders()
+
+        sys.stdout.flush()
+        print('Saving features..............')
+        # save extracted features to cached_features directory
+        catalog = get_catalog()
+        with atomic_write(catalog.get_filename('features', month=self.start_month, duration=self.duration)) as temp_filename:
+            self.df_rider_features.to_csv(temp_filename)
+        catalog.register('features', month=self.start_month, duration=self.duration)
+
+        return self.df_rider_features
+
+    def _label_riders(self):
+        """
+        Function to merge the extracted patterns, label riders and drop the riders that are not segmented
+        INPUT:
+            None
+        OUTPUT:
+            df_rider_features: a df of rider level features plus group_by_frequency
+        """
         # merge all extracted patterns into one featues DataFrame
         self.df_rider_features = pd.merge(self.temporal_patterns, self.geographical_patterns, how='inner', on='riderID')
         self.df_rider_features = pd.merge(self.df_rider_features, self.purchasing_patterns, how='inner', on='riderID')
@@ -274,9 +296,6 @@ class FeatureExtractor:
         # drop infrequent riders
         self.df_rider_features = self.df_rider_features[self.df_rider_features['total_num_trips'] > 5*self.duration]
 
-
-        print('Labeling riders...', end='\r')
-
         # label riders based on whether they have commuter rail pass
         self.df_rider_features['group_commuter_rail'] = self.df_rider_features.apply(self._label_commuter_rail_rider, axis=1)
         # drop CR riders
@@ -290,12 +309,60 @@ class FeatureExtractor:
         # drop zonecr columns (not useful)
         zonecr_cols = [col for col in self.df_rider_features.columns if 'zonecr_' in col]
         self.df_rider_features.drop(zonecr_cols, axis=1, inplace=True)
+        return self.df_rider_features
 
 
-        sys.stdout.flush()
-        print('Saving features..............')
-        # save extracted features to cached_features directory
-        self.df_rider_features.to_csv(DATA_PATH + FEATURE_PATH + FEATURE_FILE_PREFIX +
-                                      self.start_month + '_' + str(self.duration) + '.csv')
+def get_rider_features_filename(start_month='1701', duration=1):
+    """
+    DESCRIPTION:
+        Function to get the cached rider features file, extracting the features first if they are not cached
+    INPUT:
+        start_month: A string of start month in yymm format
+        duration: An integer of number of months
+    RETURN:
+        csv_filename: A string of the cached features csv
+    """
+    def extract_features():  # if features in that month are not cached
+        new_df = FeatureExtractor(start_month=start_month, duration=duration).extract_features()
+        del new_df
 
-        return self.df_rider_features
+    # concurrent requests of uncached features wait for the first one to extract them
+    return get_catalog().find_or_compute('features', extract_features, month=start_month, duration=duration)
+
+def load_rider_features(start_month='1701', duration=1):
+    """
+    DESCRIPTION:
+        Function to load cached rider features, extracting them first if they are not cached.
+        The first read of the csv writes a binary copy (pickle) next to it, later reads
+        use the binary copy as long as it is newer than the csv.
+    INPUT:
+        start_month: A string of start month in yymm format
+        duration: An integer of number of months
+    RETURN:
+        df: A dataframe of rider features, as saved by FeatureExtractor.extract_features()
+    """
+    csv_filename = get_rider_features_filename(start_month=start_month, duration=duration)
+    pkl_filename = csv_filename[:-len('.csv')] + '.pkl'
+
+    if os.path.isfile(pkl_filename) and os.path.getmtime(pkl_filename) >= os.path.getmtime(csv_filename):
+        df = pd.read_pickle(pkl_filename)
+    else:
+        df = pd.read_csv(csv_filename, sep=',', dtype={'riderID': str}, index_col=0)
+        with atomic_write(pkl_filename) as temp_filename:
+            df.to_pickle(temp_filename)
+    return df
+
+def iter_rider_features(start_month='1701', duration=1, chunksize=CHUNK_SIZE):
+    """
+    DESCRIPTION:
+        Function to read cached rider features in chunks of rows, extracting them first if they are not cached.
+    INPUT:
+        start_month: A string of start month in yymm format
+        duration: An integer of number of months
+        chunksize: An integer of number of rows per chunk
+    RETURN:
+        A generator of dataframes of at most chunksize riders, in the row order of the cached features
+    """
+    csv_filename = get_rider_features_filename(start_month=start_month, duration=duration)
+    for chunk in pd.read_csv(csv_filename, sep=',', dtype={'riderID': str}, index_col=0, chunksize=chunksize):
+        yield chunk
@@ -1,16 +1,19 @@
 import numpy as np
 import pandas as pd
-from sklearn.decomposition import PCA
 import os, sys
-import re
-from datetime import datetime
+import hashlib
 
 from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.catalog import get_catalog, atomic_write
+from MBTAriderSegmentation.features import load_rider_features, iter_rider_features
+from MBTAriderSegmentation.segmentation import Segmentation, load_cluster_labels
 from MBTAriderSegmentation.report import ReportGenerator
 
 class CensusFormatter:
     """
-    Class to format and to return formatted census data
+    Class to format and to return formatted census data.
+    Census in counts is loaded on first use and shared by all instances in the process,
+    percents and proportions are computed on first use. Returned dataframes are shared, do not modify them.
     """
     # column names used to rename raw census columns
     new_col_names = [
@@ -52,11 +55,66 @@ class CensusFormatter:
         'household': 'hstat_'
     }
 
+    # formatted census shared by all instances in the process, keyed by workbook path, size and mtime
+    census_cache = {}
+
     def __init__(self, raw_census_filepath):
         self.raw_census_filepath = raw_census_filepath
-        self.census_in_counts = self.__format_raw_census_in_counts(self.raw_census_filepath)
-        self.census_in_percents = self.__convert_to_percents(self.census_in_counts)
-        self.census_in_proportions = self.__convert_to_proportions(self.census_in_counts)
+
+    def __get_cached(self):
+        """
+        Function to get the process-wide cache entry of the workbook, loading census in counts on first use
+        """
+        stat = os.stat(self.raw_census_filepath)
+        key = (os.path.abspath(self.raw_census_filepath), stat.st_size, stat.st_mtime)
+        if key not in CensusFormatter.census_cache:
+            CensusFormatter.census_cache[key] = {'counts': self.__load_census_in_counts(self.raw_census_filepath)}
+        return CensusFormatter.census_cache[key]
+
+    def __load_census_in_counts(self, raw_census_filepath):
+        """
+        DESCRIPTION:
+            Function to load census in counts. The formatted census is saved as a pickle next to the
+            workbook, keyed on the hash of the workbook, so the workbook is only parsed when it changes.
+        INPUT:
+            raw_census_filepath: A string of file path to raw census data
+        RETURN:
+            census: A formatted dataframe where data is represented in counts
+        """
+        with open(raw_census_filepath, 'rb') as f:
+            workbook_hash = hashlib.sha1(f.read()).hexdigest()[:16]
+        stem = os.path.splitext(raw_census_filepath)[0]
+        pkl_filename = stem + '.' + workbook_hash + '.pkl'
+        if os.path.isfile(pkl_filename):
+            return pd.read_pickle(pkl_filename)
+
+        census = self.__format_raw_census_in_counts(raw_census_filepath)
+        # remove pickles of previous versions of the workbook
+        dirname, basename = os.path.split(stem)
+        for filename in os.listdir(dirname or '.'):
+            if filename.startswith(basename + '.') and filename.endswith('.pkl'):
+                os.remove(os.path.join(dirname, filename))
+        with atomic_write(pkl_filename) as temp_filename:
+            census.to_pickle(temp_filename)
+        return census
+
+    @property
+    def census_in_counts(self):
+        return self.__get_cached()['counts']
+
+    @property
+    def census_in_percents(self):
+        cached = self.__get_cached()
+        if 'percents' not in cached:
+            cached['percents'] = self.__convert_to_percents(cached['counts'])
+        return cached['percents']
+
+    @property
+    def census_in_proportions(self):
+        cached = self.__get_cached()
+        if 'proportions' not in cached:
+            cached['proportions'] = self.__convert_to_proportions(cached['counts'])
+        return cached['proportions']
 
     def __format_raw_census_in_counts(self, raw_census_filepath):
         """
@@ -214,6 +272,12 @@ class CensusFormatter:
 
 
 class ClusterProfiler:
+    """
+    Class to profile the clusters of the hierarchical or non-hierarchical model.
+
+    With low_memory=True, the cached features are never loaded as a whole. extract_profiles() reads
+    them in row chunks and only keeps the per-cluster column sums of every label column.
+    """
     # feature groups and expected prefixes in riders
     feat_groups = {
         'cluster': ['cluster_'],
@@ -234,71 +298,82 @@ class ClusterProfiler:
         'household': 'hstat_'
     }
 
-    def __init__(self, hierarchical=False, w_time=None, start_month='1701', duration=1):
+    def __init__(self, hierarchical=False, w_time=None, start_month='1701', duration=1, low_memory=False):
         self.start_month = start_month
         self.duration = duration
         self.hierarchical = hierarchical
-        self.census = CensusFormatter(DATA_PATH + INPUT_PATH + "census/MA_census.xlsx").get_census_in_counts()
-
+        self.low_memory = low_memory
         if w_time:
             self.w_time = int(w_time)
         else:
             self.w_time = 0
 
-        if hierarchical:
-            self.input_path = DATA_PATH + CLUSTER_PATH + 'hierarchical/results/'
-        else:
-            self.input_path = DATA_PATH + CLUSTER_PATH + 'non_hierarchical/results/'
-
-        self.param_keys = ['hierarchical', 'month', 'duration', 'w_time']
-
         self.__get_data()
 
-    def __split(self, delimiters, string, maxsplit=0):
+    @property
+    def census(self):
         """
-        Function to split file name for matching cached results
+        Census in counts, loaded on first use (see CensusFormatter)
         """
-        regexPattern = '|'.join(map(re.escape, delimiters))
-        return re.split(regexPattern, string, maxsplit)
-
+        return CensusFormatter(DATA_PATH + INPUT_PATH + "census/MA_census.xlsx").get_census_in_counts()
 
-    def __get_cached_params_list(self):
+    def __get_labels_filename(self, hierarchical):
         """
-        Function to find parameter combinations of cached results
+        Function to get the cluster labels file of the hierarchical or non-hierarchical model, reclustering if it is not cached
         """
-        cached_combo = []
-        delimiters = ['_', '.']
-        for filename in os.listdir(self.input_path):
-            if filename.endswith(".csv"):
-                str_split = self.__split(delimiters, filename)[:-1]
-                if 'non' not in self.input_path:
-                    param_vals = ['True'] + str_split[2:]
-                else:
-                    param_vals = ['False'] + str_split[2:]
-                cached_combo.append(dict(zip(self.param_keys, param_vals)))
-        return cached_combo
-
-    def __get_data(self):
-        # check if the requested data is in the cache directory ready to go
-        cached_combo = self.__get_cached_params_list()
-        req_param_vals = [str(self.hierarchical), self.start_month, str(self.duration), str(self.w_time)]
-        req_param_dict = dict(zip(self.param_keys, req_param_vals))
-
-        if req_param_dict in cached_combo:
-            self.riders = pd.read_csv(self.input_path + CLUSTER_FILE_PREFIX +
-                                       req_param_dict['month'] + '_' +
-                                       req_param_dict['duration'] + '_' +
-                                       req_param_dict['w_time'] +
-                                       '.csv', index_col=0)
-        else:  # Recluster
+        params = {'view': 'hierarchical' if hierarchical else 'non-hierarchical',
+                  'month': self.start_month, 'duration': self.duration, 'w_time': self.w_time}
+        def recluster():
             segmentation = Segmentation(start_month=self.start_month, duration=self.duration, w_time=self.w_time)
-            segmentation.get_rider_segmentation(hierarchical=self.hierarchical)
+            segmentation.get_rider_segmentation(hierarchical=hierarchical)
             del segmentation
-            self.riders = pd.read_csv(self.input_path + CLUSTER_FILE_PREFIX +
-                                       req_param_dict['month'] + '_' +
-                                       req_param_dict['duration'] + '_' +
-                                       req_param_dict['w_time'] +
-                                       '.csv', index_col=0)
+
+        # concurrent requests of uncached labels wait for the first one to recluster
+        return get_catalog().find_or_compute('clusters', recluster, **params)
+
+    def __get_data(self):
+        self.labels_filename = self.__get_labels_filename(self.hierarchical)
+        # riders are joined with their features on first access
+        self._riders = None
+        self._features = None
+
+    def __get_features(self):
+        """
+        Function to get cached rider features (without group_by_frequency), loaded once per profiler
+        """
+        if self._features is None:
+            features = load_rider_features(start_month=self.start_month, duration=self.duration)
+            self._features = features.drop(['group_by_frequency'], axis=1)
+        return self._features
+
+    def __load_labels(self, labels_filename, n_riders=None):
+        """
+        Function to load a cluster labels table and check it matches the cached features,
+        n_riders is the number of cached riders, the cached features are loaded to count them if it is None
+        """
+        features_filename, labels = load_cluster_labels(labels_filename)
+        expected_filename = FEATURE_FILE_PREFIX + self.start_month + '_' + str(self.duration) + '.csv'
+        if n_riders is None:
+            n_riders = len(self.__get_features())
+        if features_filename != expected_filename or labels['riderID'].max() >= n_riders:
+            raise ValueError('Cluster labels in {} do not match cached features {}'.format(labels_filename,
+                                                                                         expected_filename))
+        return labels
+
+    @property
+    def riders(self):
+        """
+        Rider-level features plus initial_cluster and one column per algorithm.
+        The label table is joined to the cached features lazily on first access.
+        """
+        if self._riders is None:
+            labels = self.__load_labels(self.labels_filename)
+            riders = self.__get_features().iloc[labels['riderID'].values]
+            riders = riders.reset_index(drop=True)
+            for col in labels.columns.drop('riderID'):
+                riders[col] = labels[col].values
+            self._riders = riders
+        return self._riders
 
     def _softmax(self, df):
         exp_df = np.exp(df)
@@ -325,43 +400,130 @@ class ClusterProfiler:
                 and additional cluster info such as cluster size
         """
 
-        wkday_24_cols = ['wkday_24_' + str(i) for i in range(1, 25)]
-        wkend_24_cols = ['wkend_24_' + str(i) for i in range(1, 25)]
-
         if by_cluster:
-            # group by cluster and calculate cluster_size and cluster_avg_num_trips
-            temp_df1 = riders.groupby(by=['cluster'])
-            # column sums
-            temp_df2 = temp_df1.sum()
-            temp_df2['cluster_size'] = temp_df1['total_num_trips'].count()
-            temp_df2['cluster_avg_num_trips'] = temp_df2['total_num_trips'].div(temp_df2['cluster_size'], axis=0)
-            temp_df2 = temp_df2.reset_index()
-            weekday = temp_df2[wkday_24_cols]
-            weekend = temp_df2[wkend_24_cols]
-
-            # max_hr_modes = temp_df1.apply(lambda x: x[['max_wkday_24_1', 'max_wkday_24_2', 'max_wkend_24_1']].mode())
-            # max_hr_idx = [i for i, x in enumerate(max_hr_modes.index) if x[1] == 0]
-            # max_hr_modes = max_hr_modes.iloc[max_hr_idx].reset_index().drop(['cluster', 'level_1'], axis=1)
-
+            feature_sums = self._aggregate_features(riders.drop(['cluster'], axis=1), riders['cluster'].values)
         else:
             temp_df1 = riders.drop(['cluster'], axis=1)
             # column sums
-            temp_df2 = (temp_df1.sum().to_frame()).T
-            temp_df2['cluster_size'] = len(temp_df1)
-            temp_df2['cluster_avg_num_trips'] = temp_df2['total_num_trips'] / temp_df2['cluster_size']
-            temp_df2 = temp_df2.reset_index().rename(index=int, columns={'index': 'cluster'})
-            weekday = temp_df2[wkday_24_cols]
-            weekend = temp_df2[wkend_24_cols]
-
-            # max_hr_modes = (temp_df1[['max_wkday_24_1', 'max_wkday_24_2', 'max_wkend_24_1']].mode().loc[0,:].to_frame()).T
-
-        # get max_hr_modes
-        wkday_rank = weekday.apply(np.argsort, axis=1)
-        ranked_wkday_cols = weekday.columns.to_series()[wkday_rank.values[:,::-1][:,:2]]
+            feature_sums = (temp_df1.sum().to_frame()).T
+            feature_sums['cluster_size'] = len(temp_df1)
+            feature_sums.index.name = 'cluster'
+        return self._summarize_feature_sums(feature_sums)
+
+    def _aggregate_features(self, features, labels):
+        """
+        DESCRIPTION:
+            Function to sum rider-level features by cluster
+        INPUT:
+            features: A dataframe containing rider-level pattern-of-use features, required
+            labels: An array of cluster assignment of each rider, required
+        RETURN:
+            feature_sums: A dataframe of column sums indexed by cluster, plus cluster_size
+        """
+        # group by cluster and calculate column sums and cluster_size
+        temp_df1 = features.groupby(labels)
+        feature_sums = temp_df1.sum()
+        feature_sums['cluster_size'] = temp_df1['total_num_trips'].count()
+        feature_sums.index.name = 'cluster'
+        return feature_sums
+
+    def _aggregate_features_chunked(self, label_sets, chunk_size=CHUNK_SIZE):
+        """
+        DESCRIPTION:
+            Function to sum rider-level features by cluster for several label columns in one pass over
+            the cached features, read in row chunks. Only a (clusters x columns) accumulator is kept
+            per label column, the sums are the same as _aggregate_features() of each label column.
+        INPUT:
+            label_sets: A dictionary of (rows, labels) keyed by e.g. (view, algorithm), required.
+                rows are the row positions of the labelled riders in the cached features (riderID of
+                the cluster labels) and labels their clusters. (None, None) sums all riders as cluster 0.
+            chunk_size: An integer of number of riders per chunk
+        RETURN:
+            feature_sums: A dictionary of dataframes of column sums indexed by cluster, plus cluster_size,
+                with the keys of label_sets
+        """
+        # cluster index of each cached rider for every label column, -1 for riders without a label
+        clusters = {}
+        cluster_idx = {}
+        for key, (rows, labels) in label_sets.items():
+            if rows is None:
+                clusters[key] = np.array([0])
+                cluster_idx[key] = None
+            else:
+                clusters[key], idx = np.unique(labels, return_inverse=True)
+                cluster_idx[key] = np.full(rows.max() + 1 if len(rows) else 0, -1, dtype=np.int64)
+                cluster_idx[key][rows] = idx.reshape(-1)
+
+        sums = {}
+        counts = {}
+        is_integer = None
+        n_riders = 0
+        for chunk in iter_rider_features(start_month=self.start_month, duration=self.duration, chunksize=chunk_size):
+            chunk = chunk.drop(['riderID', 'group_by_frequency'], axis=1)
+            if is_integer is None:
+                columns = chunk.columns
+                is_integer = np.ones(len(columns), dtype=bool)
+                for key in label_sets:
+                    sums[key] = np.zeros((len(clusters[key]), len(columns)))
+                    counts[key] = np.zeros(len(clusters[key]), dtype=np.int64)
+            # a column keeps an integer dtype only if it is integer in every chunk, as in a single read
+            is_integer &= np.array([pd.api.types.is_integer_dtype(dtype) for dtype in chunk.dtypes])
+
+            for key, idx in cluster_idx.items():
+                if idx is None:
+                    chunk_idx = np.zeros(len(chunk), dtype=np.int64)
+                else:
+                    chunk_idx = np.full(len(chunk), -1, dtype=np.int64)
+                    chunk_labels = idx[n_riders:n_riders + len(chunk)]
+                    chunk_idx[:len(chunk_labels)] = chunk_labels
+                labelled = chunk_idx >= 0
+                if not labelled.any():
+                    continue
+                chunk_sums = chunk[labelled].groupby(chunk_idx[labelled]).sum()
+                sums[key][chunk_sums.index.values] += chunk_sums.values
+                counts[key] += np.bincount(chunk_idx[labelled], minlength=len(counts[key]))
+            n_riders += len(chunk)
+            del chunk
+
+        feature_sums = {}
+        for key in label_sets:
+            idx = cluster_idx[key]
+            if idx is not None and len(idx) > n_riders:
+                raise ValueError('Cluster labels {} do not match cached features with {} riders'.format(key, n_riders))
+            key_sums = pd.DataFrame(sums[key], index=pd.Index(clusters[key], name='cluster'), columns=columns)
+            for col in columns[is_integer]:
+                key_sums[col] = key_sums[col].astype(np.int64)
+            key_sums['cluster_size'] = counts[key]
+            feature_sums[key] = key_sums
+        return feature_sums
+
+    def _summarize_feature_sums(self, feature_sums):
+        """
+        DESCRIPTION:
+            Function to summarize features from their column sums, see _summarize_features()
+        INPUT:
+            feature_sums: A dataframe of column sums indexed by cluster, plus cluster_size, required
+        RETURN:
+            cluster_features: A dataframe containing cluster-level pattern-of-use features
+                and additional cluster info such as cluster size
+        """
+        wkday_24_cols = ['wkday_24_' + str(i) for i in range(1, 25)]
+        wkend_24_cols = ['wkend_24_' + str(i) for i in range(1, 25)]
+
+        temp_df2 = feature_sums.copy()
+        temp_df2['cluster_avg_num_trips'] = temp_df2['total_num_trips'].div(temp_df2['cluster_size'], axis=0)
+        temp_df2 = temp_df2.reset_index()
+        weekday = temp_df2[wkday_24_cols]
+        weekend = temp_df2[wkend_24_cols]
+
+        # get max_hr_modes, hours are looked up by column position
+        # (a full row-wise argsort is kept rather than argpartition so that ties between hours rank as before)
+        hours = np.array([int(col.split('_')[-1]) for col in wkday_24_cols])
+        wkday_rank = np.argsort(weekday.values, axis=1)[:, ::-1]
         max_hr_modes = pd.DataFrame()
-        max_hr_modes['max_wkday_24_1'] = pd.DataFrame(ranked_wkday_cols[:, 0])[0].apply(lambda x: int(str(x).split('_')[-1]))
-        max_hr_modes['max_wkday_24_2'] = pd.DataFrame(ranked_wkday_cols[:, 1])[0].apply(lambda x: int(str(x).split('_')[-1]))
-        max_hr_modes['max_wkend_24_1'] = weekend.idxmax(axis=1).apply(lambda x: int(x.split('_')[-1]))
+        max_hr_modes['max_wkday_24_1'] = hours[wkday_rank[:, 0]]
+        max_hr_modes['max_wkday_24_2'] = hours[wkday_rank[:, 1]]
+        max_hr_modes['max_wkend_24_1'] = hours[np.argmax(weekend.values, axis=1)]
 
         # loop through feature groups
         cluster_features = pd.DataFrame()
@@ -407,23 +569,17 @@ class ClusterProfiler:
         # filter census by the zipcodes present in the data to increase search efficiency
         self.zipcodes = [col.split('_')[-1] for col in geo_patterns.columns]
         census_of_interest = self.census.loc[self.census['zipcode'].isin(self.zipcodes)]
+        demo_cols = census_of_interest.columns[2:]
+
+        # align census to geo columns: row i is the demographics of the zipcode in geo column i
+        # (zeros if the zipcode is not in the census, summed if it appears more than once)
+        zipcode_match = (np.array(self.zipcodes, dtype=object)[:, np.newaxis] ==
+                         census_of_interest['zipcode'].values.astype(object)[np.newaxis, :])
+        census_matrix = zipcode_match.astype(float).dot(census_of_interest[demo_cols].fillna(0).values.astype(float))
 
-        cluster_demographics = pd.DataFrame()
-        # loop through each cluster in geo_patterns
-        for cluster, cluster_feats in geo_patterns.iterrows():
-            # demographics of current cluster
-            cluster_i_demo = pd.DataFrame()
-            # loop through each zipcode in current cluster
-            for col_name in cluster_feats.index:
-                zipcode_i = col_name.split('_')[-1]  # current zipcode
-                zipcode_i_prob = cluster_feats[col_name]  # weight of current zipcode
-                # demographics of current zipcode
-                zipcode_i_demo = census_of_interest[census_of_interest.zipcode == zipcode_i].iloc[:, 2:]
-                # multiply weight by the demographics profile
-                cluster_i_demo = cluster_i_demo.append(zipcode_i_prob * zipcode_i_demo)
-            # cluster i demographics is weighted sum of demographics profile in each zipcode
-            cluster_i_demo = cluster_i_demo.sum()
-            cluster_demographics = cluster_demographics.append(cluster_i_demo.rename(cluster))
+        # cluster demographics are weighted sums of demographics profile in each zipcode
+        cluster_demographics = pd.DataFrame(data=geo_patterns.values.dot(census_matrix),
+                                            index=geo_patterns.index, columns=demo_cols)
 
         # round all counts fields (e.g. population, num_households) as integer
         count_suffix = '_nb'
@@ -442,21 +598,32 @@ class ClusterProfiler:
         new_count_cols = [col for col in cluster_demographics.columns if count_suffix in col]
         cluster_demographics.drop(new_count_cols, axis=1, inplace=True)
 
-        # loop through feature groups
-        normalized_cluster_demographics = pd.DataFrame()
-        normalized_cluster_demographics['cluster'] = cluster_features['cluster']
-        normalized_cluster_demographics['cluster_id'] = cluster_features['cluster'].astype(int)
+        # columns of each feature group, in group order ('cluster' columns are kept as they are)
+        cluster_cols = []
+        group_cols = []
+        group_ids = []
         for feature, prefix in ClusterProfiler.demo_groups.items():
-            # get column names that belong to the current feature group
             feature_cols = [col for col in cluster_demographics.columns if prefix in col]
-            # normalize if the feature is not 'cluster'
-            if feature is 'cluster':
-                normalized_cluster_demographics = pd.concat([normalized_cluster_demographics, cluster_demographics[feature_cols]], axis=1)
+            if feature == 'cluster':
+                cluster_cols += feature_cols
             else:
-                # normalize by row sum of current feature group
-                normalized = cluster_demographics[feature_cols].copy()
-                normalized.iloc[:, :] = (normalized.iloc[:, :].div(normalized.sum(axis=1), axis=0)).multiply(100)
-                normalized_cluster_demographics = pd.concat([normalized_cluster_demographics, normalized], axis=1)
+                group_cols += feature_cols
+                group_ids += [len(set(group_ids))] * len(feature_cols)
+
+        # normalize by row sum of each feature group
+        group_values = cluster_demographics[group_cols].values.astype(float)
+        group_ids = np.array(group_ids, dtype=int)
+        group_onehot = np.eye(len(set(group_ids)))[group_ids]
+        group_sums = group_values.dot(group_onehot)[:, group_ids]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalized = pd.DataFrame(data=group_values / group_sums * 100,
+                                      index=cluster_demographics.index, columns=group_cols)
+
+        normalized_cluster_demographics = pd.DataFrame()
+        normalized_cluster_demographics['cluster'] = cluster_features['cluster']
+        normalized_cluster_demographics['cluster_id'] = cluster_features['cluster'].astype(int)
+        normalized_cluster_demographics = pd.concat([normalized_cluster_demographics,
+                                                     cluster_demographics[cluster_cols], normalized], axis=1)
 
         return normalized_cluster_demographics
 
@@ -469,6 +636,7 @@ class ClusterProfiler:
                     X[col] = 0
                 else:
                     X[col] = (features[col] - features[col].mean())/features[col].std()
+            from sklearn.decomposition import PCA  # only needed when profiles are generated
             pca = PCA(n_components=2, svd_solver='full')
             X_pca = pca.fit_transform(X)
             pca_df = pd.DataFrame(data={'cluster': features['cluster'], 'viz_id': features['cluster'].astype(int),
@@ -485,63 +653,113 @@ class ClusterProfiler:
         DESCRIPTION:
             Function to extract cluster profile.
         INPUT:
+            algorithm: A string of clustering algorithm, one of ALGORITHMS, required
             by_cluster: A boolean indicating whether feature summary should be performed by cluster, required
         RETURN:
             profile: A dataframe with cluster assignment, features and demographics distribution
         """
-
-        cols_to_drop = ['riderID', 'initial_cluster']
-        df = self.riders.drop(ALGORITHMS + cols_to_drop, axis=1)
-        df['cluster'] = self.riders[algorithm]
-
-        # summarize features
         if by_cluster:
-            print("summarizing by cluster features...")
-            self.features = self._summarize_features(df, True)
+            view = 'hierarchical' if self.hierarchical else 'non-hierarchical'
         else:
-            print("summarizing overall features...")
-            self.features = self._summarize_features(df, False)
-
-        # summarize demographics
-        print("summarizing demographics...")
-        self.demographics = self._summarize_demographics(self.features)
+            view = 'overview'
+        profiles = self.extract_profiles(algorithms=[algorithm], views=[view])
+        return list(profiles.values())[0]
 
-        # get pca components
-        print("getting pcas...")
-        pca_df = self._get_first_2_pca_components(self.features)
-
-        # merge dfs
-        profile = self.features.merge(self.demographics, on='cluster', how='inner')
-        profile = profile.merge(pca_df, on='cluster', how='inner')
-
-        # generating reports
+    def extract_profiles(self, algorithms=ALGORITHMS, views=PROFILE_VIEWS):
+        """
+        DESCRIPTION:
+            Function to extract and save cluster profiles of several algorithms and views in one pass.
+            Rider features are read once, features are summed once per label column, the overview
+            is computed from the same column sums and the reports of all profiles are generated in one batch.
+        INPUT:
+            algorithms: A list of clustering algorithms, subset of ALGORITHMS
+            views: A list of views, subset of PROFILE_VIEWS. 'hierarchical' and 'non-hierarchical' profile
+                the clusters of that model, 'overview' profiles all riders as one cluster
+        RETURN:
+            profiles: A dictionary of profile dataframes keyed by (view, algorithm), algorithm is None for 'overview'
+        """
+        # label columns to summarize, the overview sums all riders as one cluster
+        # unless it can be computed from the sums of another label column
+        label_sets = {}
+        for view in views:
+            if view == 'overview':
+                continue
+            labels_filename = self.__get_labels_filename(view == 'hierarchical')
+            # in low memory mode labels are checked against the number of riders while summarizing
+            labels = self.__load_labels(labels_filename, n_riders=np.inf if self.low_memory else None)
+            for algorithm in algorithms:
+                label_sets[(view, algorithm)] = (labels['riderID'].values, labels[algorithm].values)
+        if 'overview' in views and not label_sets:
+            label_sets[('overview', None)] = (None, None)
+
+        # summarize features, one grouped aggregation per label column
+        print("summarizing by cluster features...")
+        if self.low_memory:
+            feature_sums = self._aggregate_features_chunked(label_sets)
+        else:
+            features = self.__get_features().drop(['riderID'], axis=1)
+            feature_sums = {}
+            view_features = {}  # riders of each view, selected once for all algorithms
+            for (view, algorithm), (rows, labels) in label_sets.items():
+                if view not in view_features:
+                    if rows is None or (len(rows) == len(features) and (rows == np.arange(len(rows))).all()):
+                        view_features[view] = features
+                    else:
+                        view_features[view] = features.iloc[rows]
+                if rows is None:
+                    labels = np.zeros(len(features), dtype=int)
+                feature_sums[(view, algorithm)] = self._aggregate_features(view_features[view], labels)
+            del view_features
+
+        if 'overview' in views:
+            print("summarizing overall features...")
+            # column sums over all riders are the sums of the cluster sums
+            cluster_sums = feature_sums.pop(('overview', None), None)
+            if cluster_sums is None:
+                cluster_sums = next(iter(feature_sums.values()))
+            overall = (cluster_sums.drop(['cluster_size'], axis=1).sum().to_frame()).T
+            overall['cluster_size'] = int(cluster_sums['cluster_size'].sum())
+            overall.index.name = 'cluster'
+            feature_sums[('overview', None)] = overall
+
+        profiles = {}
+        for key, sums in feature_sums.items():
+            self.features = self._summarize_feature_sums(sums)
+
+            # summarize demographics
+            print("summarizing demographics...")
+            self.demographics = self._summarize_demographics(self.features)
+
+            # get pca components
+            print("getting pcas...")
+            pca_df = self._get_first_2_pca_components(self.features)
+
+            # merge dfs
+            profile = self.features.merge(self.demographics, on='cluster', how='inner')
+            profiles[key] = profile.merge(pca_df, on='cluster', how='inner')
+
+        # generating reports of all profiles in one batch
         print("generating reports...")
         cnn_model_filename = DATA_PATH + REPORT_PATH + 'report_cnn.h5'
-        profile = ReportGenerator(cnn_model_filename=cnn_model_filename).generate_report(profile)
+        keys = list(profiles.keys())
+        batch = pd.concat([profiles[key] for key in keys], ignore_index=True)
+        batch = ReportGenerator(cnn_model_filename=cnn_model_filename).generate_report(batch)
+        offset = 0
+        for key in keys:
+            n_clusters = len(profiles[key])
+            profiles[key]['rider_type'] = batch['rider_type'].values[offset:offset + n_clusters]
+            profiles[key]['report'] = batch['report'].values[offset:offset + n_clusters]
+            offset += n_clusters
 
         print("saving results...")
-        self.__save_profile(profile, algorithm, by_cluster)
-
-    def __save_profile(self, profile, algorithm, by_cluster):
-        start_month = datetime.strptime(self.start_month, "%y%m").strftime("%Y-%b")
-
-        if self.duration > 1:
-            end_month = datetime.strptime(str(int(self.start_month) + self.duration-1), "%y%m").strftime("%Y-%b")
-            dest = DATA_PATH + PROFILE_PATH + start_month + '_to_' + end_month + '/'
-        else:
-            dest = DATA_PATH + PROFILE_PATH + start_month + '/'
-
-        if not os.path.isdir(dest):
-            os.makedirs(dest)
-
-        if by_cluster:
-            if self.hierarchical:
-                profile.to_csv(dest + 'hierarchical_' + PROFILE_FILE_PREFIX  + self.start_month +
-                       '_' + str(self.duration) + '_' + str(self.w_time) + '_' + algorithm + '.csv')
-            else:
-                profile.to_csv(dest + 'non-hierarchical_' + PROFILE_FILE_PREFIX  + self.start_month +
-                       '_' + str(self.duration) + '_' + str(self.w_time) + '_' + algorithm + '.csv')
-
-        else:
-            profile.to_csv(dest + 'overview_' + PROFILE_FILE_PREFIX  + self.start_month +
-                       '_' + str(self.duration) + '.csv')
+        self.__save_profiles(profiles)
+        return profiles
+
+    def __save_profiles(self, profiles):
+        catalog = get_catalog()
+        for (view, algorithm), profile in profiles.items():
+            params = {'view': view, 'month': self.start_month, 'duration': self.duration,
+                      'w_time': self.w_time, 'algorithm': algorithm}
+            with atomic_write(catalog.get_filename('profiles', **params)) as temp_filename:
+                profile.to_csv(temp_filename)
+            catalog.register('profiles', **params)
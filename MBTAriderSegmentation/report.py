@@ -1,35 +1,265 @@
 import numpy as np
 import pandas as pd
+import os
+import json
 import warnings
 warnings.filterwarnings('ignore')
 
-import keras
-from keras.models import Sequential, load_model
-from keras.layers import Dense, Conv2D, Flatten, MaxPooling2D, Activation
-from keras.optimizers import Adam
-from sklearn.model_selection import train_test_split
-
 from MBTAriderSegmentation.config import *
 
+# keras layers supported by ReportCNN, Dropout and InputLayer do nothing at inference
+CNN_LAYERS = ['Conv2D', 'MaxPooling2D', 'Flatten', 'Dense', 'Activation', 'Dropout', 'InputLayer']
+
+###############################################
+# Numpy forward pass of the report CNN
+###############################################
+def _get_same_padding(size, kernel_size, stride):
+    # padding of keras/tensorflow 'same' mode, extra padding goes after
+    out_size = int(np.ceil(float(size) / stride))
+    pad = max((out_size - 1) * stride + kernel_size - size, 0)
+    return pad // 2, pad - pad // 2
+
+def _pad(x, kernel_size, strides, padding, value=0.):
+    if padding == 'valid':
+        return x
+    pad_h = _get_same_padding(x.shape[1], kernel_size[0], strides[0])
+    pad_w = _get_same_padding(x.shape[2], kernel_size[1], strides[1])
+    return np.pad(x, ((0, 0), pad_h, pad_w, (0, 0)), mode='constant', constant_values=value)
+
+def _conv2d(x, kernel, bias, strides, padding):
+    """
+    Function to compute a channels_last 2D convolution (cross-correlation, as in keras)
+    of x (n, height, width, channels) with kernel (kernel_height, kernel_width, channels, filters)
+    """
+    kernel_h, kernel_w = kernel.shape[:2]
+    x = _pad(x, (kernel_h, kernel_w), strides, padding)
+    out_h = (x.shape[1] - kernel_h) // strides[0] + 1
+    out_w = (x.shape[2] - kernel_w) // strides[1] + 1
+    out = np.zeros((x.shape[0], out_h, out_w, kernel.shape[3]), dtype=x.dtype)
+    for i in range(kernel_h):
+        for j in range(kernel_w):
+            patch = x[:, i:i + strides[0] * (out_h - 1) + 1:strides[0], j:j + strides[1] * (out_w - 1) + 1:strides[1], :]
+            out += patch.dot(kernel[i, j])
+    return out + bias
+
+def _max_pooling2d(x, pool_size, strides, padding):
+    x = _pad(x, pool_size, strides, padding, value=-np.inf)
+    out_h = (x.shape[1] - pool_size[0]) // strides[0] + 1
+    out_w = (x.shape[2] - pool_size[1]) // strides[1] + 1
+    out = None
+    for i in range(pool_size[0]):
+        for j in range(pool_size[1]):
+            patch = x[:, i:i + strides[0] * (out_h - 1) + 1:strides[0], j:j + strides[1] * (out_w - 1) + 1:strides[1], :]
+            out = patch if out is None else np.maximum(out, patch)
+    return out
+
+def _activation(x, activation):
+    if activation in [None, 'linear']:
+        return x
+    elif activation == 'relu':
+        return np.maximum(x, 0)
+    elif activation == 'softmax':
+        exp_x = np.exp(x - x.max(axis=-1, keepdims=True))
+        return exp_x / exp_x.sum(axis=-1, keepdims=True)
+    elif activation == 'sigmoid':
+        return 1. / (1. + np.exp(-x))
+    elif activation == 'tanh':
+        return np.tanh(x)
+    else:
+        raise ValueError('Unsupported activation: {}'.format(activation))
+
+
+class ReportCNN:
+    """
+    Class to run the report CNN in numpy. The CNN is a keras Sequential model of Conv2D, MaxPooling2D,
+    Flatten, Dense and Activation layers (channels_last) whose weights were exported by export_cnn_weights().
+    Has the same predict() and predict_classes() as the keras model.
+    """
+    def __init__(self, weights_filename):
+        with np.load(weights_filename) as weights:
+            self.layers = json.loads(str(weights['layers']))
+            self.weights = [[weights['layer{}_{}'.format(i, j)] for j in range(layer['n_weights'])]
+                            for i, layer in enumerate(self.layers)]
+
+    def predict(self, X):
+        """
+        DESCRIPTION:
+            Function to compute the output of the CNN
+        INPUT:
+            X: An array of shape (n_samples, height, width, channels), required
+        RETURN:
+            y: An array of shape (n_samples, n_classes) of class probabilities
+        """
+        x = np.asarray(X, dtype=np.float32)
+        for layer, weights in zip(self.layers, self.weights):
+            name = layer['class_name']
+            if name == 'Conv2D':
+                x = _conv2d(x, weights[0], weights[1] if layer['use_bias'] else 0., layer['strides'], layer['padding'])
+                x = _activation(x, layer['activation'])
+            elif name == 'MaxPooling2D':
+                x = _max_pooling2d(x, layer['pool_size'], layer['strides'], layer['padding'])
+            elif name == 'Flatten':
+                x = x.reshape((x.shape[0], -1))
+            elif name == 'Dense':
+                x = x.dot(weights[0])
+                if layer['use_bias']:
+                    x = x + weights[1]
+                x = _activation(x, layer['activation'])
+            elif name == 'Activation':
+                x = _activation(x, layer['activation'])
+        return x
+
+    def predict_classes(self, X):
+        return np.argmax(self.predict(X), axis=-1)
+
+
+def get_weights_filename(cnn_model_filename):
+    """
+    Function to get the numpy weights file of a keras model file (same name with .npz extension)
+    """
+    return os.path.splitext(cnn_model_filename)[0] + '.npz'
+
+def _decode(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+def export_cnn_weights(cnn_model_filename, weights_filename=None):
+    """
+    DESCRIPTION:
+        Function to export the layers and weights of a keras Sequential model saved in h5 format
+        to a numpy .npz file that can be run by ReportCNN. Reads the h5 file directly, keras is not needed.
+    INPUT:
+        cnn_model_filename: A string of keras model filename (.h5), required
+        weights_filename: A string of output filename, default get_weights_filename(cnn_model_filename)
+    RETURN:
+        weights_filename: A string of the output filename
+    """
+    import h5py
+
+    if weights_filename is None:
+        weights_filename = get_weights_filename(cnn_model_filename)
+
+    with h5py.File(cnn_model_filename, 'r') as f:
+        model_config = json.loads(_decode(f.attrs['model_config']))
+        if model_config['class_name'] != 'Sequential':
+            raise ValueError('Only Sequential models can be exported, got {}'.format(model_config['class_name']))
+        layer_configs = model_config['config']
+        if isinstance(layer_configs, dict):  # keras >= 2.2 nests the layers
+            layer_configs = layer_configs['layers']
+        model_weights = f['model_weights'] if 'model_weights' in f else f
+
+        layers = []
+        arrays = {}
+        for i, layer_config in enumerate(layer_configs):
+            name = layer_config['class_name']
+            config = layer_config['config']
+            if name not in CNN_LAYERS:
+                raise ValueError('Unsupported layer: {}'.format(name))
+            if config.get('data_format', 'channels_last') != 'channels_last':
+                raise ValueError('Only channels_last layers are supported')
+            layer = {'class_name': name,
+                     'activation': config.get('activation'),
+                     'use_bias': config.get('use_bias', True),
+                     'padding': config.get('padding'),
+                     'strides': config.get('strides'),
+                     'pool_size': config.get('pool_size')}
+            if name == 'MaxPooling2D' and layer['strides'] is None:
+                layer['strides'] = layer['pool_size']
+
+            weight_names = []
+            if config['name'] in model_weights:
+                weight_names = [_decode(n) for n in model_weights[config['name']].attrs['weight_names']]
+            for j, weight_name in enumerate(weight_names):
+                arrays['layer{}_{}'.format(i, j)] = model_weights[config['name']][weight_name][()]
+            layer['n_weights'] = len(weight_names)
+            layers.append(layer)
+
+    np.savez(weights_filename, layers=json.dumps(layers), **arrays)
+    return weights_filename
+
+def verify_cnn_weights(cnn_model_filename, weights_filename=None, n_samples=200, random_state=RANDOM_STATE):
+    """
+    DESCRIPTION:
+        Function to compare ReportCNN outputs with the keras model on random hourly patterns.
+        Needs keras.
+    INPUT:
+        cnn_model_filename: A string of keras model filename (.h5), required
+        weights_filename: A string of exported weights filename, default get_weights_filename(cnn_model_filename)
+        n_samples: An integer of number of random patterns
+    RETURN:
+        max_diff: A float, max absolute difference of class probabilities
+        n_mismatch: An integer, number of patterns with a different predicted class
+    """
+    from keras.models import load_model
+
+    if weights_filename is None:
+        weights_filename = get_weights_filename(cnn_model_filename)
+    keras_model = load_model(cnn_model_filename)
+    numpy_model = ReportCNN(weights_filename)
+
+    # hourly patterns like the ones in cluster profiles: percentages over the 7 x 24 hours of a week
+    rng = np.random.RandomState(random_state)
+    X = rng.dirichlet(np.full(7 * 24, 0.3), size=n_samples) * 100
+    X = X.reshape((n_samples,) + tuple(keras_model.input_shape[1:])).astype(np.float32)
+
+    y_keras = keras_model.predict(X)
+    y_numpy = numpy_model.predict(X)
+    max_diff = float(np.abs(y_keras - y_numpy).max())
+    n_mismatch = int((np.argmax(y_keras, axis=1) != np.argmax(y_numpy, axis=1)).sum())
+    return max_diff, n_mismatch
+
+
+def _get_hour_labels(hours):
+    """
+    Function to get the 'h-1:00-h:00' label of every hour, formatted once per distinct hour
+    """
+    unique_hours, inverse = np.unique(hours.values, return_inverse=True)
+    labels = np.array([str(h-1) + ':00-' + str(h) + ':00' for h in unique_hours.tolist()], dtype=object)
+    return labels[inverse.reshape(-1)]
+
+
 class ReportGenerator():
     def __init__(self, cnn_model_filename, sample_factor=1000, noise_std=0.3):
         self.n_classes = len(RIDER_LABEL_DICT)
         self.cnn_model_filename = cnn_model_filename
         self.sample_factor = sample_factor
         self.noise_std = noise_std
+        self.cnn_model = None
+
+    def __load_model(self):
+        """
+        Function to load the CNN, in numpy if its weights were exported (see export_cnn_weights()), otherwise in keras
+        """
+        weights_filename = get_weights_filename(self.cnn_model_filename)
+        if os.path.isfile(weights_filename):
+            return ReportCNN(weights_filename)
+        from keras.models import load_model
+        return load_model(self.cnn_model_filename)
 
     def get_text(self, row):
-        text = 'The predicted type of rider for this cluster is {}. '.format(RIDER_LABEL_DICT[row['rider_type']])
-        text += 'There are {} riders in the cluster, taking {} trips on average. '.format(row['cluster_size'],
-                                                                                          round(row['cluster_avg_num_trips'], 2))
-        max_wkday_hr1 = str(row['max_wkday_24_1']-1)+':00-' + str(row['max_wkday_24_1'])+':00'
-        max_wkday_hr2 = str(row['max_wkday_24_2']-1)+':00-' + str(row['max_wkday_24_2'])+':00'
-        max_wkend_hr1 = str(row['max_wkend_24_1']-1)+':00-' + str(row['max_wkend_24_1'])+':00'
-
-        text += 'The cluster overall shows most traffic during {} and {} on weekdays, '.format(max_wkday_hr1, max_wkday_hr2)
-        text += 'and during {} on weekends. '.format(max_wkend_hr1)
-        text += 'The most frequent trip origin is in zipcode {}. '.format(row['max_zip'])
-        return text
+        return self.get_texts(pd.DataFrame([row]))[0]
+
+    def get_texts(self, df):
+        """
+        DESCRIPTION:
+            Function to assemble the report text of every cluster column-wise
+        INPUT:
+            df: A dataframe with rider_type, cluster_size, cluster_avg_num_trips, max_wkday_24_1,
+                max_wkday_24_2, max_wkend_24_1 and max_zip columns, required
+        RETURN:
+            texts: An object array of report strings, one per row of df
+        """
+        rider_labels = np.array([RIDER_LABEL_DICT[i] for i in range(self.n_classes)], dtype=object)
+        # str() of python scalars, as row-wise formatting would give
+        cluster_size = np.array([str(x) for x in df['cluster_size'].tolist()], dtype=object)
+        avg_num_trips = np.array([str(round(x, 2)) for x in df['cluster_avg_num_trips'].tolist()], dtype=object)
+
+        texts = 'The predicted type of rider for this cluster is ' + rider_labels[df['rider_type'].values.astype(int)] + '. '
+        texts += 'There are ' + cluster_size + ' riders in the cluster, taking ' + avg_num_trips + ' trips on average. '
+        texts += 'The cluster overall shows most traffic during ' + _get_hour_labels(df['max_wkday_24_1']) + \
+                 ' and ' + _get_hour_labels(df['max_wkday_24_2']) + ' on weekdays, '
+        texts += 'and during ' + _get_hour_labels(df['max_wkend_24_1']) + ' on weekends. '
+        texts += 'The most frequent trip origin is in zipcode ' + df['max_zip'].values.astype(object) + '. '
+        return texts
 
     def generate_report(self, df):
         # drop the old report
@@ -43,25 +273,28 @@ class ReportGenerator():
         hr_cols = ['hr_' + str(i) for i in range(1, 169)]
         X_1D = df_copy[hr_cols].values
         n_clusters = X_1D.shape[0]
-        X = np.expand_dims(X_1D.reshape((n_clusters, 7, 24)), axis=-1)
+        X = np.expand_dims(X_1D.reshape((n_clusters, 7, 24)), axis=-1).astype(np.float32)
 
-        self.cnn_model = load_model(self.cnn_model_filename)
+        if self.cnn_model is None:
+            self.cnn_model = self.__load_model()
+        y_proba = self.cnn_model.predict(X)
         if 'manual_label' in df_copy.columns:
-            y_onehot = np.eye(len(RIDER_LABEL_DICT))[df_copy['manual_label'].values.astype(int)]
-            scores = self.cnn_model.evaluate(X, y_onehot, verbose=1)
-            print('Loss (against manual label):', scores[0])
-            print('Accuracy (against manual label):', scores[1])
+            # categorical crossentropy and accuracy, as in keras evaluate
+            y_true = df_copy['manual_label'].values.astype(int)
+            p_true = np.clip(y_proba[np.arange(n_clusters), y_true], 1e-7, 1 - 1e-7)
+            print('Loss (against manual label):', -np.mean(np.log(p_true)))
+            print('Accuracy (against manual label):', np.mean(np.argmax(y_proba, axis=1) == y_true))
 
         # predicted rider type
-        df_copy['rider_type'] = self.cnn_model.predict_classes(X)
+        df_copy['rider_type'] = np.argmax(y_proba, axis=1)
 
         # get max origin zipcode
         zip_cols = [col for col in df_copy.columns if 'zipcode_' in col]
-        max_zip_indices = np.argmax(df_copy[zip_cols].values, axis=1)
-        df_copy['max_zip'] = [zip_cols[idx].split('_')[-1] for idx in max_zip_indices]
+        zip_labels = np.array([col.split('_')[-1] for col in zip_cols], dtype=object)
+        df_copy['max_zip'] = zip_labels[np.argmax(df_copy[zip_cols].values, axis=1)]
 
         # generate report summary and append to the dataframe
-        df_copy['report'] = df_copy.apply(lambda row: self.get_text(row), axis=1)
+        df_copy['report'] = self.get_texts(df_copy)
 
         # save the profile csv with report and newly predicted rider type
         df['rider_type'] = df_copy['rider_type']
@@ -4,21 +4,461 @@ import pandas as pd
 import numpy as np
 import json
 import sys, os
+import gc
+import resource
+import threading
 import time
+from contextlib import contextmanager
 from copy import deepcopy
-from sklearn import preprocessing
-from sklearn.cluster import KMeans
-from sklearn.decomposition import LatentDirichletAllocation
-from sklearn.metrics import calinski_harabaz_score
+from itertools import product
 
 from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.catalog import get_catalog, atomic_write
+from MBTAriderSegmentation.features import load_rider_features, iter_rider_features
+
+###############################################
+# Module level helpers (picklable for joblib)
+###############################################
+def _get_model(algorithm, random_state=RANDOM_STATE, max_iter=MAX_ITER, tol=TOL, n_jobs=-1):
+    """
+    Function to construct an unfitted clustering model by name
+    INPUT:
+        algorithm: one of ALGORITHMS
+    OUTPUT:
+        model: Kmeans or LDA model
+    """
+    # sklearn is imported on first use so that reading cluster labels does not pay for it
+    if algorithm == 'kmeans':
+        from sklearn.cluster import KMeans
+        return KMeans(random_state=random_state, max_iter=max_iter, tol=tol, n_jobs=n_jobs)
+    elif algorithm == 'lda':
+        from sklearn.decomposition import LatentDirichletAllocation
+        return LatentDirichletAllocation(random_state=random_state, n_jobs=n_jobs)
+    else:
+        raise ValueError('algorithm must be one of {}'.format(ALGORITHMS))
+
+def _get_cluster_score(features, cluster_labels):
+    """
+    Function to get the CH-index that shows how good the clustring result is.
+    INPUT:
+        features: df of features to cluster
+        cluster_labels: predicted features
+    OUTPUT:
+        score: CH-index for the current clustering results
+    """
+    from sklearn.metrics import calinski_harabaz_score
+    score = calinski_harabaz_score(features, cluster_labels)
+    return score
+
+def _get_cluster_score_chunked(X, cluster_labels, col_scale=None, col_shift=None, sample_weight=None,
+                               chunk_size=CHUNK_SIZE):
+    """
+    Function to get the CH-index of X * col_scale + col_shift without materializing the scaled matrix.
+    Per-cluster (weighted) sums and sums of squares are accumulated over row chunks, which gives the same
+    within/between cluster dispersion as calinski_harabaz_score on the scaled matrix.
+    INPUT:
+        X: 2D array of unscaled features
+        cluster_labels: predicted features
+        col_scale, col_shift: 1D arrays of the per-column affine transform, None for no transform
+        sample_weight: 1D array of row weights (e.g. coreset weights), None for equal weights
+    OUTPUT:
+        score: CH-index for the current clustering results
+    """
+    unique_labels, label_idx = np.unique(cluster_labels, return_inverse=True)
+    n_labels = len(unique_labels)
+    if sample_weight is None:
+        sample_weight = np.ones(len(X))
+    counts = np.zeros(n_labels)
+    sums = np.zeros((n_labels, X.shape[1]))
+    sumsq = np.zeros((n_labels, X.shape[1]))
+    for start in range(0, len(X), chunk_size):
+        chunk = X[start:start+chunk_size].astype(np.float64)
+        if col_scale is not None:
+            chunk = chunk * col_scale + col_shift
+        # weighted one-hot cluster membership of the rows in the chunk
+        membership = (label_idx[start:start+chunk_size] == np.arange(n_labels)[:, None]) * sample_weight[start:start+chunk_size]
+        counts += membership.sum(axis=1)
+        sums += membership.dot(chunk)
+        sumsq += membership.dot(chunk ** 2)
+        del chunk, membership
+    total_disp = (sumsq.sum(axis=0) - sums.sum(axis=0) ** 2 / counts.sum()).sum()
+    within_disp = (sumsq - sums ** 2 / counts[:, None]).sum()
+    between_disp = total_disp - within_disp
+    n_samples = counts.sum()
+    if within_disp == 0:
+        return 1.
+    return between_disp * (n_samples - n_labels) / (within_disp * (n_labels - 1.))
+
+def _get_peak_memory():
+    """
+    Function to get the peak resident memory (MB) of this process and its finished child processes
+    over their lifetime, used where /proc is not available
+    """
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':  # ru_maxrss is in bytes on macOS and in KB on linux
+        peak = peak / 1024
+    return peak / 1024
+
+def _get_rss(pid):
+    """
+    Function to get the current resident memory (MB) of a process, None if /proc is not available
+    """
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+def _get_child_pids(pid):
+    """
+    Function to get the child processes of a process (e.g. joblib workers), empty if /proc does not list them
+    """
+    children = []
+    try:
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid), 'r') as f:
+                children += [int(child) for child in f.read().split()]
+    except (IOError, OSError):
+        pass
+    return children
+
+
+class _StageMemory:
+    """
+    Context manager to measure the peak resident memory (MB) of one stage: the RSS of this process and
+    of its child processes is summed every interval seconds while the stage runs. peak includes child
+    processes alive during the stage (e.g. idle joblib workers kept for reuse), process_peak is this
+    process only. Where /proc is not available, both are the lifetime peak of _get_peak_memory() instead.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = None
+        self.process_peak = None
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __sample(self):
+        rss = _get_rss(os.getpid())
+        if rss is None:
+            return
+        self.process_peak = rss if self.process_peak is None else max(self.process_peak, rss)
+        pids = _get_child_pids(os.getpid())
+        while pids:
+            pid = pids.pop()
+            rss += _get_rss(pid) or 0  # a worker may exit between the two reads
+            pids += _get_child_pids(pid)
+        self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.__sample()
+
+    def __enter__(self):
+        self.__sample()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.__stop.set()
+        self.__thread.join()
+        self.__sample()
+        if self.peak is None:
+            self.peak = self.process_peak = _get_peak_memory()
+        return False
+
+def _apply_clustering_algorithm(features, model, n_clusters_list=[2, 3, 4, 5], sample_weight=None):
+    """
+    INPUT:
+        features: df of features to cluster
+        model: Kmeans or LDA model
+        n_clusters_list: a list of number of clusters used for the clustering algorithm
+        sample_weight: row weights used by kmeans and by the CH-index (e.g. coreset weights), None for equal weights
+    OUTPUT:
+        cluster_result: clustering results of the best number of clusters from the CH-index
+        best_n_clusters: the best number of clusters from the CH-index
+    """
+    from sklearn.cluster import KMeans
+    from sklearn.decomposition import LatentDirichletAllocation
+
+    cluster_labels_list = []
+    cluster_scores = []
+
+    for i, n_clust in enumerate(n_clusters_list):
+        # calculate label and scores for the current set of labels
+        if isinstance(model, LatentDirichletAllocation):
+            model.set_params(n_components=n_clust)
+            proba = model.fit_transform(features)
+            cluster_labels = np.argmax(proba, axis=1)
+        elif isinstance(model, KMeans):
+            model.set_params(n_clusters=n_clust)
+            if sample_weight is None:
+                cluster_labels = model.fit_predict(features)
+            else:
+                cluster_labels = model.fit_predict(features, sample_weight=sample_weight)
+        else:
+            print("Algorithm not implemented")
+            pass
+        try:
+            if sample_weight is None:
+                score = _get_cluster_score(features, cluster_labels)
+            else:
+                score = _get_cluster_score_chunked(features, cluster_labels, sample_weight=sample_weight)
+        except:
+            score = 0
+        # append cluster result to list
+        cluster_labels_list.append(cluster_labels)
+        cluster_scores.append(score)
+        print("finished fitting {}/{} models".format(i+1, len(n_clusters_list)), end='\r')
+        sys.stdout.flush()
+    # find the number of clusters and labels that gave the highest score
+    cluster_result = cluster_labels_list[np.argmax(cluster_scores)]
+    best_n_clusters = n_clusters_list[np.argmax(cluster_scores)]
+    return cluster_result, best_n_clusters
+
+def _get_weighted_rows(X, rows, col_idx, col_scale, col_shift=None, non_negative=False):
+    """
+    Function to select rows (by index array) and columns of X and apply the per-column weights.
+    Only the selected block is copied, X itself is not modified.
+    INPUT:
+        X: 2D array of features
+        rows, col_idx: row and column indices to select
+        col_scale: weight applied to each column in col_idx
+        col_shift: offset added to each column in col_idx after col_scale, None for no offset
+        non_negative: clip the result at 0 (min-max normalized features for LDA)
+    OUTPUT:
+        current_X: 2D array of weighted features
+    """
+    current_X = X[np.ix_(rows, col_idx)]
+    current_X *= col_scale.astype(current_X.dtype)
+    if col_shift is not None:
+        current_X += col_shift.astype(current_X.dtype)
+        if non_negative:  # minmax normalized features are >= 0 up to float32 rounding
+            np.maximum(current_X, 0, out=current_X)
+    return current_X
+
+def _build_coreset(X, rows, col_idx, col_scale, col_shift=None, non_negative=False, coreset_size=10000,
+                   sensitivity=True, random_state=RANDOM_STATE, chunk_size=CHUNK_SIZE):
+    """
+    Function to build a weighted coreset of the weighted rows of X.
+    With sensitivity=True this is a lightweight coreset (Bachem et al. 2018): rows are sampled with
+    probability q = 1/(2n) + d(x, mean)^2 / (2 sum d^2) and weighted by 1/(coreset_size * q).
+    Otherwise rows are sampled uniformly with equal weights n/coreset_size.
+    The weighted rows are built chunk by chunk, only the mean, n distances and the coreset are kept.
+    INPUT:
+        X, rows, col_idx, col_scale, col_shift, non_negative: see _get_weighted_rows()
+        coreset_size: number of rows in the coreset
+        sensitivity: boolean, sensitivity (lightweight coreset) or uniform sampling
+    OUTPUT:
+        coreset: 2D array of weighted features of the sampled rows
+        coreset_weight: 1D array of coreset row weights, summing to about len(rows)
+    """
+    rng = np.random.RandomState(random_state)
+    n = len(rows)
+    if n <= coreset_size:
+        return _get_weighted_rows(X, rows, col_idx, col_scale, col_shift, non_negative), np.ones(n)
+
+    q = np.full(n, 1. / n)
+    if sensitivity:
+        # mean of the weighted rows
+        col_sum = np.zeros(len(col_idx))
+        for start in range(0, n, chunk_size):
+            chunk = _get_weighted_rows(X, rows[start:start+chunk_size], col_idx, col_scale, col_shift, non_negative)
+            col_sum += chunk.sum(axis=0, dtype=np.float64)
+        col_mean = col_sum / n
+        # squared distance of each row to the mean
+        dist = np.empty(n)
+        for start in range(0, n, chunk_size):
+            chunk = _get_weighted_rows(X, rows[start:start+chunk_size], col_idx, col_scale, col_shift, non_negative)
+            dist[start:start+chunk_size] = ((chunk - col_mean) ** 2).sum(axis=1)
+        del chunk
+        if dist.sum() > 0:
+            q = 0.5 / n + 0.5 * dist / dist.sum()
+        del dist
+    sample = np.sort(rng.choice(n, size=coreset_size, replace=True, p=q))
+    coreset = _get_weighted_rows(X, rows[sample], col_idx, col_scale, col_shift, non_negative)
+    coreset_weight = 1. / (coreset_size * q[sample])
+    return coreset, coreset_weight
+
+def _cluster_rows(X, rows, col_idx, col_scale, model, n_clusters_list, col_shift=None, non_negative=False,
+                  coreset_size=None, evaluate_coreset=False, random_state=RANDOM_STATE, chunk_size=CHUNK_SIZE):
+    """
+    Function to cluster the weighted rows of X, picking the number of clusters by the CH-index.
+    If coreset_size is given, the k sweep runs on a weighted coreset (sensitivity sampling for kmeans,
+    uniform sampling for LDA, which takes no sample weights) and all rows are then assigned to the
+    chosen model chunk by chunk.
+    INPUT:
+        X, rows, col_idx, col_scale, col_shift, non_negative: see _get_weighted_rows()
+        model: Kmeans or LDA model
+        n_clusters_list: a list of number of clusters used for the clustering algorithm
+        coreset_size: number of rows in the coreset, None to cluster all rows
+        evaluate_coreset: boolean, compare kmeans inertia of the coreset model against a fit on all rows
+    OUTPUT:
+        cluster_labels: 1D array of cluster labels of rows
+        coreset_stats: dictionary of coreset size and inertia gap, empty if no coreset is used or evaluated
+    """
+    coreset_stats = {}
+    if coreset_size is None or len(rows) <= coreset_size:
+        current_X = _get_weighted_rows(X, rows, col_idx, col_scale, col_shift, non_negative)
+        cluster_labels, _ = _apply_clustering_algorithm(current_X, model, n_clusters_list=n_clusters_list)
+        del current_X
+        return cluster_labels, coreset_stats
+
+    from sklearn.cluster import KMeans
+    is_kmeans = isinstance(model, KMeans)
+    coreset, coreset_weight = _build_coreset(X, rows, col_idx, col_scale, col_shift, non_negative,
+                                             coreset_size=coreset_size, sensitivity=is_kmeans,
+                                             random_state=random_state, chunk_size=chunk_size)
+    _, best_n_clusters = _apply_clustering_algorithm(coreset, model, n_clusters_list=n_clusters_list,
+                                                     sample_weight=coreset_weight if is_kmeans else None)
+    # refit the chosen number of clusters (same random_state, so same model as in the sweep)
+    if is_kmeans:
+        model.set_params(n_clusters=best_n_clusters)
+        model.fit(coreset, sample_weight=coreset_weight)
+    else:
+        model.set_params(n_components=best_n_clusters)
+        model.fit(coreset)
+    del coreset
+
+    # assign all rows to the chosen centroids/topics
+    cluster_labels = np.empty(len(rows), dtype=int)
+    coreset_inertia = 0.
+    for start in range(0, len(rows), chunk_size):
+        chunk = _get_weighted_rows(X, rows[start:start+chunk_size], col_idx, col_scale, col_shift, non_negative)
+        if is_kmeans:
+            cluster_labels[start:start+chunk_size] = model.predict(chunk)
+            coreset_inertia -= model.score(chunk)
+        else:
+            cluster_labels[start:start+chunk_size] = np.argmax(model.transform(chunk), axis=1)
+        del chunk
+
+    if evaluate_coreset and is_kmeans:
+        full_X = _get_weighted_rows(X, rows, col_idx, col_scale, col_shift, non_negative)
+        full_model = KMeans(n_clusters=best_n_clusters, random_state=random_state,
+                            max_iter=model.max_iter, tol=model.tol).fit(full_X)
+        del full_X
+        coreset_stats = {'n_rows': len(rows), 'coreset_size': coreset_size, 'n_clusters': best_n_clusters,
+                         'coreset_inertia': coreset_inertia, 'full_inertia': full_model.inertia_,
+                         'inertia_gap': (coreset_inertia - full_model.inertia_) / full_model.inertia_}
+    return cluster_labels, coreset_stats
+
+def _final_rider_segmentation(X, initial_clusters, col_idx, col_scale, algorithm, col_shift=None,
+                              score_scaling=None, n_clusters_list=[2, 3, 4, 5], random_state=RANDOM_STATE,
+                              max_iter=MAX_ITER, tol=TOL, n_jobs=-1, coreset_size=None, evaluate_coreset=False):
+    '''
+    Function to perform final rider segmentation for one configuration.
+    Only the rows of the current initial cluster are weighted at a time, so X itself is never modified
+    and can be shared (memory-mapped by joblib) between configurations.
+    INPUT:
+        X: 2D array of standardized (kmeans) or normalized (lda) features,
+            or of raw float32 features if col_shift and score_scaling are given
+        initial_clusters: 1D array of initial cluster assignment for each row of X
+        col_idx: column indices of X used in the final round of clustering
+        col_scale: weight applied to each column in col_idx
+        algorithm: one of ALGORITHMS
+        col_shift: offset added to each column in col_idx after col_scale, None for no offset
+        score_scaling: (scale, shift) of all columns of X for the CH-index, None if X is already scaled
+        n_clusters_list: a list of number of clusters used for the clustering algorithm
+        coreset_size: number of rows in the coreset of each initial cluster, None to cluster all rows
+        evaluate_coreset: boolean, compare coreset inertia against a fit on all rows
+    OUTPUT:
+        final_clusters: final cluster labels
+        score: CH-index of the final cluster labels on (scaled) X
+        coreset_report: dictionary of coreset stats keyed by initial cluster
+    '''
+    model = _get_model(algorithm, random_state=random_state, max_iter=max_iter, tol=tol, n_jobs=n_jobs)
+    final_clusters = np.full(len(X), np.nan)
+    coreset_report = {}
+
+    # loop through unique_clusters and find within-cluster clusters
+    for cluster in np.unique(initial_clusters):
+        # find riders belonging to the current cluster
+        rows = np.flatnonzero(initial_clusters == cluster)
+        cluster_labels, coreset_stats = _cluster_rows(X, rows, col_idx, col_scale, model, n_clusters_list,
+                                                      col_shift=col_shift, non_negative=(algorithm == 'lda'),
+                                                      coreset_size=coreset_size,
+                                                      evaluate_coreset=evaluate_coreset,
+                                                      random_state=random_state)
+        if coreset_stats:
+            coreset_report[int(cluster)] = coreset_stats
+
+        # update final cluster assignment
+        final_clusters[rows] = (np.array(cluster_labels) + (cluster * 10)).astype(int)
+    if score_scaling is None and coreset_size is None:
+        score = _get_cluster_score(X, final_clusters)
+    elif score_scaling is None:
+        score = _get_cluster_score_chunked(X, final_clusters)
+    else:
+        score = _get_cluster_score_chunked(X, final_clusters, *score_scaling)
+    return final_clusters, score, coreset_report
+
+def _get_label_dtype(values):
+    """
+    Function to find the smallest signed integer type that holds all cluster labels
+    """
+    for dtype in [np.int8, np.int16, np.int32]:
+        if values.min() >= np.iinfo(dtype).min and values.max() <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def save_cluster_labels(filename, labels, features_filename):
+    """
+    DESCRIPTION:
+        Function to save cluster results as a compact binary label table.
+        Rider features are not copied, riderID is stored as the row position
+        in the cached features file named by features_filename.
+    INPUT:
+        filename: A string of the .npz file to write, required
+        labels: A dataframe of integer label columns (e.g. initial_cluster, kmeans, lda)
+            in the row order of the cached features, required
+        features_filename: A string of the cached features file the labels refer to, required
+    RETURN:
+        None
+    """
+    arrays = {'riderID': np.arange(len(labels), dtype=np.int32)}
+    for col in labels.columns:
+        values = np.asarray(labels[col]).astype(np.int64)
+        arrays[col] = values.astype(_get_label_dtype(values))
+    np.savez_compressed(filename, features_file=np.array(features_filename),
+                        label_cols=np.array(list(labels.columns)), **arrays)
+
+def load_cluster_labels(filename):
+    """
+    DESCRIPTION:
+        Function to load a label table written by save_cluster_labels()
+    INPUT:
+        filename: A string of the .npz file to read, required
+    RETURN:
+        features_filename: A string of the cached features file the labels refer to
+        labels: A dataframe with riderID (row position in the features) and label columns
+    """
+    with np.load(filename) as npz:
+        features_filename = str(npz['features_file'])
+        label_cols = [str(col) for col in npz['label_cols']]
+        labels = pd.DataFrame(data={col: npz[col] for col in ['riderID'] + label_cols},
+                              columns=['riderID'] + label_cols)
+    return features_filename, labels
+
 
 class Segmentation:
     """
     Class to do rider segmentatin using hierarchical vs. non-hierarchical model.
     The clustering methods that are currently implemented are kmeans and LDA.
+
+    With low_memory=True, only one float32 matrix of raw features is kept. Standardization,
+    normalization and weights are applied as per-column scale/offset vectors on the rows
+    of one initial cluster at a time, and peak memory of each stage is kept in self.memory_report.
+
+    With coreset_size set, the k sweep of each initial cluster runs on a weighted coreset of
+    coreset_size riders and all riders are then assigned to the chosen model. With evaluate_coreset=True
+    the kmeans inertia gap against a fit on all riders is kept in self.coreset_report.
     """
-    def __init__(self, w_time=None, start_month='1701', duration=1, random_state=RANDOM_STATE, max_iter=MAX_ITER, tol=TOL):
+    def __init__(self, w_time=None, start_month='1701', duration=1, random_state=RANDOM_STATE, max_iter=MAX_ITER, tol=TOL,
+                 low_memory=False, coreset_size=None, evaluate_coreset=False):
         self.random_state = random_state
         self.max_iter = max_iter
         self.tol = tol
@@ -26,18 +466,32 @@ class Segmentation:
         self.start_month = start_month
         self.duration = duration
         self.w_time_choice = w_time
-
-        self.__get_data()
-        self.__standardize_features()
-        self.__normalize_features()
+        self.low_memory = low_memory
+        self.memory_report = {}
+        self.coreset_size = coreset_size
+        self.evaluate_coreset = evaluate_coreset
+        self.coreset_report = {}
+
+        with self.__measure_memory('load features'):
+            if low_memory:
+                self.__get_data_low_memory()
+            else:
+                self.__get_data()
+        with self.__measure_memory('standardize and normalize features'):
+            if low_memory:
+                self.__get_scaling_params()
+            else:
+                self.__standardize_features()
+                self.__normalize_features()
+                self.X_columns = list(self.X.columns)
 
         # number of riders
-        self.N_riders = len(self.df)
+        self.N_riders = len(self.group_by_frequency)
 
         # feature groups
-        self.time_feats = [e for e in self.df.columns if 'hr_' in e] + ['max_wkday_24_1', 'max_wkday_24_2', 'max_wkend_24_1', 'flex_wkday_24', 'flex_wkend_24']
-        self.geo_feats = [e for e in self.df.columns if 'zipcode_' in e]
-        self.purchase_feats = [e for e in self.df.columns if 'tariff_' in e] + [e for e in self.df.columns if 'usertype_' in e] + [e for e in self.df.columns if 'servicebrand_' in e]
+        self.time_feats = [e for e in self.X_columns if 'hr_' in e] + ['max_wkday_24_1', 'max_wkday_24_2', 'max_wkend_24_1', 'flex_wkday_24', 'flex_wkend_24']
+        self.geo_feats = [e for e in self.X_columns if 'zipcode_' in e]
+        self.purchase_feats = [e for e in self.X_columns if 'tariff_' in e] + [e for e in self.X_columns if 'usertype_' in e] + [e for e in self.X_columns if 'servicebrand_' in e]
         self.weekday_vs_weekend_feats = ['weekday', 'weekend']
 
         # for non hierarchical model
@@ -62,14 +516,23 @@ class Segmentation:
     # Helper function for init constructor
     ###############################################
     def __get_data(self):
-        try:
-            self.df = pd.read_csv(DATA_PATH + FEATURE_PATH + FEATURE_FILE_PREFIX + self.start_month +
-                                  '_' + str(self.duration) + '.csv', sep=',', dtype={'riderID': str}, index_col=0)
-        except: # if features in that month are not cached
-            new_df = FeatureExtractor(start_month=self.start_month, duration=self.duration).extract_features()
-            del new_df
-            self.df = pd.read_csv(DATA_PATH + FEATURE_PATH + FEATURE_FILE_PREFIX + self.start_month +
-                                  '_' + str(self.duration) + '.csv', sep=',', dtype={'riderID': str}, index_col=0)
+        self.df = load_rider_features(start_month=self.start_month, duration=self.duration)
+        self.group_by_frequency = np.array(self.df['group_by_frequency']).astype(int)
+
+    def __get_data_low_memory(self):
+        # read features in row chunks straight into one float32 matrix, riderID is not kept
+        # since cluster labels refer to riders by row position
+        X_chunks = []
+        group_chunks = []
+        for chunk in iter_rider_features(start_month=self.start_month, duration=self.duration):
+            self.X_columns = list(chunk.columns.drop(['riderID', 'group_by_frequency']))
+            group_chunks.append(chunk['group_by_frequency'].values.astype(np.int8))
+            X_chunks.append(chunk[self.X_columns].values.astype(np.float32))
+            del chunk
+        self.group_by_frequency = np.concatenate(group_chunks).astype(int)
+        self.X_base = np.concatenate(X_chunks)
+        del X_chunks, group_chunks
+        gc.collect()
 
     def __standardize_features(self):
         # standardize features (only the columns with > 0 standard deviation)
@@ -93,166 +556,159 @@ class Segmentation:
             else:
                 self.X_norm[col] = (self.X[col] - self.X[col].min()) / (self.X[col].max() - self.X[col].min())
 
-    ###############################################
-    # Helper function for segmentation
-    ###############################################
-    def __apply_clustering_algorithm(self, features, model, n_clusters_list=[2, 3, 4, 5]):
+    def __get_scaling_params(self, block_size=64):
+        # per-column scale and offset such that X_base * scale + shift equals X_stand (kmeans) or X_norm (lda)
+        n_cols = self.X_base.shape[1]
+        col_mean, col_std = np.zeros(n_cols), np.zeros(n_cols)
+        col_min, col_max = np.zeros(n_cols), np.zeros(n_cols)
+        for start in range(0, n_cols, block_size):
+            block = self.X_base[:, start:start+block_size].astype(np.float64)
+            col_mean[start:start+block_size] = block.mean(axis=0)
+            col_std[start:start+block_size] = block.std(axis=0, ddof=1)
+            col_min[start:start+block_size] = block.min(axis=0)
+            col_max[start:start+block_size] = block.max(axis=0)
+            del block
+        # columns with 0 standard deviation or 0 range are set to 0
+        stand_scale = np.divide(1., col_std, out=np.zeros(n_cols), where=col_std > 0)
+        col_range = col_max - col_min
+        norm_scale = np.divide(1., col_range, out=np.zeros(n_cols), where=col_range > 0)
+        self.scaling = {'kmeans': (stand_scale, -col_mean * stand_scale),
+                        'lda': (norm_scale, -col_min * norm_scale)}
+
+    def __get_base_matrix(self, algorithm):
         """
-        INPUT:
-            features: df of features to cluster
-            model: Kmeans or LDA model
-            n_clusters_list: a list of number of clusters used for the clustering algorithm
-        OUTPUT:
-            cluster_result: clustering results of the best number of clusters from the CH-index
+        Function to get the matrix to cluster on and the per-column (scale, shift) still to be applied to it
         """
-        cluster_labels_list = []
-        cluster_scores = []
-
-        for i, n_clust in enumerate(n_clusters_list):
-            # calculate label and scores for the current set of labels
-            if isinstance(model, LatentDirichletAllocation):
-                model.set_params(n_components=n_clust)
-                proba = model.fit_transform(features)
-                cluster_labels = np.argmax(proba, axis=1)
-            elif isinstance(model, KMeans):
-                model.set_params(n_clusters=n_clust)
-                cluster_labels = model.fit_predict(features)
-            else:
-                print("Algorithm not implemented")
-                pass
-            try:
-                score = self.__get_cluster_score(features, cluster_labels)
-            except:
-                score = 0
-            # append cluster result to list
-            cluster_labels_list.append(cluster_labels)
-            cluster_scores.append(score)
-            print("finished fitting {}/{} models".format(i+1, len(n_clusters_list)), end='\r')
-            sys.stdout.flush()
-        # find the number of clusters and labels that gave the highest score
-        cluster_result = cluster_labels_list[np.argmax(cluster_scores)]
-        return cluster_result
-
-    def __get_cluster_score(self, features, cluster_labels):
+        if self.low_memory:
+            return self.X_base, self.scaling[algorithm]
+        elif algorithm == 'kmeans':
+            return self.X_stand.values, None
+        else:
+            return self.X_norm.values, None
+
+    @contextmanager
+    def __measure_memory(self, stage):
         """
-        Function to get the CH-index that shows how good the clustring result is.
-        INPUT:
-            features: df of features to cluster
-            cluster_labels: predicted features
-        OUTPUT:
-            score: CH-index for the current clustering results
+        Function to keep the peak memory of a stage in self.memory_report, see _StageMemory
         """
-        score = calinski_harabaz_score(features, cluster_labels)
-        return score
+        with _StageMemory() as memory:
+            yield
+        self.memory_report[stage] = memory.peak
+        print("[{}] peak memory: {:.1f} MB (this process {:.1f} MB)".format(stage, memory.peak, memory.process_peak))
 
+    ###############################################
+    # Helper function for segmentation
+    ###############################################
     def __initial_rider_segmentation(self, hierarchical=False):
         '''
         Function to perform initial rider segmentation
             If hierarchical is True, perform Kmeans on weekday_vs_weekend_feats and purchase_feats
-            Otherwise, simply rename "group_by_frequency" to "initial_cluster"
+            Otherwise, simply map "group_by_frequency" to 10 and 20
         INPUT:
             hierarchical: boolean value True or False
+        OUTPUT:
+            initial_clusters: 1D array of initial cluster assignment, self.df is left untouched
         '''
         # assign initial cluster based trip frequency
         print("assigning initial clusters")
-        self.df.rename(columns={"group_by_frequency": "initial_cluster"}, inplace=True)
+        initial_clusters = self.group_by_frequency.copy()
 
         if hierarchical:
             # perform KMeans on unique clusters
-            unique_clusters = set(self.df['initial_cluster'].unique())
-
-            features_to_cluster = self.X_stand.copy().loc[:, self.features_layer_1]
+            unique_clusters = set(np.unique(initial_clusters))
 
-            # apply weights
-            features_to_cluster[self.purchase_feats] = features_to_cluster[self.purchase_feats] * self.w_purchase
-            features_to_cluster[self.weekday_vs_weekend_feats] = features_to_cluster[self.weekday_vs_weekend_feats] * self.w_week
+            col_idx = [self.X_columns.index(col) for col in self.features_layer_1]
+            col_scale = self.__get_col_scale(self.features_layer_1, {'purchase': self.w_purchase, 'week': self.w_week})
+            X, scaling = self.__get_base_matrix('kmeans')
+            col_shift = None
+            if scaling is not None:
+                col_shift = col_scale * scaling[1][col_idx]
+                col_scale = col_scale * scaling[0][col_idx]
 
             # perform K means clustering on the frequent riders (initial cluster = 1 or 2)
-            kmeans = KMeans(random_state=self.random_state, max_iter=self.max_iter, tol=self.tol, n_jobs=-1)
+            kmeans = _get_model('kmeans', random_state=self.random_state, max_iter=self.max_iter, tol=self.tol)
             print("K means for initial clustering in hierarchical model")
 
              # loop through unique_clusters and find within-cluster clusters
             for cluster in unique_clusters:
                 # find riders belonging to the current cluster
-                current_X = features_to_cluster.loc[self.df['initial_cluster'] == cluster]
-                new_initial_cluster = self.__apply_clustering_algorithm(current_X, kmeans, n_clusters_list=[2, 3])
+                rows = np.flatnonzero(initial_clusters == cluster)
+                new_initial_cluster, _ = _cluster_rows(X, rows, col_idx, col_scale, kmeans, [2, 3],
+                                                       col_shift=col_shift, coreset_size=self.coreset_size,
+                                                       random_state=self.random_state)
 
                 # update initial cluster assignment
-                self.df.loc[self.df['initial_cluster']==cluster, 'initial_cluster'] = (np.array(new_initial_cluster) + (cluster * 10)).astype(int)
-                del current_X
+                initial_clusters[rows] = (np.array(new_initial_cluster) + (cluster * 10)).astype(int)
                 del new_initial_cluster
-            del features_to_cluster
         else:
-            self.df['initial_cluster'][self.df['initial_cluster'] == 1] = 10
-            self.df['initial_cluster'][self.df['initial_cluster'] == 2] = 20
+            initial_clusters[initial_clusters == 1] = 10
+            initial_clusters[initial_clusters == 2] = 20
+        return initial_clusters
 
-
-    def __final_rider_segmentation(self, model, features, n_clusters_list=[2, 3, 4, 5], hierarchical=False):
+    def __get_weights(self, hierarchical=False, w_time_choice=None):
         '''
-        Function to perform final rider segmentation
-            If hierarchical is True, perform further clustering on temporal (168 hrs) and geo features
-            Otherwise, perform clustering on temporal (168 hours), geo and ticket purchasing features
+        Function to get the feature group weights of the final round of clustering.
+        The base weights set in the constructor are not modified, so any number of
+        w_time choices can be evaluated with the same object.
         INPUT:
-            model: K-means or LDA model
-            features: features to perform final clustring
-            n_clusters_list: a list of number of clusters used for the clustering algorithm
             hierarchical: boolean value True or False
+            w_time_choice: relative weight (out of 100) of temporal patterns, None for equal weighting
         OUTPUT:
-            results: final cluster labels
+            weights: dictionary of weights keyed by feature group
         '''
-        df = features.copy()
-        # add a column
-        df['final_cluster'] = np.nan
-        df['initial_cluster'] = np.array(self.df['initial_cluster'])
-
-        unique_clusters = set(df['initial_cluster'].unique())
-        print(unique_clusters)
-        features_to_cluster = None
-
-        if hierarchical:
-            if self.w_time_choice:
-                self.w_time = self.w_time * self.w_time_choice
-                self.w_geo_choice = (100 - self.w_time_choice)
-                self.w_geo = self.w_geo * self.w_geo_choice
+        weights = {'time': self.w_time, 'geo': self.w_geo, 'purchase': self.w_purchase, 'week': self.w_week}
+        if w_time_choice:
+            weights['time'] = self.w_time * w_time_choice
+            if hierarchical:
+                weights['geo'] = self.w_geo * (100 - w_time_choice)
             else:
-                self.w_geo_choice = None
-
-            features_to_cluster = df[self.features_layer_2]
+                weights['geo'] = self.w_geo * (100 - w_time_choice)/2
+                weights['purchase'] = self.w_purchase * (100 - w_time_choice)/2
+        return weights
 
-            # apply weights
-            features_to_cluster[self.time_feats] = features_to_cluster[self.time_feats] * self.w_time
-            features_to_cluster[self.geo_feats] = features_to_cluster[self.geo_feats] * self.w_geo
-        else:
-            # update weights
-            if self.w_time_choice:
-                self.w_time = self.w_time * self.w_time_choice
-                self.w_geo_choice = (100 - self.w_time_choice)/2
-                self.w_pur_choice = self.w_geo_choice
-                self.w_geo = self.w_geo * self.w_geo_choice
-                self.w_purchase = self.w_purchase * self.w_pur_choice
-            else:
-                self.w_geo_choice = None
-
-            features_to_cluster = df[self.features]
-            # apply weights
-            features_to_cluster[self.purchase_feats] = features_to_cluster[self.purchase_feats] * self.w_purchase
-            features_to_cluster[self.time_feats] = features_to_cluster[self.time_feats] * self.w_time
-            features_to_cluster[self.geo_feats] = features_to_cluster[self.geo_feats] * self.w_geo
-
-        # loop through unique_clusters and find within-cluster clusters
-        for cluster in unique_clusters:
-            # find riders belonging to the current cluster
-            current_X = features_to_cluster.loc[df['initial_cluster'] == cluster]
-            final_clusters = self.__apply_clustering_algorithm(current_X, model, n_clusters_list=n_clusters_list)
-
-            # update initial cluster assignment
-            df.loc[df['initial_cluster']==cluster, 'final_cluster'] = (np.array(final_clusters) + (cluster * 10)).astype(int)
-        results = df['final_cluster']
-
-        del df
-        del features_to_cluster
-
-        return results
+    def __get_col_scale(self, features, weights):
+        '''
+        Function to turn feature group weights into a per-column scale vector
+        INPUT:
+            features: list of column names
+            weights: dictionary of weights keyed by feature group, output of __get_weights()
+        OUTPUT:
+            col_scale: 1D array with the weight of each column in features
+        '''
+        group_feats = {'time': self.time_feats, 'geo': self.geo_feats,
+                       'purchase': self.purchase_feats, 'week': self.weekday_vs_weekend_feats}
+        col_weight = {}
+        for group, weight in weights.items():
+            for col in group_feats[group]:
+                col_weight[col] = weight
+        return np.array([col_weight[col] for col in features])
+
+    def __save_results(self, labels, scores, hierarchical, w_time_choice):
+        '''
+        Function to save cluster results and scores of one (hierarchical, w_time) configuration.
+        Results are saved as a compact label table (riderID as row position in the cached features
+        plus one small integer column per label), see save_cluster_labels().
+        INPUT:
+            labels: dataframe of initial_cluster plus one column per algorithm, in cached features row order
+            scores: dictionary of CH-index keyed by algorithm
+            hierarchical: boolean value True or False
+            w_time_choice: relative weight of temporal patterns, None for equal weighting
+        '''
+        catalog = get_catalog()
+        params = {'view': 'hierarchical' if hierarchical else 'non-hierarchical',
+                  'month': self.start_month, 'duration': self.duration, 'w_time': w_time_choice}
+        results_filename = catalog.get_filename('clusters', **params)
+        scores_filename = catalog.get_sidecar_filenames('clusters', **params)[0]
+
+        features_filename = FEATURE_FILE_PREFIX + self.start_month + '_' + str(self.duration) + '.csv'
+        with atomic_write(results_filename) as temp_filename:
+            save_cluster_labels(temp_filename, labels, features_filename)
+        scores_json = json.dumps(scores)
+        with atomic_write(scores_filename) as temp_filename:
+            f = open(temp_filename, "w")
+            f.write(scores_json)
+            f.close()
+        catalog.register('clusters', **params)
 
     def get_rider_segmentation(self, hierarchical=False):
         """
@@ -260,63 +716,92 @@ class Segmentation:
         INPUT:
             hierarchical: boolean value True or False
         """
-        if hierarchical:
-            n_clusters_list = [2, 3, 4]
-        else:
-            n_clusters_list = [i for i in range(2, 9)]
-        self.scores = {}
-        # perform initial segmentation
-        print("performing initial segmentation...")
-        self.__initial_rider_segmentation(hierarchical=hierarchical)
-
-        # perform K means
-        print("performing KMeans...")
-        kmeans = KMeans(random_state=self.random_state, max_iter=self.max_iter, tol=self.tol, n_jobs=-1)
-        self.df['kmeans'] = self.__final_rider_segmentation(kmeans, self.X_stand, n_clusters_list=n_clusters_list, hierarchical=hierarchical)
-        print(self.df['kmeans'].unique())
-        self.scores['kmeans'] = self.__get_cluster_score(self.X_stand, self.df['kmeans'])
-        del kmeans
-
-        # perform LDA
-        print("performing LDA...")
-        lda = LatentDirichletAllocation(random_state=self.random_state, n_jobs=-1)
-        self.df['lda'] = self.__final_rider_segmentation(lda, self.X_norm, n_clusters_list=n_clusters_list, hierarchical=hierarchical)
-        print(self.df['lda'].unique())
-        self.scores['lda'] = self.__get_cluster_score(self.X_norm, self.df['lda'])
-        del lda
-
-        print("saving results...")
-        if hierarchical:
-            # save results in subdirectories
-            dest = DATA_PATH + CLUSTER_PATH + 'hierarchical/'
-            if not os.path.isdir(dest):
-                os.makedirs(dest)
-        else:
-            # save results in a subdirectory
-            dest = DATA_PATH + CLUSTER_PATH + 'non_hierarchical/'
-            if not os.path.isdir(dest):
-                os.makedirs(dest)
-
-
-        if not os.path.isdir(dest+'results/'):
-                os.makedirs(dest+'results/')
+        results = self.get_rider_segmentation_sweep(hierarchical_list=[hierarchical],
+                                                    w_time_list=[self.w_time_choice],
+                                                    algorithms=ALGORITHMS, n_jobs=1)
+        self.scores = results[(hierarchical, self.w_time_choice)]['scores']
 
-        if not os.path.isdir(dest+'scores/'):
-            os.makedirs(dest+'scores/')
+    def get_rider_segmentation_sweep(self, hierarchical_list=[True, False], w_time_list=[None],
+                                     algorithms=ALGORITHMS, n_jobs=-1):
+        """
+        Function to do rider segmentation for every (hierarchical, w_time, algorithm) combination
+        and save all results and scores in one call. Features are loaded and scaled once in the constructor,
+        initial segmentation is done once per hierarchical flag, and the final clustering of each
+        configuration runs in parallel.
+        INPUT:
+            hierarchical_list: list of boolean values True or False
+            w_time_list: list of relative weights (out of 100) of temporal patterns, None for equal weighting
+            algorithms: list of clustering algorithms, subset of ALGORITHMS
+            n_jobs: number of configurations fitted in parallel, -1 means using all processors
+        OUTPUT:
+            results: dictionary keyed by (hierarchical, w_time) with the saved 'labels' dataframe and 'scores'.
+                'labels' holds initial_cluster plus one column per algorithm, in cached features row order
+        """
+        X_by_algo = {algorithm: self.__get_base_matrix(algorithm) for algorithm in algorithms}
+        # avoid oversubscription, sklearn parallelism is only used if configurations run one at a time
+        inner_n_jobs = -1 if n_jobs == 1 else 1
 
-        if self.w_time_choice:
-            self.df.to_csv(dest + 'results/'+ CLUSTER_FILE_PREFIX + self.start_month +
-                       '_' + str(self.duration) + '_' + str(self.w_time_choice) + '.csv')
-            scores_json = json.dumps(self.scores)
-            f = open(dest + 'scores/' + CLUSTER_FILE_PREFIX + self.start_month +
-                    '_' + str(self.duration) + '_' + str(self.w_time_choice) + '.json',"w")
-            f.write(scores_json)
-            f.close()
-        else:
-            self.df.to_csv(dest + 'results/'+ CLUSTER_FILE_PREFIX + self.start_month + '_' + str(self.duration)
-                           + '_0' + '.csv')
-            scores_json = json.dumps(self.scores)
-            f = open(dest + 'scores/' + CLUSTER_FILE_PREFIX + self.start_month + '_' + str(self.duration)  +
-                     '_0' + '.json',"w")
-            f.write(scores_json)
-            f.close()
+        # perform initial segmentation
+        print("performing initial segmentation...")
+        initial_clusters = {}
+        with self.__measure_memory('initial segmentation'):
+            for hierarchical in hierarchical_list:
+                initial_clusters[hierarchical] = self.__initial_rider_segmentation(hierarchical=hierarchical)
+
+        from sklearn.externals.joblib import Parallel, delayed
+
+        # collect the final segmentation tasks
+        configs = list(product(hierarchical_list, w_time_list, algorithms))
+        tasks = []
+        for hierarchical, w_time_choice, algorithm in configs:
+            if hierarchical:
+                n_clusters_list = [2, 3, 4]
+                features = self.features_layer_2
+            else:
+                n_clusters_list = [i for i in range(2, 9)]
+                features = self.features
+            weights = self.__get_weights(hierarchical=hierarchical, w_time_choice=w_time_choice)
+            col_idx = [self.X_columns.index(col) for col in features]
+            col_scale = self.__get_col_scale(features, weights)
+            X, scaling = X_by_algo[algorithm]
+            col_shift = None
+            if scaling is not None:  # fold standardization/normalization into the weights
+                col_shift = col_scale * scaling[1][col_idx]
+                col_scale = col_scale * scaling[0][col_idx]
+            tasks.append(delayed(_final_rider_segmentation)(X, initial_clusters[hierarchical],
+                                                            col_idx, col_scale, algorithm,
+                                                            col_shift=col_shift, score_scaling=scaling,
+                                                            n_clusters_list=n_clusters_list,
+                                                            random_state=self.random_state,
+                                                            max_iter=self.max_iter, tol=self.tol,
+                                                            n_jobs=inner_n_jobs,
+                                                            coreset_size=self.coreset_size,
+                                                            evaluate_coreset=self.evaluate_coreset))
+
+        # perform final segmentation
+        with self.__measure_memory('final segmentation'):
+            print("performing final segmentation for {} configurations...".format(len(tasks)))
+            outputs = Parallel(n_jobs=n_jobs)(tasks)
+            del tasks
+            gc.collect()
+
+        with self.__measure_memory('save results'):
+            print("saving results...")
+            results = {}
+            for (hierarchical, w_time_choice, algorithm), (final_clusters, score, coreset_report) in zip(configs, outputs):
+                key = (hierarchical, w_time_choice)
+                if key not in results:
+                    labels = pd.DataFrame(data={'initial_cluster': initial_clusters[hierarchical]})
+                    results[key] = {'labels': labels, 'scores': {}}
+                results[key]['labels'][algorithm] = final_clusters
+                results[key]['scores'][algorithm] = score
+                print(algorithm, np.unique(final_clusters))
+                if coreset_report:
+                    self.coreset_report[(hierarchical, w_time_choice, algorithm)] = coreset_report
+                    for cluster, stats in coreset_report.items():
+                        print("[coreset] initial cluster {}: {} of {} riders, k={}, inertia gap vs full fit: {:.2%}".format(
+                            cluster, stats['coreset_size'], stats['n_rows'], stats['n_clusters'], stats['inertia_gap']))
+
+            for (hierarchical, w_time_choice), result in results.items():
+                self.__save_results(result['labels'], result['scores'], hierarchical, w_time_choice)
+        return results
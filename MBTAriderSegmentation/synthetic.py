@@ -0,0 +1,390 @@
+import numpy as np
+import pandas as pd
+import os, sys
+import shutil
+import json
+import calendar
+from datetime import datetime
+
+from MBTAriderSegmentation.config import *
+
+# data shipped with the package (census, geojson and report model are copied into synthetic data roots)
+PACKAGE_DATA_PATH = os.path.dirname(os.path.abspath(__file__)) + '/data/'
+
+# Greater Boston zipcodes (all present in MA_census.xlsx), most to least frequent trip origins
+SYNTHETIC_ZIPCODES = [
+    '02115', '02116', '02111', '02108', '02109', '02110', '02114', '02118', '02119', '02120',
+    '02121', '02122', '02124', '02125', '02126', '02127', '02128', '02129', '02130', '02131',
+    '02132', '02134', '02135', '02136', '02138', '02139', '02140', '02141', '02142', '02143',
+    '02144', '02145', '02148', '02149', '02150', '02151', '02152', '02155', '02163', '02169',
+    '02170', '02171', '02176', '02180', '02184', '02186', '02199', '02210', '02215', '02445',
+    '02446', '02452', '02453', '02458', '02459', '02460', '02472', '02474', '02476', '02478',
+    '01906', '01923', '01960', '02019', '02021', '02026', '02043', '02062', '02090', '02188'
+]
+
+# ticket types: (tickettypeid, tariff, servicebrand, usertype, zonecr), zonecr is only set for commuter rail
+SYNTHETIC_TICKET_TYPES = [
+    (101, 'Stored Value', 'Subway', 'Adult', None),
+    (102, 'Stored Value', 'Local Bus', 'Adult', None),
+    (103, 'Monthly Pass', 'Subway', 'Adult', None),
+    (104, 'Monthly Pass', 'Local Bus', 'Adult', None),
+    (105, '7-Day Pass', 'Subway', 'Adult', None),
+    (106, 'Single Ride', 'Subway', 'Adult', None),
+    (201, 'Monthly Pass', 'Subway', 'Student', None),
+    (202, 'Stored Value', 'Local Bus', 'Student', None),
+    (301, 'Monthly Pass', 'Subway', 'Senior', None),
+    (302, 'Stored Value', 'Subway', 'Senior/TAP', None),
+    (401, 'Stored Value', 'Subway', 'Blind', None),
+    (501, 'Monthly Pass', 'Commuter Rail', 'Adult', '1a'),
+    (502, 'Monthly Pass', 'Commuter Rail', 'Adult', '2'),
+    (503, 'Monthly Pass', 'Inner Express Bus', 'Adult', None)
+]
+
+# relative frequency of each ticket type in SYNTHETIC_TICKET_TYPES as a rider's primary ticket
+SYNTHETIC_TICKET_MIX = [0.22, 0.10, 0.20, 0.06, 0.05, 0.05, 0.08, 0.03, 0.05, 0.08, 0.01, 0.03, 0.02, 0.02]
+
+# rider types and their share of riders
+SYNTHETIC_RIDER_MIX = {'commuter': 0.55, 'weekend': 0.15, 'random': 0.30}
+
+# relative number of trips by rider type
+SYNTHETIC_TRIP_MULTIPLIER = {'commuter': 1.5, 'weekend': 0.5, 'random': 0.7}
+
+# hourly profiles (hour 0 to 23) of trip start times
+SYNTHETIC_HOURLY_PROFILES = {
+    'am_peak': np.array([0, 0, 0, 0, 0, 1, 4, 10, 12, 6, 2, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], dtype=float),
+    'pm_peak': np.array([0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 2, 2, 3, 5, 10, 12, 8, 4, 2, 1, 1, 0], dtype=float),
+    'weekend': np.array([1, 0, 0, 0, 0, 0, 1, 1, 2, 4, 6, 7, 8, 8, 8, 7, 7, 6, 6, 5, 4, 3, 2, 1], dtype=float),
+    'random': np.array([1, 0, 0, 0, 0, 1, 2, 4, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 4, 4, 3, 2, 2, 1], dtype=float)
+}
+
+# valid (station entry) and other device classes / movement types, see DataLoader
+STATION_DEVICECLASSIDS = [411, 412, 441, 442, 443, 501, 503]
+OTHER_DEVICECLASSIDS = [100, 200, 300]
+VALIDATION_MOVEMENTTYPES = [7, 20]
+OTHER_MOVEMENTTYPES = [1, 5]
+
+
+class SyntheticDataGenerator:
+    """
+    Class to generate synthetic afc_odx transactions plus the matching stops and fareprod lookups.
+    The files have the same schema as the real input, so the whole pipeline (features, segmentation,
+    profile, dashboard) can run on them by pointing MBTA_DATA_PATH to output_path.
+
+    Each rider is a commuter, weekend rider or random rider with a home stop, a work stop and a primary
+    ticket type. Stop popularity and zipcodes follow a Zipf-like distribution. Rider attributes only depend
+    on seed and rider index, so the same riders appear in every generated month. Riders are generated and
+    written in chunks of chunk_riders, so memory does not grow with the number of transactions.
+    """
+    def __init__(self, output_path, n_riders=10000, trips_per_rider=20, rider_mix=SYNTHETIC_RIDER_MIX,
+                 ticket_mix=SYNTHETIC_TICKET_MIX, n_stops=800, zipcode_skew=1.0, stop_skew=1.1,
+                 invalid_fraction=0.02, seed=RANDOM_STATE, chunk_riders=100000):
+        self.output_path = os.path.join(output_path, '')
+        self.n_riders = n_riders
+        self.trips_per_rider = trips_per_rider
+        self.rider_types = list(rider_mix.keys())
+        self.rider_mix = np.array([rider_mix[rider_type] for rider_type in self.rider_types], dtype=float)
+        self.rider_mix /= self.rider_mix.sum()
+        self.ticket_mix = np.array(ticket_mix, dtype=float) / np.sum(ticket_mix)
+        self.n_stops = n_stops
+        self.zipcode_skew = zipcode_skew
+        self.stop_skew = stop_skew
+        self.invalid_fraction = invalid_fraction
+        self.seed = seed
+        self.chunk_riders = chunk_riders
+
+        # average trips per rider of each type, scaled so that the overall mean is trips_per_rider
+        multiplier = np.array([SYNTHETIC_TRIP_MULTIPLIER.get(rider_type, 1.) for rider_type in self.rider_types])
+        self.type_trips = trips_per_rider * multiplier / (self.rider_mix * multiplier).sum()
+
+        self.__make_stops()
+
+    ###############################################
+    # Helper functions
+    ###############################################
+    def __zipf_proba(self, n, skew):
+        proba = 1. / np.arange(1, n + 1) ** skew
+        return proba / proba.sum()
+
+    def __make_stops(self):
+        rng = np.random.RandomState(self.seed)
+        self.stop_ids = np.array(['place-' + str(10000 + i) for i in range(self.n_stops)])
+        zipcode_proba = self.__zipf_proba(len(SYNTHETIC_ZIPCODES), self.zipcode_skew)
+        self.stop_zipcodes = np.array(SYNTHETIC_ZIPCODES)[rng.choice(len(SYNTHETIC_ZIPCODES), size=self.n_stops,
+                                                                      p=zipcode_proba)]
+        self.stop_proba = self.__zipf_proba(self.n_stops, self.stop_skew)
+
+    def __make_directories(self):
+        subdirs = ['afc_odx', 'stops', 'fareprod', 'census', 'geojson']
+        for subdir in subdirs:
+            os.makedirs(self.output_path + INPUT_PATH + subdir, exist_ok=True)
+        for subdir in ['hierarchical', 'non_hierarchical']:
+            os.makedirs(self.output_path + CLUSTER_PATH + subdir + '/results', exist_ok=True)
+            os.makedirs(self.output_path + CLUSTER_PATH + subdir + '/scores', exist_ok=True)
+        for path in [FEATURE_PATH, PROFILE_PATH, VIZ_PATH, REPORT_PATH]:
+            os.makedirs(self.output_path + path, exist_ok=True)
+
+    def __copy_static_inputs(self):
+        # census, geojson and report model are not synthesized, copy them from the package data
+        for path in [INPUT_PATH + 'census/', INPUT_PATH + 'geojson/', REPORT_PATH]:
+            src = PACKAGE_DATA_PATH + path
+            if not os.path.isdir(src) or os.path.abspath(src) == os.path.abspath(self.output_path + path):
+                continue
+            for filename in os.listdir(src):
+                if filename != 'README.md' and not os.path.exists(self.output_path + path + filename):
+                    shutil.copy(src + filename, self.output_path + path + filename)
+
+    def __write_zipcode_geojson(self):
+        # the MA zipcode geojson is not shipped with the package, write one square per synthetic zipcode
+        filename = self.output_path + INPUT_PATH + 'geojson/ma_massachusetts_zip_codes_geo.min.json'
+        if os.path.exists(filename):
+            return
+        features = []
+        for i, zipcode in enumerate(SYNTHETIC_ZIPCODES):
+            lon, lat = -71.25 + 0.03 * (i % 10), 42.25 + 0.03 * (i // 10)
+            square = [[lon, lat], [lon + 0.03, lat], [lon + 0.03, lat + 0.03], [lon, lat + 0.03], [lon, lat]]
+            features.append({'type': 'Feature', 'properties': {'ZCTA5CE10': zipcode},
+                             'geometry': {'type': 'Polygon', 'coordinates': [square]}})
+        with open(filename, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+    def __get_riders(self, chunk):
+        """
+        Function to get the attributes of the riders in one chunk, independent of the month
+        """
+        start = chunk * self.chunk_riders
+        n = min(self.chunk_riders, self.n_riders - start)
+        rng = np.random.RandomState([self.seed, chunk])
+        riders = {
+            'card': np.arange(start, start + n) + 1000000000,
+            'rider_type': rng.choice(len(self.rider_types), size=n, p=self.rider_mix),
+            'home_stop': rng.choice(self.n_stops, size=n, p=self.stop_proba),
+            'work_stop': rng.choice(self.n_stops, size=n, p=self.stop_proba),
+            'ticket': rng.choice(len(SYNTHETIC_TICKET_TYPES), size=n, p=self.ticket_mix),
+            # some commuters start their day up to 2 hours earlier
+            'hour_shift': rng.choice([0, 0, 0, -1, -2], size=n)
+        }
+        return riders
+
+    def __sample_hours(self, rng, profile, n):
+        proba = SYNTHETIC_HOURLY_PROFILES[profile] / SYNTHETIC_HOURLY_PROFILES[profile].sum()
+        return rng.choice(24, size=n, p=proba)
+
+    def __get_transactions(self, riders, month, chunk):
+        """
+        Function to generate one month of transactions of the riders in one chunk
+        """
+        rng = np.random.RandomState([self.seed, chunk, int(month)])
+        year, mon = 2000 + int(month[:2]), int(month[2:])
+        n_days = calendar.monthrange(year, mon)[1]
+        day_of_week = np.array([datetime(year, mon, day + 1).weekday() for day in range(n_days)])
+        weekdays = np.flatnonzero(day_of_week < 5)
+        weekends = np.flatnonzero(day_of_week >= 5)
+
+        # number of trips of each rider, then one row per trip
+        n_trips = rng.poisson(self.type_trips[riders['rider_type']])
+        trip_rider = np.repeat(np.arange(len(n_trips)), n_trips)
+        n = len(trip_rider)
+        rider_type = np.array(self.rider_types)[riders['rider_type'][trip_rider]]
+
+        day = np.empty(n, dtype=int)
+        hour = np.empty(n, dtype=int)
+        stop = rng.choice(self.n_stops, size=n, p=self.stop_proba)
+
+        # commuters: mostly weekday trips, from home in the am peak and from work in the pm peak
+        is_commuter = np.flatnonzero(rider_type == 'commuter')
+        on_weekday = rng.rand(len(is_commuter)) < 0.9
+        is_am = rng.rand(len(is_commuter)) < 0.5
+        commute_day = np.where(on_weekday, rng.choice(weekdays, size=len(is_commuter)),
+                               rng.choice(weekends, size=len(is_commuter)))
+        commute_hour = np.where(is_am, self.__sample_hours(rng, 'am_peak', len(is_commuter)),
+                                self.__sample_hours(rng, 'pm_peak', len(is_commuter)))
+        commute_hour = np.where(on_weekday, commute_hour + riders['hour_shift'][trip_rider[is_commuter]],
+                                self.__sample_hours(rng, 'weekend', len(is_commuter)))
+        day[is_commuter] = commute_day
+        hour[is_commuter] = np.clip(commute_hour, 0, 23)
+        stop[is_commuter] = np.where(is_am, riders['home_stop'][trip_rider[is_commuter]],
+                                     riders['work_stop'][trip_rider[is_commuter]])
+
+        # weekend riders: mostly weekend trips, half of them from home
+        is_weekend = np.flatnonzero(rider_type == 'weekend')
+        on_weekend = rng.rand(len(is_weekend)) < 0.85
+        day[is_weekend] = np.where(on_weekend, rng.choice(weekends, size=len(is_weekend)),
+                                   rng.choice(weekdays, size=len(is_weekend)))
+        hour[is_weekend] = self.__sample_hours(rng, 'weekend', len(is_weekend))
+        from_home = rng.rand(len(is_weekend)) < 0.5
+        stop[is_weekend] = np.where(from_home, riders['home_stop'][trip_rider[is_weekend]], stop[is_weekend])
+
+        # random riders: any day, daytime hours, half of the trips from home
+        is_random = np.flatnonzero(rider_type == 'random')
+        day[is_random] = rng.choice(n_days, size=len(is_random))
+        hour[is_random] = self.__sample_hours(rng, 'random', len(is_random))
+        from_home = rng.rand(len(is_random)) < 0.5
+        stop[is_random] = np.where(from_home, riders['home_stop'][trip_rider[is_random]], stop[is_random])
+
+        # transaction time as seconds since the start of the month
+        seconds = day * 86400 + hour * 3600 + rng.randint(0, 3600, size=n)
+        trxtime = np.datetime64('{:04d}-{:02d}-01T00:00:00'.format(year, mon)) + seconds.astype('timedelta64[s]')
+        trxtime = np.char.replace(np.datetime_as_string(trxtime, unit='s'), 'T', ' ')
+
+        # mostly the primary ticket, sometimes another one
+        ticket = riders['ticket'][trip_rider]
+        other_ticket = rng.rand(n) < 0.05
+        ticket[other_ticket] = rng.choice(len(SYNTHETIC_TICKET_TYPES), size=other_ticket.sum(), p=self.ticket_mix)
+        tickettypeid = np.array([t[0] for t in SYNTHETIC_TICKET_TYPES])[ticket]
+
+        # station entries plus a fraction of transactions that DataLoader filters out
+        deviceclassid = rng.choice(STATION_DEVICECLASSIDS, size=n)
+        movementtype = rng.choice(VALIDATION_MOVEMENTTYPES, size=n)
+        origin = self.stop_ids[stop].astype(object)
+        invalid = np.flatnonzero(rng.rand(n) < self.invalid_fraction)
+        invalid_kind = rng.randint(0, 3, size=len(invalid))
+        deviceclassid[invalid[invalid_kind == 0]] = rng.choice(OTHER_DEVICECLASSIDS, size=(invalid_kind == 0).sum())
+        movementtype[invalid[invalid_kind == 1]] = rng.choice(OTHER_MOVEMENTTYPES, size=(invalid_kind == 1).sum())
+        origin[invalid[invalid_kind == 2]] = None
+
+        transactions = pd.DataFrame(data={
+            'deviceclassid': deviceclassid,
+            'trxtime': trxtime,
+            'tickettypeid': tickettypeid,
+            'card': riders['card'][trip_rider],
+            'origin': origin,
+            'movementtype': movementtype
+        }, columns=['deviceclassid', 'trxtime', 'tickettypeid', 'card', 'origin', 'movementtype'])
+        return transactions
+
+    ###############################################
+    # Main functions
+    ###############################################
+    def generate_lookups(self):
+        """
+        DESCRIPTION:
+            Function to write stops/stops_withzip.csv and fareprod/fareprod_ttj.csv and to copy
+            census, geojson and report model inputs into output_path. A placeholder zipcode geojson
+            is written if the package data has none.
+        INPUT:
+            None
+        RETURN:
+            None
+        """
+        self.__make_directories()
+        self.__copy_static_inputs()
+        self.__write_zipcode_geojson()
+
+        stops = pd.DataFrame(data={'stop_id': self.stop_ids,
+                                   'stop_name': ['Synthetic Stop ' + stop_id[6:] for stop_id in self.stop_ids],
+                                   'zipcode': self.stop_zipcodes},
+                             columns=['stop_id', 'stop_name', 'zipcode'])
+        stops.to_csv(self.output_path + INPUT_PATH + 'stops/stops_withzip.csv', sep=',', index=False)
+
+        fareprod = pd.DataFrame(data=SYNTHETIC_TICKET_TYPES,
+                                columns=['tickettypeid', 'tariff', 'servicebrand', 'usertype', 'zonecr'])
+        fareprod.to_csv(self.output_path + INPUT_PATH + 'fareprod/fareprod_ttj.csv', sep=';', index=False)
+
+    def generate_month(self, month):
+        """
+        DESCRIPTION:
+            Function to write one month of synthetic transactions to afc_odx/afc_odx_<month>.csv
+        INPUT:
+            month: A string of month in yymm format, required
+        RETURN:
+            n_transactions: An integer of number of transactions written
+        """
+        filename = self.output_path + INPUT_PATH + 'afc_odx/afc_odx_' + month + '.csv'
+        n_chunks = int(np.ceil(self.n_riders / self.chunk_riders))
+        n_transactions = 0
+        for chunk in range(n_chunks):
+            transactions = self.__get_transactions(self.__get_riders(chunk), month, chunk)
+            transactions.to_csv(filename, sep=',', index=False, header=(chunk == 0), mode='w' if chunk == 0 else 'a')
+            n_transactions += len(transactions)
+            del transactions
+            print("month {}: finished {}/{} rider chunks".format(month, chunk + 1, n_chunks), end='\r')
+            sys.stdout.flush()
+        print("month {}: {} transactions of {} riders".format(month, n_transactions, self.n_riders))
+        return n_transactions
+
+    def generate(self, months):
+        """
+        DESCRIPTION:
+            Function to write the lookups and the transactions of every month in months
+        INPUT:
+            months: A list of strings of months in yymm format, required
+        RETURN:
+            n_transactions: A dictionary of number of transactions keyed by month
+        """
+        self.generate_lookups()
+        return dict((month, self.generate_month(month)) for month in months)
+
+    def __get_profile_columns(self):
+        """
+        Function to get the groups of columns of a cluster profile, each group holds proportions that sum to 1
+        """
+        from MBTAriderSegmentation.profile import CensusFormatter
+
+        zipcodes = sorted(set(self.stop_zipcodes))
+        groups = [['hr_' + str(hr) for hr in range(1, 169)],
+                  ['zipcode_' + zipcode for zipcode in zipcodes]]
+        for i, prefix in [(3, 'usertype_'), (1, 'tariff_'), (2, 'servicebrand_')]:
+            groups.append(sorted(set(prefix + ticket_type[i] for ticket_type in SYNTHETIC_TICKET_TYPES)))
+        # census counts (_nb) and medians become the cluster_demo_ columns, see ClusterProfiler
+        derived = {'pov_': ['pov_fam_not_in_pov'], 'emp_': ['emp_employed'], 'hu_': ['hu_occ_hh', 'hu_unocc']}
+        for prefix in CensusFormatter.census_groups.values():
+            groups.append([col for col in CensusFormatter.new_col_names
+                           if col.startswith(prefix) and not col.endswith('_nb') and col != 'inc_med'] +
+                          derived.get(prefix, []))
+        return groups
+
+    def generate_profile(self, view, month, algorithm='lda', n_clusters=10, duration=1, w_time='0'):
+        """
+        DESCRIPTION:
+            Function to write a synthetic cluster profile with the columns of ClusterProfiler's output
+            and register it in the catalog of output_path, so the dashboard can serve it without running
+            the pipeline (e.g. to load test the dashboard with many views and clusters)
+        INPUT:
+            view: A string, one of PROFILE_VIEWS, required
+            month: A string of month in yymm format, required
+            algorithm: A string, one of ALGORITHMS, ignored by the overview
+            n_clusters: An integer, number of clusters, the overview has 1
+            duration: An integer, number of months
+            w_time: A string, weight of the temporal features
+        RETURN:
+            filename: A string of the profile file name
+        """
+        from MBTAriderSegmentation.catalog import get_catalog, atomic_write
+
+        n_clusters = 1 if view == 'overview' else n_clusters
+        rng = np.random.RandomState([self.seed, int(month), PROFILE_VIEWS.index(view), ALGORITHMS.index(algorithm),
+                                     n_clusters])
+        # clusters of rider group g are numbered g00, g01, ..., the overview is cluster 0
+        index = np.arange(n_clusters)
+        clusters = index if view == 'overview' else 100 * (index // 100 + 1) + index % 100
+        sizes = rng.randint(50, 5000, size=n_clusters)
+        avg_num_trips = np.round(rng.gamma(4., self.trips_per_rider / 4., size=n_clusters), 2)
+
+        # temporal, geographical, ticket purchase and census groups as random proportions
+        groups = [pd.DataFrame(rng.dirichlet(np.ones(len(cols)), size=n_clusters), columns=cols)
+                  for cols in self.__get_profile_columns()]
+        weekday_hours, weekend_hours = groups[0].values[:, :120], groups[0].values[:, 120:]
+        modes = pd.DataFrame({'max_wkday_24_1': weekday_hours.argmax(axis=1) % 24,
+                              'max_wkday_24_2': weekday_hours.argsort(axis=1)[:, -2] % 24,
+                              'max_wkend_24_1': weekend_hours.argmax(axis=1) % 24})
+        demographics = pd.DataFrame({'cluster_id': clusters, 'cluster_demo_pop': sizes * 10,
+                                     'cluster_demo_med_income': rng.randint(30000, 150000, size=n_clusters),
+                                     'cluster_demo_hh': sizes * 4, 'cluster_demo_pop_25': sizes * 7,
+                                     'cluster_demo_fam': sizes * 2, 'cluster_demo_pop_16': sizes * 8,
+                                     'cluster_demo_house_unit': sizes * 5})
+        viz = pd.DataFrame({'viz_id': clusters, 'viz_pca1': rng.randn(n_clusters), 'viz_pca2': rng.randn(n_clusters),
+                            'viz_size': sizes, 'viz_grp': clusters // 100})
+
+        profile = pd.DataFrame({'cluster': clusters, 'cluster_size': sizes, 'cluster_avg_num_trips': avg_num_trips})
+        profile = pd.concat([profile] + groups[:5] + [modes, demographics] + groups[5:] + [viz], axis=1)
+        profile['rider_type'] = rng.randint(0, 5, size=n_clusters)
+        profile['report'] = ['Synthetic cluster {} of {} riders taking {:.2f} trips on average.'.format(*row)
+                             for row in zip(clusters, sizes, avg_num_trips)]
+
+        catalog = get_catalog(self.output_path)
+        params = {'view': view, 'month': month, 'duration': str(duration), 'w_time': w_time, 'algorithm': algorithm}
+        filename = catalog.get_filename('profiles', **params)
+        with atomic_write(filename) as temp_filename:
+            profile.to_csv(temp_filename)
+        catalog.register('profiles', **params)
+        return filename
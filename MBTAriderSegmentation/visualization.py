@@ -1,95 +1,46 @@
-from sklearn.decomposition import PCA
-from datetime import datetime
-import os
-import re
 import numpy as np
 import pandas as pd
 import json
-import matplotlib.pyplot as plt
-import seaborn as sns
-import folium
-from branca.colormap import linear
-import IPython
 
 from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.catalog import get_catalog, atomic_write
 from MBTAriderSegmentation.profile import ClusterProfiler
 
 SMALL_FONT = 12
 MEDIUM_FONT = 15
 LARGE_FONT = 100
 
-sns.set()
-plt.rc('font', size=SMALL_FONT)          # controls default text sizes
-plt.rc('axes', titlesize=MEDIUM_FONT)     # fontsize of the axes title
-plt.rc('axes', labelsize=MEDIUM_FONT)    # fontsize of the x and y labels
-plt.rc('xtick', labelsize=SMALL_FONT)    # fontsize of the tick labels
-plt.rc('ytick', labelsize=SMALL_FONT)    # fontsize of the tick labels
-plt.rc('legend', fontsize=MEDIUM_FONT)    # legend fontsize
-plt.rc('figure', titlesize=LARGE_FONT)  # fontsize of the figure title
+def _get_pyplot():
+    """
+    DESCRIPTION:
+        Function to import matplotlib on first use and apply the plot style once. The plotting
+        libraries are not imported with the module so that loading profiles does not pay for them.
+    RETURN:
+        plt: matplotlib.pyplot module
+    """
+    import matplotlib.pyplot as plt
+    global _plot_style_set
+    if not _plot_style_set:
+        import seaborn as sns
+        sns.set()
+        plt.rc('font', size=SMALL_FONT)          # controls default text sizes
+        plt.rc('axes', titlesize=MEDIUM_FONT)     # fontsize of the axes title
+        plt.rc('axes', labelsize=MEDIUM_FONT)    # fontsize of the x and y labels
+        plt.rc('xtick', labelsize=SMALL_FONT)    # fontsize of the tick labels
+        plt.rc('ytick', labelsize=SMALL_FONT)    # fontsize of the tick labels
+        plt.rc('legend', fontsize=MEDIUM_FONT)    # legend fontsize
+        plt.rc('figure', titlesize=LARGE_FONT)  # fontsize of the figure title
+        _plot_style_set = True
+    return plt
+
+_plot_style_set = False
 
 class Visualization:
     def __init__(self, start_month='1701', duration=1):
         self.start_month = start_month
         self.duration = duration
 
-        # setting the file path based on start month and duration
-        start = datetime.strptime(self.start_month, "%y%m").strftime("%Y-%b")
-        if self.duration > 1:
-            end = datetime.strptime(str(int(self.start_month) + self.duration-1), "%y%m").strftime("%Y-%b")
-            self.input_path = DATA_PATH + PROFILE_PATH + start + '_to_' + end + '/'
-            self.output_path = DATA_PATH + VIZ_PATH + start + '_to_' + end + '/'
-        else:
-            self.input_path = DATA_PATH + PROFILE_PATH + start + '/'
-            self.output_path = DATA_PATH + VIZ_PATH + start + '/'
-
-        if not os.path.isdir(self.input_path):
-            os.makedirs(self.input_path)
-
-        self.param_keys = ['view', 'month', 'duration', 'w_time', 'algorithm']
-
-    def __split(self, delimiters, string, maxsplit=0):
-        """
-        Function to split file name for matching cached results
-        """
-        regexPattern = '|'.join(map(re.escape, delimiters))
-        return re.split(regexPattern, string, maxsplit)
-
-    def __get_cached_params_list(self):
-        """
-        Function to find parameter combinations of cached results
-        """
-        cached_combo = []
-        delimiters = ['_', '.']
-        for filename in os.listdir(self.input_path):
-            if filename.endswith(".csv"):
-                str_split = self.__split(delimiters, filename)[:-1]
-                if len(str_split) > 5:
-                    param_vals = [str_split[0]] + str_split[3:]
-                else:
-                    param_vals = [str_split[0]] + str_split[3:5] + ['na', 'na']
-                cached_combo.append(dict(zip(self.param_keys, param_vals)))
-        return cached_combo
-
-    def __read_csv(self, req_param_dict, by_cluster):
-        if by_cluster:
-            self.df = pd.read_csv(self.input_path + req_param_dict['view'] + '_' +
-                                      PROFILE_FILE_PREFIX +
-                                       req_param_dict['month'] + '_' +
-                                       req_param_dict['duration'] + '_' +
-                                       req_param_dict['w_time'] + '_' +
-                                       req_param_dict['algorithm'] +
-                                       '.csv', index_col=0)
-        else:
-            self.df = pd.read_csv(self.input_path + req_param_dict['view'] + '_' +
-                                      PROFILE_FILE_PREFIX +
-                                       req_param_dict['month'] + '_' +
-                                       req_param_dict['duration'] +
-                                       '.csv', index_col=0)
-
-
     def load_data(self, by_cluster=False, hierarchical=False, w_time=None, algorithm=None):
-        # check if the requested data is in the cache directory ready to go
-        cached_combo = self.__get_cached_params_list()
         if by_cluster:
             # parse hierarchical request
             if hierarchical:
@@ -114,20 +65,22 @@ class Visualization:
             self.req_w_time = 'na'
             self.req_algo = 'na'
 
-        req_param_vals = [self.req_view, self.start_month, str(self.duration), self.req_w_time, self.req_algo]
-        req_param_dict = dict(zip(self.param_keys, req_param_vals))
-
-        # check if request params are cached in profiler
-        if req_param_dict in cached_combo:
-            self.__read_csv(req_param_dict, by_cluster)
-        else:  # Get the cluster profile again
+        # check if the requested profile is cached
+        catalog = get_catalog()
+        self.req_params = {'view': self.req_view, 'month': self.start_month, 'duration': self.duration,
+                           'w_time': self.req_w_time, 'algorithm': self.req_algo}
+        def extract_profile():  # Get the cluster profile again
             profiler = ClusterProfiler(hierarchical=hierarchical, w_time=w_time, start_month=self.start_month, duration=self.duration)
-            profiler.extract_profile(algorithm=algorithm, by_cluster=by_cluster)
+            profiler.extract_profile(algorithm=self.req_algo, by_cluster=by_cluster)
             del profiler
-            self.__read_csv(req_param_dict, by_cluster)
+
+        # concurrent requests of an uncached profile wait for the first one to extract it
+        profile_filename = catalog.find_or_compute('profiles', extract_profile, **self.req_params)
+        self.df = pd.read_csv(profile_filename, index_col=0)
 
 
     def visualize_clusters_2d(self):
+        plt = _get_pyplot()
         fig, ax = plt.subplots(1, 1, figsize=(10, 7))
         for grp in self.df.viz_grp.unique():
             if grp == 1:
@@ -150,6 +103,8 @@ class Visualization:
         plt.show()
 
     def plot_cluster_hourly_pattern(self, cluster):
+        plt = _get_pyplot()
+        import seaborn as sns
         time_feats = [col for col in self.df.columns if 'hr_' in col]
         heatmap_matrix = self.df.loc[self.df['cluster'] == cluster, time_feats].values.reshape(7, 24)
         fig, ax = plt.subplots(1, 1, figsize = (18, 4))
@@ -166,6 +121,9 @@ class Visualization:
             self.plot_cluster_hourly_pattern(cluster.cluster)
 
     def plot_cluster_geo_pattern(self, cluster):
+        import folium
+        from branca.colormap import linear
+
         geo_cols = [col for col in self.df.columns if 'zipcode' in col]
         zipcodes = [z.split('_')[-1] for z in geo_cols]
         geo_json_data = json.load(open(DATA_PATH + INPUT_PATH + 'geojson/ma_massachusetts_zip_codes_geo.min.json'))
@@ -204,13 +162,13 @@ class Visualization:
         colormap.add_to(m)
 
         # save visualization
-        output_filename = 'GEO-chart' + '_' + self.req_view + '_' + self.start_month + '_' + str(self.duration) + '_' + self.req_w_time + '_' + self.req_algo + '_cluster'+ str(cluster) + '.html'
-        if not os.path.isdir(self.output_path):
-            os.makedirs(self.output_path)
-        m.save(os.path.join(self.output_path + output_filename))
+        catalog = get_catalog()
+        url = catalog.get_filename('viz', cluster=cluster, **self.req_params)
+        with atomic_write(url) as temp_filename:
+            m.save(temp_filename)
+        catalog.register('viz', cluster=cluster, **self.req_params)
 
         # display
-        url = self.output_path + output_filename
         return url
 
     def __single_feature_viz(self, feature, title, ylabel, xlabel):
@@ -218,6 +176,7 @@ class Visualization:
         Single-bar plot visualization of cluster_feat VS. cluster #
         cluster_feat: ['cluster_size', 'cluster_avg_num_trips']
         '''
+        plt = _get_pyplot()
         ax = self.df.set_index('cluster')[[feature]].plot(kind='bar', rot=0,
                                                                   title=title,
                                                                   figsize=(10, 7), colormap=COLORMAP)
@@ -251,6 +210,7 @@ class Visualization:
                                         'race', 'emp', 'edu', 'inc']
         stacked: boolean, default = True for stacked bar plot; False for side-by-side bar plot
         '''
+        plt = _get_pyplot()
         key = grp_key + '_'
         feat_grps = [col for col in self.df.columns if key in col]
         ax = self.df.set_index('cluster')[feat_grps].plot(kind='bar', rot=0, stacked=stacked,
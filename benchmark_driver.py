@@ -0,0 +1,32 @@
+import os
+import tempfile
+from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.benchmark import PipelineBenchmark, load_results, compare_to_baseline
+
+# runs every pipeline stage on synthetic data at each scale (generated once into output_path and reused), the
+# data roots and results are kept outside the repository, set output_path elsewhere to keep a baseline across reboots
+output_path = os.path.join(tempfile.gettempdir(), 'mbta_benchmark', '')
+results_filename = output_path + 'results.json'
+baseline_filename = output_path + 'baseline.json'
+
+benchmark = PipelineBenchmark(output_path=output_path, scales=BENCHMARK_SCALES, start_month='1710', duration=1)
+benchmark.run()
+benchmark.save(results_filename)
+
+# scaling curves, exponent is the slope of log(time) vs log(number of transactions)
+print("\nscaling curves (wall time):")
+for stage, curve in benchmark.get_scaling_curves(metric='wall_time').items():
+    exponent = 'n/a' if curve['exponent'] is None else '{:.2f}'.format(curve['exponent'])
+    print("{:<24s} {}  exponent {}".format(stage, ' '.join('{:9.2f}s'.format(t) for t in curve['wall_time']), exponent))
+
+# compare against the stored baseline, the first run becomes the baseline
+if os.path.exists(baseline_filename):
+    regressions = compare_to_baseline(benchmark.results, load_results(baseline_filename), threshold=BENCHMARK_THRESHOLD)
+    print("\n{} regression(s) vs baseline (threshold {:.0%})".format(len(regressions), BENCHMARK_THRESHOLD))
+    for regression in regressions:
+        print("[{} riders] {} {}: {:.2f} -> {:.2f} ({:+.0%})".format(regression['n_riders'], regression['stage'],
+                                                                      regression['metric'], regression['baseline'],
+                                                                      regression['current'], regression['change']))
+else:
+    benchmark.save(baseline_filename)
+    print("\nsaved baseline to {}".format(baseline_filename))
@@ -0,0 +1,17 @@
+from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.catalog import get_catalog
+
+# remove the cached files computed from outdated inputs, then rebuild the manifest to adopt the cached files
+# that were written without registering them, and list them
+catalog = get_catalog()
+stale = catalog.collect_garbage(dry_run=True)
+print("{} stale artifact(s)".format(len(stale)))
+for key in stale:
+    print(key)
+catalog.collect_garbage()
+
+catalog.rebuild()
+print("\ncached artifacts:")
+for kind in ['features', 'clusters', 'profiles', 'viz']:
+    entries = catalog.list_artifacts(kind=kind)
+    print("{}: {} artifact(s), {:.1f} MB".format(kind, len(entries), sum(entry['size'] for entry in entries) / 1e6))
@@ -2,19 +2,14 @@ import time
 from MBTAriderSegmentation.config import *
 from MBTAriderSegmentation.segmentation import Segmentation
 
-# Hierarchical pipeline
+# Hierarchical and non-hierarchical pipelines share one load/standardize/normalize pass
 import time
 t0 = time.time()
 start_month='1710'
 duration=1
 segmentation = Segmentation(start_month=start_month, duration=duration)
-segmentation.get_rider_segmentation(hierarchical=True)
-print("Hierarchical clustering time: ", time.time() - t0)
+print("Loading and scaling features time: ", time.time() - t0)
 
-# Non-hierarchical pipeline
 t0 = time.time()
-start_month='1710'
-duration=1
-segmentation = Segmentation(start_month=start_month, duration=duration)
-segmentation.get_rider_segmentation(hierarchical=False)
-print("Non-hierarchical clustering time: ", time.time() - t0)
+segmentation.get_rider_segmentation_sweep(hierarchical_list=[True, False], w_time_list=[None], algorithms=ALGORITHMS)
+print("Hierarchical + non-hierarchical clustering time: ", time.time() - t0)
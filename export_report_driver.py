@@ -0,0 +1,13 @@
+from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.report import export_cnn_weights, verify_cnn_weights
+
+# export the trained report CNN to numpy weights, ReportGenerator then runs it without keras/tensorflow
+cnn_model_filename = DATA_PATH + REPORT_PATH + 'report_cnn.h5'
+weights_filename = export_cnn_weights(cnn_model_filename)
+print("exported weights to", weights_filename)
+
+try:
+    max_diff, n_mismatch = verify_cnn_weights(cnn_model_filename, weights_filename)
+    print("max abs difference vs keras: {:.2e}, predicted classes differing: {}".format(max_diff, n_mismatch))
+except ImportError:
+    print("keras is not installed, skipped verification against keras")
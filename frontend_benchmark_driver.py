@@ -0,0 +1,11 @@
+from MBTAriderSegmentation.config import *
+from MBTAdashboard.src.benchmark import benchmark_frontend_data
+
+# formats the cached hierarchical kmeans profile of 1710 tiled to each number of clusters (set MBTA_DATA_PATH
+# to benchmark on another data root, e.g. the synthetic data of benchmark_driver.py)
+records = benchmark_frontend_data(n_clusters_list=FRONTEND_BENCHMARK_CLUSTERS, view='hierarchical',
+                                  start_month='1710', duration='1', time_weight='0', algorithm='kmeans')
+print("{:>10s} {:>10s} {:>10s} {:>10s}".format('clusters', 'format', 'serialize', 'payload'))
+for record in records:
+    print("{:>10d} {:9.3f}s {:9.3f}s {:8.2f}MB".format(record['n_clusters'], record['format_time'],
+                                                      record['serialize_time'], record['payload_mb']))
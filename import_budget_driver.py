@@ -0,0 +1,14 @@
+import sys
+from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.benchmark import check_import_budget
+
+# the dashboard and cached profile reads must start fast, heavy dependencies are imported where they are used
+records = check_import_budget(modules=IMPORT_BUDGET_MODULES, budget=IMPORT_TIME_BUDGET)
+for record in records:
+    print("{:<40s} {:6.3f}s  {}{}".format(record['module'], record['import_time'],
+                                        'ok' if record['passed'] else 'FAILED',
+                                        '  loads ' + ', '.join(record['deferred']) if record['deferred'] else ''))
+
+failed = [record for record in records if not record['passed']]
+print("\n{} of {} module(s) over the import budget of {:.2f}s".format(len(failed), len(records), IMPORT_TIME_BUDGET))
+sys.exit(1 if failed else 0)
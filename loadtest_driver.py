@@ -0,0 +1,45 @@
+import os
+import tempfile
+# the load test writes its synthetic profiles and results outside the repository, set MBTA_DATA_PATH and
+# output_path to keep them elsewhere (e.g. to keep a baseline across reboots)
+output_path = os.path.join(tempfile.gettempdir(), 'mbta_loadtest', '')
+os.environ.setdefault('MBTA_DATA_PATH', output_path + 'data/')
+
+from MBTAriderSegmentation.config import *
+from MBTAdashboard.src.loadtest import LoadTest, load_results, compare_to_baseline
+
+# load tests /reload_data with synthetic profiles of every view, month and algorithm, mode 'server' starts
+# the dashboard as a local flask server and measures it over HTTP, binary requests the payloads like the
+# dashboard in a browser does, False like json clients
+mode = 'in-process'
+binary = True
+load_test = LoadTest(data_path=DATA_PATH, mode=mode, concurrency=LOADTEST_CONCURRENCY, n_requests=LOADTEST_REQUESTS,
+                     months=LOADTEST_MONTHS, n_clusters=LOADTEST_CLUSTERS, binary=binary)
+results = load_test.run()
+
+print("\n{:>8s} {:>10s} {:>9s} {:>9s} {:>9s} {:>8s} {:>11s} {:>10s}".format(
+    'clients', 'req/s', 'p50', 'p95', 'p99', 'errors', 'rss growth', 'cache hit'))
+for record in results:
+    rss_growth = 'n/a' if record['rss_growth_mb'] is None else '{:.1f}MB'.format(record['rss_growth_mb'])
+    hit_rate = 'n/a' if record['cache_hit_rate'] is None else '{:.0%}'.format(record['cache_hit_rate'])
+    print("{:>8d} {:>10.1f} {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>8d} {:>11s} {:>10s}".format(
+        record['concurrency'], record['throughput'], record['p50'] * 1000, record['p95'] * 1000,
+        record['p99'] * 1000, record['errors'], rss_growth, hit_rate))
+print("throughput saturates at {} concurrent clients".format(load_test.get_saturation()))
+
+# results record the git revision they were measured at, compare against the stored baseline, the first run
+# becomes the baseline (remove it to measure a new one)
+payload_format = 'binary' if binary else 'json'
+results_filename = output_path + 'results_' + mode + '_' + payload_format + '.json'
+baseline_filename = output_path + 'baseline_' + mode + '_' + payload_format + '.json'
+load_test.save(results_filename)
+if os.path.exists(baseline_filename):
+    regressions = compare_to_baseline(results, load_results(baseline_filename), threshold=LOADTEST_THRESHOLD)
+    print("\n{} regression(s) vs baseline (threshold {:.0%})".format(len(regressions), LOADTEST_THRESHOLD))
+    for regression in regressions:
+        print("[{} clients] {}: {:.3f} -> {:.3f} ({:+.0%})".format(regression['concurrency'], regression['metric'],
+                                                                 regression['baseline'], regression['current'],
+                                                                 regression['change']))
+else:
+    load_test.save(baseline_filename)
+    print("\nsaved baseline to {}".format(baseline_filename))
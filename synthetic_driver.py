@@ -0,0 +1,17 @@
+import os
+import time
+import tempfile
+from MBTAriderSegmentation.config import *
+from MBTAriderSegmentation.synthetic import SyntheticDataGenerator
+
+# writes a synthetic data root outside the repository, run the other drivers on it with
+# MBTA_DATA_PATH=<output_path>
+t0 = time.time()
+output_path = os.path.join(tempfile.gettempdir(), 'mbta_synthetic_data', '')
+months = ['1710']
+n_riders = 10000
+trips_per_rider = 20
+generator = SyntheticDataGenerator(output_path=output_path, n_riders=n_riders, trips_per_rider=trips_per_rider)
+generator.generate(months)
+print("synthetic data generation time: ", time.time() - t0)
+print("wrote {}".format(output_path))